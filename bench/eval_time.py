@@ -0,0 +1,86 @@
+#
+# Wall time of MAMLRAWR.eval_macaw as a function of the number of adaptation steps,
+# for the exact (re-adapt from scratch at every step) and incremental schedules, and
+# for the task-batched eval (eval_macaw_batched) with the exact schedule.
+# Runs on the synthetic envs, so it needs no MuJoCo or offline data:
+#
+#   python -m bench.eval_time --steps 1 5 20
+#
+import argparse
+import json
+import random
+import tempfile
+import time
+from collections import namedtuple
+
+import numpy as np
+import torch
+
+from run import load_tasks, make_env
+from src.args import get_args
+from src.maml_rawr import MAMLRAWR
+from src.utils import NullWriter
+
+
+def build_model(task_config_path: str, argv=[], seed: int = 0) -> MAMLRAWR:
+    '''A MAMLRAWR on `task_config_path` with test buffers filled by random rollouts.'''
+    random.seed(seed)
+    np.random.seed(seed)
+    torch.manual_seed(seed)
+    args = get_args(['--task_config', task_config_path, '--device', 'cpu'] + argv)
+    with open(task_config_path, 'r') as f:
+        task_config = json.load(f, object_hook=lambda d: namedtuple('X', d.keys())(*d.values()))
+    env = make_env(task_config, args, load_tasks(task_config))
+    model = MAMLRAWR(args, task_config, env, tempfile.mkdtemp(), 'bench', training_iterations=args.train_steps,
+                     visualization_interval=args.vis_interval, silent=True,
+                     gradient_steps_per_iteration=args.gradient_steps_per_iteration,
+                     replay_buffer_length=args.replay_buffer_size, discount_factor=args.discount_factor)
+
+    env.action_space.seed(seed)
+    for _ in range(args.initial_rollouts):
+        for task_idx, test_buffer in zip(task_config.test_tasks, model._test_buffers):
+            env.set_task_idx(task_idx)
+            trajectory, _, _ = model._rollout_policy(model._adaptation_policy, env, random=True)
+            test_buffer.add_trajectory(trajectory, force=True)
+    return model
+
+
+def time_eval(model: MAMLRAWR, steps: int, incremental: bool, seed: int = 0, batched: bool = False):
+    model._maml_steps = steps
+    model._args.eval_maml_steps = steps
+    model._args.eval_incremental = incremental
+    model._rollout_counter = 0
+    random.seed(seed)
+    np.random.seed(seed)
+    torch.manual_seed(seed)
+
+    start = time.perf_counter()
+    eval_fn = model.eval_macaw_batched if batched else model.eval_macaw
+    _, rewards, _ = eval_fn(0, NullWriter())
+    return time.perf_counter() - start, rewards
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--task_config', type=str, default='config/synthetic/velocity_40tasks.json')
+    parser.add_argument('--steps', type=int, nargs='+', default=[1, 5, 20])
+    parser.add_argument('--batch_per_step', type=int, default=32)
+    parser.add_argument('--repeats', type=int, default=3)
+    args, model_argv = parser.parse_known_args()
+
+    batch_size = args.batch_per_step * max(args.steps)
+    # Small inner lrs keep the adaptation of an untrained model from diverging over 20 steps
+    model = build_model(args.task_config, ['--initial_rollouts', '5', '--inner_buffer_size', '5000', '--eval_batch_size', str(batch_size),
+                                           '--inner_value_lr', '1e-5', '--inner_policy_lr', '1e-5'] + model_argv)
+
+    print(f'{"steps":>5} {"exact (s)":>10} {"incremental (s)":>16} {"speedup":>8} {"batched (s)":>12} {"speedup":>8}')
+    for steps in args.steps:
+        model._args.eval_batch_size = args.batch_per_step * steps
+        exact = min(time_eval(model, steps, False)[0] for _ in range(args.repeats))
+        incremental = min(time_eval(model, steps, True)[0] for _ in range(args.repeats))
+        task_batched = min(time_eval(model, steps, False, batched=True)[0] for _ in range(args.repeats))
+        print(f'{steps:>5} {exact:>10.3f} {incremental:>16.3f} {exact / incremental:>7.2f}x {task_batched:>12.3f} {exact / task_batched:>7.2f}x')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,72 @@
+#
+# Time the training thread spends logging per iteration, replaying what train_step
+# logs for every training task (per-task scalars, the inner/outer weight histograms
+# and the lr histograms), with a plain SummaryWriter and with src/metrics.py.
+#
+#   python -m bench.metrics_writer --tasks 50 --steps 200
+#
+import argparse
+import tempfile
+import time
+
+import numpy as np
+import torch
+from torch.utils.tensorboard import SummaryWriter
+
+from src.metrics import MetricsWriter
+
+
+SCALARS = ['Loss_Value_Inner', 'Loss_Policy_Inner', 'Loss_Policy_Adv_Inner', 'Value_Mean_Inner', 'Advantage_Mean_Inner',
+           'Weight_Mean_Inner', 'MC_Mean_Inner', 'MC_std_Inner', 'Value_Mean_Outer', 'Weight_Mean_Outer',
+           'Advantage_Mean_Outer', 'MC_Mean_Outer', 'MC_std_Outer', 'Loss_Value_Outer', 'Loss_Policy_Outer',
+           'Reward_Train', 'Success_Train']
+
+
+def log_step(writer, step: int, n_tasks: int, batch_size: int, lrs: torch.tensor):
+    for task_idx in range(n_tasks):
+        for name in SCALARS:
+            writer.add_scalar(f'{name}/Task_{task_idx}', np.random.randn(), step)
+        writer.add_histogram(f'Inner_Weights/Task_{task_idx}', torch.rand(batch_size), step)
+        writer.add_histogram(f'Value_LRs', lrs, step)
+        writer.add_histogram(f'Policy_LRs', lrs, step)
+        writer.add_histogram(f'Outer_Weights/Task_{task_idx}', torch.rand(batch_size), step)
+
+
+def time_writer(writer, steps: int, n_tasks: int, batch_size: int):
+    '''(seconds per step on the training thread, seconds to drain and close the writer)'''
+    lrs = torch.rand(16)
+    start = time.perf_counter()
+    for step in range(steps):
+        log_step(writer, step, n_tasks, batch_size, lrs)
+    logging = time.perf_counter() - start
+    start = time.perf_counter()
+    writer.close()
+    return logging / steps, time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--tasks', type=int, default=50)
+    parser.add_argument('--steps', type=int, default=200)
+    parser.add_argument('--batch_size', type=int, default=256)
+    parser.add_argument('--log_interval', type=int, default=10)
+    parser.add_argument('--histogram_interval', type=int, default=100)
+    args = parser.parse_args()
+
+    writers = {
+        'SummaryWriter': lambda: SummaryWriter(tempfile.mkdtemp()),
+        'MetricsWriter (1, 1)': lambda: MetricsWriter(SummaryWriter(tempfile.mkdtemp())),
+        f'MetricsWriter ({args.log_interval}, {args.histogram_interval})':
+            lambda: MetricsWriter(SummaryWriter(tempfile.mkdtemp()), args.log_interval, args.histogram_interval),
+    }
+
+    print(f'{"writer":>28} {"ms/step":>9} {"close (s)":>10} {"speedup":>8}')
+    baseline = None
+    for name, make_writer in writers.items():
+        per_step, close = time_writer(make_writer(), args.steps, args.tasks, args.batch_size)
+        baseline = per_step if baseline is None else baseline
+        print(f'{name:>28} {per_step * 1e3:>9.2f} {close:>10.2f} {baseline / per_step:>7.1f}x')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,204 @@
+#
+# Microbenchmarks of the training hot paths on synthetic data: replay buffer writes
+# and sampling (in RAM, memmapped and contiguous), MLP forward+backward for each
+# layer type at the default widths, one higher inner step, the value and policy
+# losses, and a rollout on a synthetic env. Results can be saved as a baseline and
+# later runs compared against it:
+#
+#   python -m bench.micro --save bench/micro_baseline.json
+#   python -m bench.micro --compare bench/micro_baseline.json
+#
+import argparse
+import json
+import os
+import platform
+import statistics
+import tempfile
+import time
+from collections import OrderedDict
+from typing import Callable, Dict
+
+import higher
+import numpy as np
+import torch
+import torch.nn.functional as F
+import torch.optim as O
+
+from bench.eval_time import build_model
+from src.nn import MLP
+from src.utils import Experience, NewReplayBuffer
+
+
+def measure(fn: Callable, min_time: float = 0.5, repeats: int = 5) -> Dict[str, float]:
+    '''Microseconds per call of fn(): the median and min over `repeats` runs of enough calls to fill min_time.'''
+    fn()
+    number, elapsed = 1, 0.
+    while elapsed < min_time / repeats:
+        start = time.perf_counter()
+        for _ in range(number):
+            fn()
+        elapsed = time.perf_counter() - start
+        if elapsed < min_time / repeats:
+            number *= 2
+
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        for _ in range(number):
+            fn()
+        times.append((time.perf_counter() - start) / number * 1e6)
+    return {'median_us': statistics.median(times), 'min_us': min(times), 'calls': number}
+
+
+def random_trajectory(obs_dim: int, action_dim: int, length: int):
+    obs = np.random.randn(length + 1, obs_dim).astype(np.float32)
+    actions = np.random.randn(length, action_dim).astype(np.float32)
+    return [Experience(obs[t], actions[t], obs[t + 1], float(np.random.randn()), t == length - 1) for t in range(length)]
+
+
+def memmap_buffer(buffer: NewReplayBuffer, directory: str) -> NewReplayBuffer:
+    '''buffer with every field moved to a memmap in directory, as with --from_disk.'''
+    for field, array in buffer._datasets().items():
+        mapped = np.memmap(os.path.join(directory, f'{field}.array'), mode='w+', shape=array.shape, dtype=array.dtype)
+        mapped[:] = array
+        setattr(buffer, f'_{field}', mapped)
+    return buffer
+
+
+def buffer_cases(args) -> Dict[str, Callable]:
+    obs_dim, action_dim = args.obs_dim, args.action_dim
+    buffer = NewReplayBuffer(args.buffer_size, obs_dim, action_dim)
+    trajectory = random_trajectory(obs_dim, action_dim, args.episode_length)
+    while buffer._stored_steps < buffer._size:
+        buffer.add_trajectory(trajectory)
+
+    mapped = NewReplayBuffer(args.buffer_size, obs_dim, action_dim)
+    while mapped._stored_steps < mapped._size:
+        mapped.add_trajectory(trajectory)
+    mapped = memmap_buffer(mapped, tempfile.mkdtemp())
+
+    return OrderedDict([
+        (f'buffer/add_trajectory[{args.episode_length}]', lambda: buffer.add_trajectory(trajectory)),
+        (f'buffer/sample[{args.batch_size}]', lambda: buffer.sample(args.batch_size)),
+        (f'buffer/sample_contiguous[{args.batch_size}]', lambda: buffer.sample(args.batch_size, contiguous=True)),
+        (f'buffer/sample_memmap[{args.batch_size}]', lambda: mapped.sample(args.batch_size)),
+        (f'buffer/sample_memmap_contiguous[{args.batch_size}]', lambda: mapped.sample(args.batch_size, contiguous=True)),
+    ])
+
+
+def layer_cases(args) -> Dict[str, Callable]:
+    cases = OrderedDict()
+    x = torch.randn(args.batch_size, args.obs_dim)
+    widths = [args.obs_dim] + [args.net_width] * args.net_depth + [args.action_dim]
+    # MLP builds BiasLinear layers by default (--no_bias_linear is not supported by its layers) and WLinear with --wlinear
+    for name, kwargs in (('BiasLinear', {'bias_linear': True}), ('WLinear', {'w_linear': True})):
+        mlp = MLP(widths, **kwargs)
+
+        def forward_backward(mlp=mlp):
+            mlp(x).pow(2).mean().backward()
+            mlp.zero_grad()
+
+        cases[f'mlp/{name}[{args.batch_size}x{args.net_width}x{args.net_depth}]'] = forward_backward
+    return cases
+
+
+def model_cases(args) -> Dict[str, Callable]:
+    model = build_model(args.task_config, ['--initial_rollouts', '5', '--inner_buffer_size', '5000', '--batch_size', str(args.batch_size),
+                                           '--inner_value_lr', '1e-5', '--inner_policy_lr', '1e-5'])
+    task_idx = model.task_config.test_tasks[0]
+    inner_batch = torch.tensor(model._test_buffers[0].sample(model._args.inner_batch_size))
+    outer_batch = torch.tensor(model._test_buffers[0].sample(args.batch_size))
+    vf, policy = model._value_function, model._adaptation_policy
+
+    def value_loss():
+        model.value_function_loss_on_batch(vf, outer_batch, task_idx=task_idx)[0].backward()
+        vf.zero_grad()
+
+    def policy_loss():
+        model.adaptation_policy_loss_on_batch(policy, None, vf, outer_batch, task_idx)[0].backward()
+        policy.zero_grad()
+
+    def inner_step():
+        # As in train_step: one differentiable step on the inner batch, then the meta-gradient from the outer batch
+        opt = O.SGD([{'params': p, 'lr': None} for p in vf.adaptation_parameters()])
+        with higher.innerloop_ctx(vf, opt, override={'lr': [F.softplus(l) for l in model._value_lrs]},
+                                  copy_initial_weights=False) as (f_vf, diff_opt):
+            diff_opt.step(model.value_function_loss_on_batch(f_vf, inner_batch, inner=True, task_idx=task_idx, target=vf)[0])
+            model.value_function_loss_on_batch(f_vf, outer_batch, task_idx=task_idx, target=vf)[0].backward()
+        vf.zero_grad()
+        for lr in model._value_lrs:
+            lr.grad = None
+
+    def rollout():
+        model._env.set_task_idx(task_idx)
+        model._rollout_policy(policy, model._env)
+
+    return OrderedDict([
+        (f'maml/value_function_loss[{args.batch_size}]', value_loss),
+        (f'maml/adaptation_policy_loss[{args.batch_size}]', policy_loss),
+        (f'maml/higher_inner_step[{model._args.inner_batch_size}+{args.batch_size}]', inner_step),
+        (f'maml/rollout_policy[{model._env._max_episode_steps}]', rollout),
+    ])
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--task_config', type=str, default='config/synthetic/point_8tasks.json')
+    parser.add_argument('--filter', type=str, default=None) # Only run the cases whose name contains this
+    parser.add_argument('--obs_dim', type=int, default=20)
+    parser.add_argument('--action_dim', type=int, default=6)
+    parser.add_argument('--buffer_size', type=int, default=20000)
+    parser.add_argument('--episode_length', type=int, default=200)
+    parser.add_argument('--batch_size', type=int, default=256)
+    parser.add_argument('--net_width', type=int, default=300)
+    parser.add_argument('--net_depth', type=int, default=3)
+    parser.add_argument('--min_time', type=float, default=0.5) # Seconds spent timing each case
+    parser.add_argument('--threads', type=int, default=1)
+    parser.add_argument('--save', type=str, default=None) # Write the results as a baseline JSON
+    parser.add_argument('--compare', type=str, default=None) # Compare against a baseline JSON
+    parser.add_argument('--tolerance', type=float, default=1.2) # Flag cases slower than baseline by more than this factor
+    args = parser.parse_args()
+
+    torch.set_num_threads(args.threads)
+    np.random.seed(0)
+    torch.manual_seed(0)
+
+    cases = OrderedDict()
+    for make_cases in (buffer_cases, layer_cases, model_cases):
+        cases.update(make_cases(args))
+
+    baseline = {}
+    if args.compare is not None:
+        with open(args.compare, 'r') as f:
+            baseline = json.load(f)['results']
+
+    results = OrderedDict()
+    regressions = []
+    print(f'{"case":<48} {"median (us)":>12} {"min (us)":>10} {"baseline":>10} {"ratio":>7}')
+    for name, fn in cases.items():
+        if args.filter is not None and args.filter not in name:
+            continue
+        results[name] = measure(fn, args.min_time)
+        line = f'{name:<48} {results[name]["median_us"]:>12.1f} {results[name]["min_us"]:>10.1f}'
+        if name in baseline:
+            ratio = results[name]['median_us'] / baseline[name]['median_us']
+            line += f' {baseline[name]["median_us"]:>10.1f} {ratio:>6.2f}x'
+            if ratio > args.tolerance:
+                regressions.append(name)
+                line += '  SLOWER'
+        print(line)
+
+    if args.save is not None:
+        meta = {'torch': torch.__version__, 'numpy': np.__version__, 'python': platform.python_version(),
+                'machine': platform.machine(), 'processor': platform.processor(), 'threads': args.threads,
+                'time': time.strftime('%Y-%m-%d %H:%M:%S')}
+        with open(args.save, 'w') as f:
+            json.dump({'meta': meta, 'results': results}, f, indent=4)
+
+    if regressions:
+        print(f'{len(regressions)} case(s) slower than baseline by more than {args.tolerance}x: {", ".join(regressions)}')
+        raise SystemExit(1)
+
+
+if __name__ == '__main__':
+    main()
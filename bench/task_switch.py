@@ -0,0 +1,75 @@
+#
+# Measures the simulator time spent switching tasks. MAMLRAWR calls set_task_idx
+# before every task in train_step/eval and _rollout_policy resets right after, so
+# any reset done inside set_task_idx is wasted work.
+#
+#   python -m bench.task_switch --task_config config/cheetah_vel/40tasks_offline.json
+#
+import argparse
+import json
+import time
+from collections import namedtuple
+
+from run import load_tasks, make_env
+
+
+def time_calls(fn, n_tasks: int, switches: int) -> float:
+    '''Mean seconds per call of fn(task_idx), cycling through the tasks like train_step does.'''
+    fn(0)
+    start = time.perf_counter()
+    for k in range(switches):
+        fn(k % n_tasks)
+    return (time.perf_counter() - start) / switches
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--task_config', type=str, required=True)
+    parser.add_argument('--switches', type=int, default=500)
+    parser.add_argument('--n_tasks', type=int, default=None)
+    parser.add_argument('--include_goal', action='store_true')
+    args = parser.parse_args()
+    env_args = argparse.Namespace(n_tasks=args.n_tasks, include_goal=args.include_goal, multitask=False,
+                                  one_hot_goal=False, episode_length=None)
+
+    with open(args.task_config, 'r') as f:
+        task_config = json.load(f, object_hook=lambda d: namedtuple('X', d.keys())(*d.values()))
+    tasks = load_tasks(task_config)
+    env = make_env(task_config, env_args, tasks)
+    n_tasks = len(env.tasks)
+
+    def switch(idx):
+        env.set_task_idx(idx)
+
+    def switch_and_reset(idx):
+        # What every set_task_idx cost before resets were deferred to the rollout
+        env.set_task_idx(idx)
+        env.reset()
+
+    results = {'switch': time_calls(switch, n_tasks, args.switches),
+               'reset': time_calls(lambda idx: env.reset(), n_tasks, args.switches),
+               'switch_with_reset': time_calls(switch_and_reset, n_tasks, args.switches)}
+
+    if task_config.env == 'walker_params':
+        from src.envs import WalkerRandParamsWrappedEnv
+        uncached = WalkerRandParamsWrappedEnv(tasks, args.n_tasks, include_goal=args.include_goal)
+
+        def uncached_switch_and_reset(idx):
+            # Rewrites the physics parameters into the shared model, then resets twice as before
+            uncached.set_task_idx(idx)
+            uncached.reset()
+            uncached.reset()
+        results['uncached_switch_with_reset'] = time_calls(uncached_switch_and_reset, n_tasks, args.switches)
+        baseline = results['uncached_switch_with_reset']
+    else:
+        baseline = results['switch_with_reset']
+
+    for k, v in results.items():
+        print(f'{k:>28}: {v * 1e6:10.1f} us')
+    saved = baseline - results['switch']
+    print(f'Saved per task switch: {saved * 1e6:.1f} us ({baseline / max(results["switch"], 1e-12):.1f}x faster)')
+    print(f'Saved per train_step over {n_tasks} tasks: {saved * n_tasks * 1e3:.2f} ms')
+
+
+if __name__ == '__main__':
+    main()
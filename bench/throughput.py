@@ -0,0 +1,195 @@
+#
+# End-to-end training throughput of MAMLRAWR.train_step on offline synthetic data.
+# Writes HDF5 buffers in the format NewReplayBuffer loads (via NewReplayBuffer.save)
+# for each task of a synthetic env, then for every combination of task count, batch
+# size, net width and maml_steps runs a fixed number of iterations in a fresh forked
+# process and reports iterations/sec, the peak RSS and the time per phase. Results
+# can be saved as a baseline and later runs compared against it:
+#
+#   python -m bench.throughput --tasks 5 20 40 --net_widths 128 300 --save bench/throughput_baseline.json
+#   python -m bench.throughput --tasks 5 20 40 --net_widths 128 300 --compare bench/throughput_baseline.json
+#
+# With --ranks 1 2 4, every config is also trained data-parallel (src/distributed.py)
+# in that many local processes, and the speedup over one rank is reported. With
+# --shard_buffers, the multi-rank configs are run again with sharded buffer loading.
+#
+# Unknown arguments are passed on to the model (e.g. --gradient_steps_per_iteration 1).
+#
+import argparse
+import itertools
+import json
+import os
+import shutil
+import tempfile
+import time
+from collections import OrderedDict
+
+import numpy as np
+import torch
+import torch.multiprocessing as mp
+
+from bench.eval_time import build_model
+from bench.micro import random_trajectory
+from src import distributed
+from src.memory import MB, proc_status, reset_peak_rss
+from src.utils import NewReplayBuffer, NullWriter
+
+
+def write_task_config(directory: str, env: str, n_train: int, n_test: int, obs_dim: int, action_dim: int,
+                      steps: int, episode_length: int) -> str:
+    '''A task config for a synthetic env whose train and test tasks have offline buffers of `steps` random steps.'''
+    buffer_paths = os.path.join(directory, 'buffer_{}.h5')
+    for task_idx in range(n_train + n_test):
+        buffer = NewReplayBuffer(steps, obs_dim, action_dim)
+        while buffer._stored_steps < steps:
+            buffer.add_trajectory(random_trajectory(obs_dim, action_dim, episode_length))
+        buffer.save(buffer_paths.format(task_idx))
+
+    task_config = {
+        'env': f'synthetic_{env}',
+        'total_tasks': n_train + n_test,
+        'obs_dim': obs_dim,
+        'action_dim': action_dim,
+        'episode_length': episode_length,
+        'train_tasks': list(range(n_train)),
+        'test_tasks': list(range(n_train, n_train + n_test)),
+        'train_buffer_paths': buffer_paths,
+        'test_buffer_paths': buffer_paths,
+    }
+    path = os.path.join(directory, 'task_config.json')
+    with open(path, 'w') as f:
+        json.dump(task_config, f)
+    return path
+
+
+def run_config(task_config_path: str, argv: list, warmup: int, iterations: int, threads: int) -> dict:
+    torch.set_num_threads(threads)
+    model = build_model(task_config_path, argv)
+    writer = NullWriter()
+    # Iteration 0 evaluates (vis_interval); start after it
+    for t in range(1, warmup + 1):
+        model.train_step(t, writer)
+    model._timer.interval_summary()
+
+    reset_peak_rss()
+    start = time.perf_counter()
+    for t in range(warmup + 1, warmup + iterations + 1):
+        model._timer.switch('step')
+        model.train_step(t, writer)
+    model._timer.stop()
+    elapsed = time.perf_counter() - start
+
+    phases = model._timer.interval_summary()
+    return {
+        'iterations_per_second': iterations / elapsed,
+        'peak_rss_mb': proc_status().get('VmHWM', 0) / MB,
+        'phase_ms': OrderedDict((phase, 1000 * seconds / iterations)
+                                for phase, seconds in sorted(phases.items(), key=lambda item: -item[1])),
+    }
+
+
+def run_rank(results, task_config_path: str, argv: list, warmup: int, iterations: int, threads: int):
+    # Every rank trains; rank 0's timings are the run's
+    result = run_config(task_config_path, argv, warmup, iterations, threads)
+    if distributed.rank() == 0:
+        results.put(result)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--env', type=str, default='velocity')
+    parser.add_argument('--tasks', type=int, nargs='+', default=[5, 20]) # Train task counts to sweep
+    parser.add_argument('--test_tasks', type=int, default=2)
+    parser.add_argument('--batch_sizes', type=int, nargs='+', default=[256])
+    parser.add_argument('--net_widths', type=int, nargs='+', default=[300])
+    parser.add_argument('--maml_steps', type=int, nargs='+', default=[1])
+    parser.add_argument('--obs_dim', type=int, default=20)
+    parser.add_argument('--action_dim', type=int, default=6)
+    parser.add_argument('--buffer_steps', type=int, default=20000) # Offline steps per task
+    parser.add_argument('--episode_length', type=int, default=200)
+    parser.add_argument('--warmup', type=int, default=3)
+    parser.add_argument('--iterations', type=int, default=20)
+    parser.add_argument('--threads', type=int, default=1) # Per rank
+    parser.add_argument('--ranks', type=int, nargs='+', default=[1]) # Data-parallel rank counts to sweep
+    parser.add_argument('--shard_buffers', action='store_true') # Also run the multi-rank configs with --shard_buffers
+    parser.add_argument('--save', type=str, default=None) # Write the results as a baseline JSON
+    parser.add_argument('--compare', type=str, default=None) # Compare against a baseline JSON
+    parser.add_argument('--tolerance', type=float, default=1.2) # Flag configs slower than baseline by more than this factor
+    args, model_argv = parser.parse_known_args()
+
+    np.random.seed(0)
+    directory = tempfile.mkdtemp()
+    try:
+        print(f'Writing {max(args.tasks) + args.test_tasks} synthetic buffers of {args.buffer_steps} steps to {directory}')
+        task_config_path = write_task_config(directory, args.env, max(args.tasks), args.test_tasks, args.obs_dim,
+                                             args.action_dim, args.buffer_steps, args.episode_length)
+        with open(task_config_path, 'r') as f:
+            task_config = json.load(f)
+
+        baseline = {}
+        if args.compare is not None:
+            with open(args.compare, 'r') as f:
+                baseline = json.load(f)['results']
+
+        results = OrderedDict()
+        regressions = []
+        ctx = mp.get_context('fork')
+        print(f'{"config":<64} {"it/s":>8} {"peak RSS (MB)":>14} {"baseline":>9} {"ratio":>7}  top phases (ms/it)')
+        for n_tasks, batch_size, net_width, maml_steps, ranks, shard in itertools.product(args.tasks, args.batch_sizes, args.net_widths,
+                                                                                          args.maml_steps, args.ranks, [False, True]):
+            if shard and (ranks == 1 or not args.shard_buffers):
+                continue
+            single_rank_name = f'tasks={n_tasks},batch={batch_size},width={net_width},maml_steps={maml_steps}'
+            name = single_rank_name if ranks == 1 else f'{single_rank_name},ranks={ranks}' + (',shard_buffers' if shard else '')
+            # The first n_tasks train tasks of the config written above
+            config_path = os.path.join(directory, f'task_config_{n_tasks}.json')
+            with open(config_path, 'w') as f:
+                json.dump(dict(task_config, train_tasks=task_config['train_tasks'][:n_tasks]), f)
+            argv = ['--offline', '--load_inner_buffer', '--load_outer_buffer', '--initial_rollouts', '0',
+                    '--inner_buffer_size', str(args.buffer_steps), '--replay_buffer_size', str(args.buffer_steps),
+                    '--batch_size', str(batch_size), '--net_width', str(net_width), '--maml_steps', str(maml_steps),
+                    '--vis_interval', str(10 ** 9), '--inner_value_lr', '1e-5', '--inner_policy_lr', '1e-5'] + model_argv
+            if shard:
+                argv.append('--shard_buffers')
+
+            if ranks == 1:
+                # A fresh process per config, so the peak RSS is that config's alone
+                with ctx.Pool(1, maxtasksperchild=1) as pool:
+                    results[name] = pool.apply(run_config, (config_path, argv, args.warmup, args.iterations, args.threads))
+            else:
+                rank_results = ctx.Queue()
+                distributed.launch(run_rank, ranks, rank_results, config_path, argv, args.warmup, args.iterations, args.threads)
+                results[name] = rank_results.get()
+
+            result = results[name]
+            line = f'{name:<64} {result["iterations_per_second"]:>8.2f} {result["peak_rss_mb"]:>14.1f}'
+            if name in baseline:
+                ratio = baseline[name]['iterations_per_second'] / result['iterations_per_second']
+                line += f' {baseline[name]["iterations_per_second"]:>9.2f} {ratio:>6.2f}x'
+                if ratio > args.tolerance:
+                    regressions.append(name)
+            else:
+                line += f' {"":>9} {"":>7}'
+            top = list(result['phase_ms'].items())[:4]
+            line += '  ' + ', '.join(f'{phase} {ms:.1f}' for phase, ms in top)
+            if ranks > 1 and single_rank_name in results:
+                speedup = result['iterations_per_second'] / results[single_rank_name]['iterations_per_second']
+                line += f'  ({speedup:.2f}x 1 rank)'
+            print(line)
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+    if args.save is not None:
+        meta = {'torch': torch.__version__, 'threads': args.threads, 'ranks': args.ranks, 'shard_buffers': args.shard_buffers,
+                'iterations': args.iterations, 'buffer_steps': args.buffer_steps, 'obs_dim': args.obs_dim, 'action_dim': args.action_dim,
+                'model_argv': model_argv, 'time': time.strftime('%Y-%m-%d %H:%M:%S')}
+        with open(args.save, 'w') as f:
+            json.dump({'meta': meta, 'results': results}, f, indent=4)
+
+    if regressions:
+        print(f'{len(regressions)} config(s) slower than baseline by more than {args.tolerance}x: {", ".join(regressions)}')
+        raise SystemExit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,160 @@
+#
+# Evaluate a directory of MAMLRAWR checkpoints (archive_*.pt) over several seeds.
+# The env and the test buffers are built once; worker processes are forked from
+# that state, so they share the loaded buffers copy-on-write and each job only
+# loads an archive and runs the same eval as `run.py --eval --archive ...`.
+#
+#   python eval_farm.py --archives log/NeurIPS3/macaw_vel --seeds 0 1 2 --workers 8
+#
+# Arguments not listed below are passed to src/args.py; by default the args.txt
+# saved next to the archives is used, and anything given on the command line
+# overrides it.
+#
+import argparse
+import csv
+import glob
+import json
+import os
+import re
+import time
+from collections import namedtuple, defaultdict
+from typing import List, Optional
+
+import numpy as np
+import torch
+import torch.multiprocessing as mp
+
+from run import load_tasks, make_env
+from src.args import get_args, merge_saved_args
+from src.maml_rawr import MAMLRAWR
+from src.utils import NullWriter
+
+
+# Set in the parent before the pool is forked, so that workers inherit it
+_MODEL = None
+
+
+class RecordingWriter(NullWriter):
+    '''Keeps the scalars an eval logs, e.g. Eval_Reward/Mean for every adaptation step.'''
+    def __init__(self):
+        self.scalars = defaultdict(dict)
+
+    def add_scalar(self, tag: str, value, step: int):
+        self.scalars[tag][step] = float(value)
+
+
+def find_archives(archive_dir: str, include_latest: bool = False) -> List[str]:
+    archives = []
+    for path in glob.glob(os.path.join(archive_dir, 'archive_*.pt')):
+        if archive_step(path) is not None or include_latest:
+            archives.append(path)
+    return sorted(archives, key=lambda path: (archive_step(path) is None, archive_step(path) or 0))
+
+
+def archive_step(path: str) -> Optional[int]:
+    match = re.match(r'archive_(\d+)\.pt$', os.path.basename(path))
+    return int(match.group(1)) if match else None
+
+
+def build_args(archive_dir: str, argv: List[str]) -> argparse.Namespace:
+    args = get_args(argv)
+    args_path = os.path.join(archive_dir, 'args.txt')
+    if os.path.exists(args_path):
+        args = merge_saved_args(args, args_path, argv)
+
+    args.eval = True
+    args.archive = None
+    args.render = False
+    args.async_eval = False
+    args.actors = 0
+    args.resume = None
+    if args.advantage_head_coef == 0:
+        args.advantage_head_coef = None
+    return args
+
+
+def _init_worker(threads: int):
+    torch.set_num_threads(threads)
+
+
+def _evaluate(job):
+    archive_path, seed = job
+    start = time.time()
+    _MODEL.load_archive(archive_path)
+    _MODEL.reseed(seed)
+    writer = RecordingWriter()
+    hits = _MODEL._eval_cache.hits if _MODEL._eval_cache is not None else 0
+    _, rewards, successes = _MODEL.eval(0, writer)
+
+    row = {'archive': os.path.basename(archive_path), 'step': archive_step(archive_path), 'seed': seed,
+           'mean_reward': float(np.mean(rewards)),
+           'success_rate': float(np.mean(successes)) if len(successes) else float('nan')}
+    for adaptation_step, r in sorted(writer.scalars['Eval_Reward/Mean'].items()):
+        row[f'mean_reward_step{adaptation_step}'] = r
+    for task_idx, r in zip(_MODEL.task_config.test_tasks, rewards):
+        row[f'task_{task_idx}'] = float(r)
+    row['cache_hit'] = _MODEL._eval_cache is not None and _MODEL._eval_cache.hits > hits
+    row['eval_seconds'] = time.time() - start
+    return row
+
+
+def main():
+    global _MODEL
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--archives', type=str, required=True) # Directory containing archive_*.pt (usually a run's log dir)
+    parser.add_argument('--seeds', type=int, nargs='+', default=[0])
+    parser.add_argument('--workers', type=int, default=1)
+    parser.add_argument('--threads_per_worker', type=int, default=1)
+    parser.add_argument('--include_latest', action='store_true')
+    parser.add_argument('--output', type=str, default=None) # Defaults to <archives>/eval_farm.csv
+    farm_args, argv = parser.parse_known_args()
+
+    archives = find_archives(farm_args.archives, farm_args.include_latest)
+    if not len(archives):
+        raise RuntimeError(f'No archive_*.pt files found in {farm_args.archives}')
+
+    args = build_args(farm_args.archives, argv)
+    if farm_args.workers > 1 and args.device != 'cpu':
+        raise ValueError('Worker processes are forked from the parent and require --device cpu')
+    with open(args.task_config, 'r') as f:
+        task_config = json.load(f, object_hook=lambda d: namedtuple('X', d.keys())(*d.values()))
+
+    print(f'Loading env and test buffers for {args.task_config}')
+    env = make_env(task_config, args, load_tasks(task_config, args.task_idx))
+    _MODEL = MAMLRAWR(args, task_config, env, args.log_dir, 'eval_farm', silent=True,
+                      replay_buffer_length=args.replay_buffer_size, discount_factor=args.discount_factor)
+
+    jobs = [(archive, seed) for archive in archives for seed in farm_args.seeds]
+    print(f'Evaluating {len(archives)} archives x {len(farm_args.seeds)} seeds with {farm_args.workers} workers')
+    rows = []
+    if farm_args.workers > 1:
+        with mp.get_context('fork').Pool(farm_args.workers, initializer=_init_worker, initargs=(farm_args.threads_per_worker,)) as pool:
+            for row in pool.imap_unordered(_evaluate, jobs):
+                print(f'{row["archive"]} seed {row["seed"]}: {row["mean_reward"]:.2f} ({row["eval_seconds"]:.1f}s)')
+                rows.append(row)
+    else:
+        for job in jobs:
+            row = _evaluate(job)
+            print(f'{row["archive"]} seed {row["seed"]}: {row["mean_reward"]:.2f} ({row["eval_seconds"]:.1f}s)')
+            rows.append(row)
+
+    rows = sorted(rows, key=lambda row: (row['step'] is None, row['step'] or 0, row['seed']))
+    output = farm_args.output if farm_args.output is not None else os.path.join(farm_args.archives, 'eval_farm.csv')
+    fields = list(dict.fromkeys(k for row in rows for k in row.keys()))
+    with open(output, 'w', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=fields)
+        writer.writeheader()
+        writer.writerows(rows)
+
+    print(f'\n{"archive":>24} {"mean reward":>12} {"std":>8} {"success":>8}')
+    for archive in archives:
+        archive_rows = [row for row in rows if row['archive'] == os.path.basename(archive)]
+        rewards = [row['mean_reward'] for row in archive_rows]
+        success = np.mean([row['success_rate'] for row in archive_rows])
+        print(f'{os.path.basename(archive):>24} {np.mean(rewards):>12.2f} {np.std(rewards):>8.2f} {success:>8.2f}')
+    print(f'Results written to {output}')
+
+
+if __name__ == '__main__':
+    main()
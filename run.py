@@ -6,14 +6,16 @@ import numpy as np
 from multiprocessing import Process
 import random
 import torch
-import metaworld
 from collections import namedtuple
 import json
+import os
 
-from src.envs import HalfCheetahDirEnv, HalfCheetahVelEnv, AntDirEnv, AntGoalEnv, HumanoidDirEnv, WalkerRandParamsWrappedEnv, ML45Env
+from src.synthetic_envs import make_synthetic_env
 from src.maml_rawr import MAMLRAWR
-from src.mql.td3 import TD3Context
-from src.args import get_args
+from src.args import get_args, merge_saved_args
+from src.memory import predict_rows, format_rows
+from src.buffer_store import BufferStore
+import src.distributed as distributed
 
 
 def get_metaworld_tasks(env_id: str = 'ml10'):
@@ -105,20 +107,65 @@ def get_gym_env(env: str):
     return env
 
 
-def run(args: argparse.Namespace, instance_idx: int = 0):
-    with open(args.task_config, 'r') as f:
-        task_config = json.load(f, object_hook=lambda d: namedtuple('X', d.keys())(*d.values()))
+def load_tasks(task_config, task_idx: Optional[int] = None) -> Optional[List[dict]]:
+    # Synthetic envs generate their own tasks (see src/synthetic_envs.py) and ML45 has a fixed task set
+    if task_config.env == 'ml45' or task_config.env.startswith('synthetic_'):
+        return None
+
+    tasks = []
+    for task_idx in (range(task_config.total_tasks) if task_idx is None else [task_idx]):
+        with open(task_config.task_paths.format(task_idx), 'rb') as f:
+            task_info = pickle.load(f)
+            assert len(task_info) == 1, f'Unexpected task info: {task_info}'
+            tasks.append(task_info[0])
+    return tasks
+
+
+def make_env(task_config, args: argparse.Namespace, tasks: Optional[List[dict]] = None):
+    if task_config.env.startswith('synthetic_'):
+        env = make_synthetic_env(task_config.env[len('synthetic_'):], n_tasks=task_config.total_tasks,
+                                 obs_dim=getattr(task_config, 'obs_dim', 2), action_dim=getattr(task_config, 'action_dim', 2),
+                                 episode_length=getattr(task_config, 'episode_length', 100),
+                                 seed=getattr(task_config, 'task_seed', 1337),
+                                 include_goal=args.include_goal or args.multitask)
+    else:
+        # MuJoCo/metaworld are only imported for the envs that need them
+        from src.envs import HalfCheetahDirEnv, HalfCheetahVelEnv, AntDirEnv, WalkerRandParamsCachedEnv, ML45Env
+
+        if task_config.env == 'ant_dir':
+            env = AntDirEnv(tasks, args.n_tasks, include_goal = args.include_goal or args.multitask)
+        elif task_config.env == 'cheetah_dir':
+            env = HalfCheetahDirEnv(tasks, include_goal = args.include_goal or args.multitask)
+        elif task_config.env == 'cheetah_vel':
+            env = HalfCheetahVelEnv(tasks, include_goal = args.include_goal or args.multitask, one_hot_goal=args.one_hot_goal or args.multitask)
+        elif task_config.env == 'walker_params':
+            env = WalkerRandParamsCachedEnv(tasks, args.n_tasks, include_goal = args.include_goal or args.multitask)
+        elif task_config.env == 'ml45':
+            env = ML45Env(include_goal=args.multitask or args.include_goal)
+        else:
+            raise RuntimeError(f'Invalid env name {task_config.env}')
+
+    if args.episode_length is not None:
+        env._max_episode_steps = args.episode_length
+
+    return env
+
+
+def load_task_config(path: str):
+    with open(path, 'r') as f:
+        return json.load(f, object_hook=lambda d: namedtuple('X', d.keys())(*d.values()))
+
+
+def run(args: argparse.Namespace, instance_idx: int = 0, buffer_store: Optional[str] = None):
+    task_config = load_task_config(args.task_config)
+    if buffer_store is not None:
+        # Load the offline buffers from the store the parent filled (see src/buffer_store.py)
+        task_config = BufferStore.attach(buffer_store).task_config(task_config)
 
     if args.advantage_head_coef == 0:
         args.advantage_head_coef = None
         
-    if task_config.env != 'ml45':
-        tasks = []
-        for task_idx in (range(task_config.total_tasks if args.task_idx is None else [args.task_idx])):
-            with open(task_config.task_paths.format(task_idx), 'rb') as f:
-                task_info = pickle.load(f)
-                assert len(task_info) == 1, f'Unexpected task info: {task_info}'
-                tasks.append(task_info[0])
+    tasks = load_tasks(task_config, args.task_idx)
 
     #if args.task_idx is not None:
     #    tasks = [tasks[args.task_idx]]
@@ -129,21 +176,10 @@ def run(args: argparse.Namespace, instance_idx: int = 0):
     torch.manual_seed(seed)
     torch.cuda.manual_seed(seed)
 
-    if task_config.env == 'ant_dir':
-        env = AntDirEnv(tasks, args.n_tasks, include_goal = args.include_goal or args.multitask)
-    elif task_config.env == 'cheetah_dir':
-        env = HalfCheetahDirEnv(tasks, include_goal = args.include_goal or args.multitask)
-    elif task_config.env == 'cheetah_vel':
-        env = HalfCheetahVelEnv(tasks, include_goal = args.include_goal or args.multitask, one_hot_goal=args.one_hot_goal or args.multitask)
-    elif task_config.env == 'walker_params':
-        env = WalkerRandParamsWrappedEnv(tasks, args.n_tasks, include_goal = args.include_goal or args.multitask)
-    elif task_config.env == 'ml45':
-        env = ML45Env(include_goal=args.multitask or args.include_goal)
-    else:
-        raise RuntimeError(f'Invalid env name {task_config.env}')
-
-    if args.episode_length is not None:
-        env._max_episode_steps = args.episode_length
+    env = make_env(task_config, args, tasks)
+    if args.memory_dry_run:
+        print(format_rows(predict_rows(args, task_config, env), title='Predicted memory'))
+        return
 
     if args.name is None:
         args.name = 'throwaway_test_run'
@@ -160,10 +196,20 @@ def run(args: argparse.Namespace, instance_idx: int = 0):
 
     if not args.mql and not args.td3ctx:
         model = MAMLRAWR(args, task_config, env, args.log_dir, name, training_iterations=args.train_steps,
-                         visualization_interval=args.vis_interval, silent=instance_idx > 0,
+                         visualization_interval=args.vis_interval, silent=instance_idx > 0 or distributed.rank() > 0,
                          gradient_steps_per_iteration=args.gradient_steps_per_iteration,
                          replay_buffer_length=args.replay_buffer_size, discount_factor=args.discount_factor)
+        if args.eval and args.eval_cache is not None:
+            # Makes an offline eval a function of the archive and seed, which --eval_cache relies on
+            model.reseed(seed)
+        if distributed.world_size() > 1:
+            # The ranks start from the same model, but sample their own batches
+            rank_seed = seed * distributed.world_size() + distributed.rank()
+            random.seed(rank_seed)
+            np.random.seed(rank_seed)
+            torch.manual_seed(rank_seed)
     elif args.td3ctx:
+        from src.mql.td3 import TD3Context
         model = TD3Context(args, task_config, env, args.log_dir, name, 30, training_iterations=args.train_steps, silent=instance_idx > 0)
 
     model.train()
@@ -171,14 +217,48 @@ def run(args: argparse.Namespace, instance_idx: int = 0):
 
 if __name__ == '__main__':
     args = get_args()
+    if args.resume is not None:
+        # Continue with the args the run was started with; flags given now take precedence
+        args = merge_saved_args(args, f'{args.resume}/args.txt')
     
-    if args.instances == 1:
+    if args.instances > 1 and args.ranks > 1:
+        raise ValueError('--instances and --ranks cannot be combined')
+    if args.ranks > 1 and args.resume is not None:
+        # Checkpoints hold rank 0's rng and estimator state only, so resumed ranks would all draw the same samples
+        raise ValueError('--resume cannot be combined with --ranks')
+    if args.ranks > 1 and (args.train_exploration or args.sample_exploration_inner):
+        # Only the meta-parameters' gradients are summed across ranks; the exploration policy would drift apart
+        raise ValueError('--train_exploration and --sample_exploration_inner cannot be combined with --ranks')
+    if args.ranks > 1 and args.async_eval:
+        # The eval workers would be forked from rank 0 with its gloo process group live
+        raise ValueError('--async_eval cannot be combined with --ranks')
+
+    if (args.instances == 1 and args.ranks == 1) or args.memory_dry_run:
         if args.profile:
             import cProfile
             cProfile.runctx('run(args)', sort='cumtime', locals=locals(), globals=globals())
         else:
             run(args)
     else:
-        for instance_idx in range(args.instances):
-            subprocess = Process(target=run, args=(args, instance_idx))
-            subprocess.start()
+        store = None
+        # Sharded ranks each load only their own buffers, which a store of all of them would defeat
+        if args.shared_buffers and not args.memory_dry_run and not (args.ranks > 1 and args.shard_buffers):
+            # Decode the offline buffers once and share them, instead of once per instance
+            task_config = load_task_config(args.task_config)
+            store = BufferStore.create(f'maml_awr_buffers_{os.getpid()}', args, task_config, workers=os.cpu_count())
+            print(store.report(args, task_config, max(args.instances, args.ranks)))
+        try:
+            if args.ranks > 1:
+                # One run, trained data-parallel over the train tasks; see src/distributed.py
+                distributed.launch(run, args.ranks, args, 0, store.name if store is not None else None)
+            else:
+                subprocesses = []
+                for instance_idx in range(args.instances):
+                    subprocess = Process(target=run, args=(args, instance_idx, store.name if store is not None else None))
+                    subprocess.start()
+                    subprocesses.append(subprocess)
+                for subprocess in subprocesses:
+                    subprocess.join()
+        finally:
+            if store is not None:
+                store.close()
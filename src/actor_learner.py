@@ -0,0 +1,164 @@
+#
+# Actor/learner split for online MACAW training. Actor processes adapt the
+# current meta-parameters to a task, roll out the adapted policy and stream the
+# trajectory back, so the learner never blocks on simulation.
+#
+import queue
+import time
+from typing import List, Optional
+
+import numpy as np
+import torch
+import torch.multiprocessing as mp
+
+from src.utils import Experience
+
+
+class ParameterSnapshot(object):
+    '''
+    A versioned copy of a list of tensors in shared memory. The learner publishes
+    into it, actors pull from it when the version has changed since their last pull.
+    '''
+    def __init__(self, tensors: List[torch.Tensor], ctx):
+        self._shared = [t.detach().to('cpu').clone().share_memory_() for t in tensors]
+        self._version = ctx.Value('i', 0)
+        self._lock = ctx.Lock()
+
+    @property
+    def version(self) -> int:
+        return self._version.value
+
+    def publish(self, tensors: List[torch.Tensor]) -> int:
+        with self._lock:
+            with torch.no_grad():
+                for shared, t in zip(self._shared, tensors):
+                    shared.copy_(t.detach())
+            self._version.value += 1
+            return self._version.value
+
+    def pull(self, tensors: List[torch.Tensor], version: int) -> int:
+        '''Copy the snapshot into `tensors` if it is newer than `version`; returns the version now held.'''
+        if self._version.value == version:
+            return version
+        with self._lock:
+            with torch.no_grad():
+                for shared, t in zip(self._shared, tensors):
+                    t.copy_(shared)
+            return self._version.value
+
+
+def pack_trajectory(trajectory: List[Experience]):
+    '''Stack a trajectory into tensors so it crosses the process boundary through shared memory.'''
+    return (torch.from_numpy(np.stack([np.asarray(e.state, dtype=np.float32) for e in trajectory])),
+            torch.from_numpy(np.stack([np.asarray(e.action, dtype=np.float32) for e in trajectory])),
+            torch.from_numpy(np.stack([np.asarray(e.next_state, dtype=np.float32) for e in trajectory])),
+            torch.tensor([float(e.reward) for e in trajectory]),
+            torch.tensor([bool(e.done) for e in trajectory]))
+
+
+def unpack_trajectory(packed) -> List[Experience]:
+    states, actions, next_states, rewards, dones = [t.numpy() for t in packed]
+    return [Experience(s, a, s_, r.item(), d.item()) for s, a, s_, r, d in zip(states, actions, next_states, rewards, dones)]
+
+
+def snapshot_tensors(model) -> List[torch.Tensor]:
+    '''Everything an actor needs to reproduce the learner's adaptation: meta-parameters and learned lrs.'''
+    tensors = list(model._value_function.parameters()) + list(model._adaptation_policy.parameters())
+    tensors += list(model._value_lrs) + list(model._policy_lrs)
+    if model._adv_coef is not None:
+        tensors.append(model._adv_coef)
+    return tensors
+
+
+def _actor_loop(model, actor_idx: int, n_actors: int, snapshot: ParameterSnapshot, task_queue, trajectory_queue):
+    # Each process gets a single intra-op thread so that actors do not fight the learner for cores
+    torch.set_num_threads(1)
+    torch.manual_seed(model._env_seeds[actor_idx].item() % 2 ** 32)
+    # Give every actor a disjoint slice of the environment seed table
+    model._rollout_counter = (actor_idx + 1) * (len(model._env_seeds) // (n_actors + 1))
+
+    local_tensors = snapshot_tensors(model)
+    version = -1
+    while True:
+        item = task_queue.get()
+        if item is None:
+            break
+
+        task_idx, value_batch = item
+        version = snapshot.pull(local_tensors, version)
+        model._env.set_task_idx(task_idx)
+        policy = model.adapt_policy(task_idx, value_batch.to(model._device))
+        trajectory, reward, success = model._rollout_policy(policy, model._env, sample_mode=model._args.offline)
+        trajectory_queue.put((task_idx, version, pack_trajectory(trajectory), reward, success))
+
+
+class ActorPool(object):
+    '''
+    Learner-side handle on a set of actor processes. The actors are forked from the
+    learner, so they start with a copy-on-write view of the model, env and buffers and
+    only need parameter snapshots afterwards. Create it before the learner starts any
+    threads or opens connections (see MAMLRAWR.train). Nothing here blocks the learner: task
+    requests are dropped when all actors are busy and results are drained without
+    waiting.
+    '''
+    def __init__(self, model, n_actors: int, queue_size: Optional[int] = None):
+        if model._device.type != 'cpu':
+            raise ValueError('Actor processes are forked from the learner and require --device cpu')
+
+        ctx = mp.get_context('fork')
+        self._snapshot = ParameterSnapshot(snapshot_tensors(model), ctx)
+        self._task_queue = ctx.Queue(maxsize=queue_size if queue_size is not None else 2 * n_actors)
+        self._trajectory_queue = ctx.Queue()
+        self._model = model
+        self.publish()
+
+        self._actors = [ctx.Process(target=_actor_loop, args=(model, idx, n_actors, self._snapshot, self._task_queue, self._trajectory_queue),
+                                    daemon=True)
+                        for idx in range(n_actors)]
+        for actor in self._actors:
+            actor.start()
+
+        self.dropped = 0
+        self._last_step_time = time.time()
+        self._last_step = 0
+
+    @property
+    def version(self) -> int:
+        return self._snapshot.version
+
+    def publish(self) -> int:
+        return self._snapshot.publish(snapshot_tensors(self._model))
+
+    def submit(self, task_idx: int, value_batch: torch.Tensor) -> bool:
+        try:
+            self._task_queue.put_nowait((task_idx, value_batch.detach().to('cpu')))
+            return True
+        except queue.Full:
+            self.dropped += 1
+            return False
+
+    def drain(self):
+        '''Yield (task_idx, staleness, trajectory, reward, success) for every finished rollout.'''
+        while True:
+            try:
+                task_idx, version, packed, reward, success = self._trajectory_queue.get_nowait()
+            except queue.Empty:
+                return
+            yield task_idx, self.version - version, unpack_trajectory(packed), reward, success
+
+    def learner_steps_per_sec(self, step: int) -> float:
+        now = time.time()
+        rate = (step - self._last_step) / max(now - self._last_step_time, 1e-9)
+        self._last_step, self._last_step_time = step, now
+        return rate
+
+    def close(self):
+        for _ in self._actors:
+            try:
+                self._task_queue.put(None, timeout=10)
+            except queue.Full:
+                break
+        for actor in self._actors:
+            actor.join(timeout=10)
+            if actor.is_alive():
+                actor.terminate()
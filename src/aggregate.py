@@ -0,0 +1,175 @@
+#
+# Loading per-task curves of many runs for plotting. Each run is parsed once into a
+# tasks x steps array (aligned on the steps every task has) and cached; the cache
+# entry is reused as long as the run's sources (its metrics.db, or its event files)
+# have the same mtime and size. Runs that are not cached are parsed in parallel
+# processes. Runs that only differ by their seed suffix (name_0, name_1, ...) are
+# grouped, and curves are reduced across seeds (mean, median, quantiles).
+#
+#   python -m src.aggregate --family 'Eval_Reward/Task_{}' --workers 16 log/gm/*
+#
+import argparse
+import glob
+import hashlib
+import json
+import os
+import re
+import sqlite3
+import time
+from collections import OrderedDict, defaultdict
+from typing import Dict, List, NamedTuple, Optional
+
+import numpy as np
+import torch.multiprocessing as mp
+
+from src.metrics_store import MetricsStore, event_scalars, read_events, tag_family
+
+
+class RunCurves(NamedTuple):
+    run: str
+    tasks: np.ndarray   # Task index of each row; -1 for a tag without a task (e.g. 'Eval_Reward/Mean')
+    steps: np.ndarray
+    values: np.ndarray  # (tasks, steps)
+
+
+def _has_scalars(db: str) -> bool:
+    connection = sqlite3.connect(f'file:{os.path.abspath(db)}?mode=ro', uri=True, timeout=60)
+    try:
+        return connection.execute('SELECT 1 FROM scalars LIMIT 1').fetchone() is not None
+    except sqlite3.Error:
+        return False
+    finally:
+        connection.close()
+
+
+def run_sources(run_dir: str) -> List[str]:
+    '''
+    The files a run's scalars are read from: its metrics.db if it has any rows (a run
+    killed before its first commit, or one that predates it, has none), otherwise its
+    event files.
+    '''
+    db = os.path.join(run_dir, 'metrics.db')
+    if os.path.exists(db) and _has_scalars(db):
+        return [path for path in (db, f'{db}-wal') if os.path.exists(path)]
+    return sorted(glob.glob(os.path.join(run_dir, 'tb', 'events.out.tfevents.*')))
+
+
+def _sources_key(sources: List[str]) -> str:
+    key = []
+    for path in sources:
+        stat = os.stat(path)
+        key.append([os.path.abspath(path), stat.st_mtime_ns, stat.st_size])
+    return json.dumps(key)
+
+
+def _read_tasks(sources: List[str], family: str) -> Dict[int, Dict[int, float]]:
+    '''{task: {step: value}} for the tags of a family.'''
+    tasks = defaultdict(dict)
+    if len(sources) and sources[0].endswith('metrics.db'):
+        store = MetricsStore(sources[0], readonly=True)
+        for run in store.runs():
+            for task, (steps, values) in store.task_scalars(run, family).items():
+                tasks[task].update(zip(steps.tolist(), values.tolist()))
+        store.close()
+    else:
+        # Each tag's task, or None for tags of other families; parsed once per tag rather than per record
+        task_of = {}
+        for path in sources:
+            for event, _ in read_events(path):
+                for tag, value in event_scalars(event):
+                    if tag not in task_of:
+                        tag_fam, task = tag_family(tag)
+                        task_of[tag] = (-1 if task is None else task) if tag_fam == family else None
+                    task = task_of[tag]
+                    if task is not None:
+                        tasks[task][event.step] = value
+    return tasks
+
+
+def align(run: str, tasks: Dict[int, Dict[int, float]]) -> RunCurves:
+    '''A tasks x steps array over the steps logged for every task.'''
+    task_idxs = sorted(tasks.keys())
+    steps = sorted(set.intersection(*(set(tasks[task].keys()) for task in task_idxs))) if len(task_idxs) else []
+    values = np.array([[tasks[task][step] for step in steps] for task in task_idxs], dtype=np.float64).reshape(len(task_idxs), len(steps))
+    return RunCurves(run, np.array(task_idxs, dtype=np.int64), np.array(steps, dtype=np.int64), values)
+
+
+def load_run(run_dir: str, family: str, cache_dir: Optional[str] = None) -> RunCurves:
+    run = os.path.basename(os.path.normpath(run_dir))
+    sources = run_sources(run_dir)
+    key = _sources_key(sources)
+    cache_path = None
+    if cache_dir is not None:
+        name = hashlib.sha1(f'{os.path.abspath(run_dir)}\0{family}'.encode()).hexdigest()
+        cache_path = os.path.join(cache_dir, f'{name}.npz')
+        if os.path.exists(cache_path):
+            with np.load(cache_path) as cached:
+                if str(cached['key']) == key:
+                    return RunCurves(run, cached['tasks'], cached['steps'], cached['values'])
+
+    curves = align(run, _read_tasks(sources, family))
+    if cache_path is not None:
+        os.makedirs(cache_dir, exist_ok=True)
+        tmp_path = f'{cache_path}.tmp{os.getpid()}.npz'
+        np.savez(tmp_path, key=np.array(key), tasks=curves.tasks, steps=curves.steps, values=curves.values)
+        os.replace(tmp_path, cache_path)
+    return curves
+
+
+def load_runs(run_dirs: List[str], family: str, cache_dir: Optional[str] = None, workers: int = 1) -> List[RunCurves]:
+    '''load_run for every run, in `workers` processes; runs without any tag of the family are dropped.'''
+    jobs = [(run_dir, family, cache_dir) for run_dir in run_dirs]
+    if workers > 1 and len(jobs) > 1:
+        with mp.get_context('fork').Pool(min(workers, len(jobs))) as pool:
+            curves = pool.starmap(load_run, jobs, chunksize=max(1, len(jobs) // (4 * workers)))
+    else:
+        curves = [load_run(*job) for job in jobs]
+    return [c for c in curves if c.values.size > 0]
+
+
+def group_seeds(curves: List[RunCurves]) -> Dict[str, List[RunCurves]]:
+    '''Runs grouped by name without the instance suffix run.py adds (name, name_1, name_2, ...).'''
+    groups = OrderedDict()
+    for c in sorted(curves, key=lambda c: c.run):
+        groups.setdefault(re.sub(r'_[0-9]+$', '', c.run), []).append(c)
+    return groups
+
+
+def reduce_seeds(curves: List[RunCurves], quantiles: List[float] = (0.25, 0.75)) -> Dict[str, np.ndarray]:
+    '''
+    Statistics across seeds of the mean over tasks, on the steps all seeds share:
+    {'steps', 'mean', 'median', 'std', 'min', 'max', 'q25', 'q75', ..., 'seeds'},
+    where 'seeds' is the (seeds, steps) array they are computed from.
+    '''
+    steps = np.array(sorted(set.intersection(*(set(c.steps.tolist()) for c in curves))), dtype=np.int64)
+    seeds = np.stack([c.values.mean(0)[np.searchsorted(c.steps, steps)] for c in curves])
+    stats = OrderedDict([('steps', steps), ('mean', seeds.mean(0)), ('median', np.median(seeds, 0)), ('std', seeds.std(0)),
+                         ('min', seeds.min(0)), ('max', seeds.max(0))])
+    for q in quantiles:
+        stats[f'q{int(round(100 * q))}'] = np.quantile(seeds, q, axis=0)
+    stats['seeds'] = seeds
+    return stats
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--family', type=str, default='Eval_Reward/Task_{}') # Tag family to load, see src/metrics_store.tag_family
+    parser.add_argument('--workers', type=int, default=os.cpu_count())
+    parser.add_argument('--cache_dir', type=str, default=os.path.expanduser('~/.cache/maml_rawr/aggregate'))
+    parser.add_argument('runs', type=str, nargs='+') # Run directories
+    args = parser.parse_args()
+
+    start = time.time()
+    curves = load_runs([path for path in args.runs if os.path.isdir(path)], args.family, args.cache_dir, args.workers)
+    print(f'Loaded {len(curves)} runs in {time.time() - start:.2f}s')
+    print(f'{"run":<40} {"seeds":>5} {"step":>8} {"mean":>10} {"median":>10} {"q25":>10} {"q75":>10}')
+    for name, group in group_seeds(curves).items():
+        stats = reduce_seeds(group)
+        if len(stats['steps']) == 0:
+            continue
+        print(f'{name:<40} {len(group):>5} {stats["steps"][-1]:>8} {stats["mean"][-1]:>10.2f} {stats["median"][-1]:>10.2f} '
+              f'{stats["q25"][-1]:>10.2f} {stats["q75"][-1]:>10.2f}')
+
+
+if __name__ == '__main__':
+    main()
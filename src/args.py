@@ -1,8 +1,10 @@
 import argparse
 import json
+import sys
+from typing import List, Optional
 
 
-def get_args() -> argparse.Namespace:
+def get_args(argv: Optional[List[str]] = None) -> argparse.Namespace:
     parser = argparse.ArgumentParser()
     parser.add_argument('--td3ctx', action='store_true')
     parser.add_argument('--mql', action='store_true')
@@ -11,6 +13,7 @@ def get_args() -> argparse.Namespace:
     parser.add_argument('--contiguous', action='store_true')
     parser.add_argument('--from_disk', action='store_true')
     parser.add_argument('--archive', type=str, default=None)
+    parser.add_argument('--resume', type=str, default=None) # Run directory to continue training from, with the args it was started with
     parser.add_argument('--wlinear', action='store_true')
     parser.add_argument('--macaw_params', type=str, default=None)
     parser.add_argument('--macaw_override_params', type=str, default=None)
@@ -64,12 +67,21 @@ def get_args() -> argparse.Namespace:
     parser.add_argument('--exploration_lr', type=float, default=1e-4)
     parser.add_argument('--device', type=str, default='cpu')
     parser.add_argument('--vis_interval', type=int, default=250)
+    parser.add_argument('--log_interval', type=int, default=1) # Average training scalars over this many steps before writing them; see src/metrics.py
+    parser.add_argument('--histogram_interval', type=int, default=1) # Only write histograms every N steps
+    parser.add_argument('--no_metrics_store', action='store_true') # Don't also write scalars to <log dir>/metrics.db; see src/metrics_store.py
+    parser.add_argument('--sync_timers', action='store_true') # Synchronize cuda at every phase boundary so GPU time is charged to the right phase; see src/profiling.py
+    parser.add_argument('--memory_interval', type=int, default=1000) # Log the memory breakdown and per-phase peaks every N steps; 0 disables. See src/memory.py
+    parser.add_argument('--memory_dry_run', action='store_true') # Print the predicted memory breakdown for the task config and exit
     parser.add_argument('--log_dir', type=str, default='log')
     parser.add_argument('--include_goal', action='store_true')
     parser.add_argument('--single_task', action='store_true')  
     parser.add_argument('--one_hot_goal', action='store_true')
     parser.add_argument('--task_idx', type=int, default=None)
     parser.add_argument('--instances', type=int, default=1)
+    parser.add_argument('--ranks', type=int, default=1) # Train data-parallel over the train tasks in this many local processes; see src/distributed.py
+    parser.add_argument('--shard_buffers', action='store_true') # With --ranks, each rank only loads the train buffers of the tasks it owns
+    parser.add_argument('--shared_buffers', action='store_true') # With --instances or --ranks > 1, load the offline buffers once into a shared store instead of in every instance; see src/buffer_store.py
     parser.add_argument('--name', type=str, default=None)
     parser.add_argument('--render', action='store_true')
     parser.add_argument('--gradient_steps_per_iteration', type=int, default=50)
@@ -78,6 +90,10 @@ def get_args() -> argparse.Namespace:
     parser.add_argument('--full_buffer_size', type=int, default=20000)
     parser.add_argument('--discount_factor', type=float, default=0.99)
     parser.add_argument('--profile', action='store_true')
+    parser.add_argument('--torch_profile', action='store_true') # Capture torch.profiler traces of training iterations into <log dir>/profiler
+    parser.add_argument('--torch_profile_start', type=int, default=100)
+    parser.add_argument('--torch_profile_steps', type=int, default=10)
+    parser.add_argument('--torch_profile_every', type=int, default=0) # Repeat the capture every N iterations; 0 captures once
     parser.add_argument('--initial_rollouts', type=int, default=30)
     parser.add_argument('--offline', action='store_true')
     parser.add_argument('--offline_outer', action='store_true')
@@ -85,6 +101,10 @@ def get_args() -> argparse.Namespace:
     parser.add_argument('--grad_clip', type=float, default=1e9) # Essentially no clip, but use this to measure the size of gradients
     parser.add_argument('--exp_advantage_clip', type=float, default=20.0)
     parser.add_argument('--eval_maml_steps', type=int, default=1)
+    parser.add_argument('--batched_eval', action='store_true') # Adapt all test tasks at once on stacked parameters; see src/batched.py
+    parser.add_argument('--eval_incremental', action='store_true') # One new policy step per eval step instead of re-adapting from scratch; see eval_macaw
+    parser.add_argument('--eval_cache', type=str, default=None) # Directory of cached --eval results; see src/eval_cache.py
+    parser.add_argument('--clear_eval_cache', action='store_true')
     parser.add_argument('--maml_steps', type=int, default=1)
     parser.add_argument('--adaptation_temp', type=float, default=1)
     parser.add_argument('--no_bias_linear', action='store_true')
@@ -92,10 +112,17 @@ def get_args() -> argparse.Namespace:
     parser.add_argument('--eval', action='store_true')
     parser.add_argument('--target_reward', type=float, default=None)
     parser.add_argument('--save_buffers', action='store_true')
+    parser.add_argument('--checkpoint_interval', type=int, default=1000)
+    parser.add_argument('--sync_checkpoints', action='store_true') # Write checkpoints in the training process instead of a background writer process; see src/checkpoint.py
     parser.add_argument('--task_config', type=str, default=None)
     parser.add_argument('--load_inner_buffer', action='store_true')
     parser.add_argument('--load_outer_buffer', action='store_true')
-    args = parser.parse_args()
+    parser.add_argument('--actors', type=int, default=0) # Number of actor processes doing adaptation + rollouts; 0 rolls out inline
+    parser.add_argument('--actor_sync_interval', type=int, default=1) # Publish a parameter snapshot to the actors every N iterations
+    parser.add_argument('--actor_queue_size', type=int, default=None)
+    parser.add_argument('--async_eval', action='store_true') # Run the vis_interval evals in background processes
+    parser.add_argument('--async_eval_jobs', type=int, default=1) # Max concurrent background evals; further evals wait for one to finish
+    args = parser.parse_args(argv)
 
     if args.macaw_params is not None:
         with open(args.macaw_params, 'r') as f:
@@ -112,3 +139,17 @@ def get_args() -> argparse.Namespace:
             setattr(args, k, v)
             
     return args
+
+
+def merge_saved_args(args: argparse.Namespace, args_path: str, argv: Optional[List[str]] = None) -> argparse.Namespace:
+    '''Overwrite args with those saved in args_path (a run's args.txt), except for the flags given explicitly in argv.'''
+    argv = sys.argv[1:] if argv is None else argv
+    with open(args_path, 'r') as f:
+        saved = json.load(f)
+
+    given = {arg[2:].split('=')[0] for arg in argv if arg.startswith('--')}
+    for k, v in saved.items():
+        if k not in given:
+            setattr(args, k, v)
+
+    return args
@@ -0,0 +1,116 @@
+#
+# Background evaluation for MAMLRAWR. Eval workers are forked from the trainer when the
+# evaluator is created, before the trainer starts its logging threads and opens its
+# metrics database, so no worker inherits a lock held by either. Each eval is handed to
+# a worker as a copy of the training state it depends on (MAMLRAWR.eval_state) at the
+# step it was submitted, and logs to the run's TensorBoard directory (and metrics.db,
+# if the run has one) under that step while training continues.
+#
+import os
+import queue
+import time
+import traceback
+from typing import List, Optional, Tuple
+
+import numpy as np
+import torch
+import torch.multiprocessing as mp
+from torch.utils.tensorboard import SummaryWriter
+
+from src.metrics import MetricsWriter
+from src.metrics_store import StoreWriter
+
+
+def _eval_worker(model, tensorboard_log_path: str, store_path: Optional[str], threads: int, jobs, results):
+    torch.set_num_threads(threads)
+    while True:
+        item = jobs.get()
+        if item is None:
+            break
+
+        step, state = item
+        start = time.time()
+        try:
+            model.load_eval_state(state)
+            # The store is written as the trainer's run, so the eval curves are read along with its scalars
+            store = None if store_path is None else StoreWriter(store_path, os.path.basename(os.path.dirname(store_path)))
+            writer = MetricsWriter(SummaryWriter(tensorboard_log_path, filename_suffix=f'.eval_{step}'), store=store)
+            _, rewards, successes = model.eval(step, writer)
+            writer.add_scalar(f'Reward_Test/Mean', np.mean(rewards), step)
+            writer.add_scalar(f'Eval/Wall_Time', time.time() - start, step)
+            writer.close()
+            results.put((step, np.asarray(rewards), np.asarray(successes)))
+        except Exception:
+            traceback.print_exc()
+            results.put((step, None, None))
+
+
+class AsyncEvaluator(object):
+    '''
+    Runs model.eval(step, writer) in `max_jobs` worker processes, forked when the
+    evaluator is created. Submitting an eval while every worker is busy blocks until
+    one finishes, so evaluation can fall behind training by at most `max_jobs` snapshots.
+    '''
+    def __init__(self, model, tensorboard_log_path: str, max_jobs: int = 1, threads: int = 1, store_path: Optional[str] = None):
+        if model._device.type != 'cpu':
+            raise ValueError('Background evaluation forks the trainer and requires --device cpu')
+
+        ctx = mp.get_context('fork')
+        self._model = model
+        self._max_jobs = max_jobs
+        self._jobs = ctx.Queue()
+        self._results = ctx.Queue()
+        self._workers = [ctx.Process(target=_eval_worker, name=f'eval_{idx}', daemon=True,
+                                     args=(model, tensorboard_log_path, store_path, threads, self._jobs, self._results))
+                         for idx in range(max_jobs)]
+        for worker in self._workers:
+            worker.start()
+        self._pending = 0
+        self._finished = []
+        self.blocked_time = 0.
+
+    def _collect(self, block: bool):
+        try:
+            while True:
+                result = self._results.get(timeout=1) if block else self._results.get_nowait()
+                self._pending -= 1
+                if result[1] is None:
+                    print(f'Eval of step {result[0]} failed')
+                else:
+                    self._finished.append(result)
+                if block:
+                    return
+        except queue.Empty:
+            if block and not all(worker.is_alive() for worker in self._workers):
+                raise RuntimeError('An eval worker exited')
+
+    def submit(self, step: int):
+        start = time.time()
+        self._collect(block=False)
+        while self._pending >= self._max_jobs:
+            self._collect(block=True)
+        self.blocked_time += time.time() - start
+
+        self._jobs.put((step, self._model.eval_state()))
+        self._pending += 1
+
+    @property
+    def running(self) -> int:
+        self._collect(block=False)
+        return self._pending
+
+    def poll(self) -> List[Tuple[int, np.ndarray, np.ndarray]]:
+        '''Return (step, test rewards, successes) for every eval that finished since the last poll.'''
+        self._collect(block=False)
+        finished, self._finished = self._finished, []
+        return sorted(finished, key=lambda result: result[0])
+
+    def close(self) -> List[Tuple[int, np.ndarray, np.ndarray]]:
+        '''Wait for the outstanding evals, stop the workers and return the results.'''
+        while self._pending > 0:
+            self._collect(block=True)
+        for _ in self._workers:
+            self._jobs.put(None)
+        for worker in self._workers:
+            worker.join()
+        return self.poll()
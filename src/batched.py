@@ -0,0 +1,172 @@
+#
+# Task-batched versions of the MAMLRAWR inner-loop losses. Parameters of a network
+# are stacked along a leading task dimension (one row per task) and a batch of data
+# has shape (tasks, batch, features), so adapting every test task takes one forward
+# and one backward per step instead of one per task. Because the tasks share no
+# parameters, the gradient of the summed per-task losses w.r.t. the stacked
+# parameters is exactly the stack of the per-task gradients.
+#
+from typing import List, Optional
+
+import torch
+import torch.distributions as D
+import torch.nn as nn
+import torch.nn.functional as F
+
+from src.nn import MLP, BiasLinear, WLinear
+
+
+def stack_parameters(module: nn.Module, n: int, requires_grad: bool = True) -> List[torch.tensor]:
+    '''n copies of every parameter of module (in .parameters() order), stacked along a new dim 0.'''
+    return [p.detach().unsqueeze(0).repeat(n, *[1] * p.dim()).requires_grad_(requires_grad) for p in module.parameters()]
+
+
+def reset_parameters(stacked: List[torch.tensor], module: nn.Module):
+    '''Reload every row of the stacked parameters from module.'''
+    with torch.no_grad():
+        for s, p in zip(stacked, module.parameters()):
+            s.copy_(p.unsqueeze(0).expand_as(s))
+
+
+def load_parameters(module: nn.Module, stacked: List[torch.tensor], idx: int):
+    '''Copy row idx of the stacked parameters into module, e.g. to roll out task idx.'''
+    with torch.no_grad():
+        for p, s in zip(module.parameters(), stacked):
+            p.copy_(s[idx])
+
+
+def _layer_forward(layer: nn.Module, params: List[torch.tensor], x: torch.tensor) -> torch.tensor:
+    if isinstance(layer, WLinear):
+        z, fc_weight, fc_bias = params
+        theta = torch.baddbmm(fc_bias.unsqueeze(1), z.unsqueeze(1), fc_weight.transpose(1, 2)).squeeze(1)
+        w = theta[:, :layer.w_idx].view(theta.shape[0], x.shape[-1], -1)
+        b = theta[:, layer.w_idx:]
+        return torch.bmm(x, w) + b.unsqueeze(1)
+    elif isinstance(layer, BiasLinear):
+        # A module's own parameters come before its children's in .parameters()
+        bias_, weight_, weight, bias = params
+        return torch.baddbmm(bias.unsqueeze(1), x, weight.transpose(1, 2)) + torch.bmm(bias_.unsqueeze(1), weight_)
+    elif isinstance(layer, nn.Linear):
+        weight, bias = params
+        return torch.baddbmm(bias.unsqueeze(1), x, weight.transpose(1, 2))
+    elif isinstance(layer, nn.ReLU):
+        return F.relu(x)
+    else:
+        raise NotImplementedError(f'No task-batched forward for {type(layer).__name__}')
+
+
+def batched_forward(mlp: MLP, params: List[torch.tensor], x: torch.tensor, acts: Optional[torch.tensor] = None):
+    '''MLP.forward with the stacked parameters `params`, for x of shape (tasks, batch, in_features).'''
+    layers = list(mlp.seq) + (list(mlp.head_seq) if mlp._head else [])
+    layer_params, idx = {}, 0
+    for layer in layers:
+        n = len(list(layer.parameters()))
+        layer_params[id(layer)] = params[idx:idx + n]
+        idx += n
+    assert idx == len(params), f'Expected {idx} stacked parameters, got {len(params)}'
+
+    def run(seq, h):
+        for layer in seq:
+            h = _layer_forward(layer, layer_params[id(layer)], h)
+        return h
+
+    if mlp._head and acts is not None:
+        h = run(mlp.pre_seq, x)
+        return mlp._final_activation(run(mlp.post_seq, h)), run(mlp.head_seq, torch.cat((h, acts), -1))
+    else:
+        return mlp._final_activation(run(mlp.seq, x))
+
+
+def _add_task_description(model, obs: torch.tensor, task_idxs: List[Optional[int]]) -> torch.tensor:
+    if not model._args.multitask:
+        return obs
+
+    idx = torch.zeros(obs.shape[:-1] + (model.task_config.total_tasks,), device=obs.device)
+    for t, task_idx in enumerate(task_idxs):
+        if task_idx is not None:
+            idx[t,:,task_idx] = 1
+    return torch.cat((obs, idx), -1)
+
+
+def mc_value_estimates(model, value_function: MLP, params: List[torch.tensor], batch: torch.tensor,
+                       task_idxs: List[Optional[int]], no_bootstrap: bool = False) -> torch.tensor:
+    mc_value_estimates = batch[...,-1:]
+    if not no_bootstrap:
+        od, ad = model._observation_dim, model._action_dim
+        terminal_obs = _add_task_description(model, batch[...,od * 2 + ad:od * 3 + ad], task_idxs)
+        terminal_state_value_estimates = batched_forward(value_function, params, terminal_obs)
+        mc_value_estimates = mc_value_estimates + batch[...,-4:-3] * terminal_state_value_estimates
+
+    return mc_value_estimates
+
+
+def value_function_loss(model, value_function: MLP, params: List[torch.tensor], batch: torch.tensor,
+                        task_idxs: List[Optional[int]], target_params: Optional[List[torch.tensor]] = None) -> torch.tensor:
+    '''Per-task MAMLRAWR.value_function_loss_on_batch(..., inner=True); returns a (tasks,) loss.'''
+    obs = _add_task_description(model, batch[...,:model._observation_dim], task_idxs)
+    value_estimates = batched_forward(value_function, params, obs)
+    with torch.no_grad():
+        if target_params is None:
+            target_params = params
+        targets = mc_value_estimates(model, value_function, target_params, batch, task_idxs,
+                                     model._args.no_bootstrap)
+
+    if model._args.normalize_values:
+        factors = []
+        for t, task_idx in enumerate(task_idxs):
+            if task_idx is not None:
+                model._value_estimators[task_idx].add(targets[t])
+                factors.append(model._value_estimators[task_idx].std() + 1)
+            else:
+                factors.append(targets[t].std() + 1)
+        factor = torch.stack([torch.as_tensor(f, device=targets.device) for f in factors]).view(-1, 1, 1)
+    else:
+        factor = 1
+
+    return (value_estimates - targets).div(factor).pow(2).mean((1,2))
+
+
+def adaptation_policy_loss(model, policy: MLP, params: List[torch.tensor], value_function: MLP,
+                           value_params: List[torch.tensor], batch: torch.tensor, task_idxs: List[Optional[int]]) -> torch.tensor:
+    '''Per-task MAMLRAWR.adaptation_policy_loss_on_batch(..., inner=True); returns a (tasks,) loss.'''
+    od, ad = model._observation_dim, model._action_dim
+    obs = _add_task_description(model, batch[...,:od], task_idxs)
+    actions = batch[...,od:od + ad]
+    with torch.no_grad():
+        value_estimates = batched_forward(value_function, value_params, obs)
+        action_value_estimates = mc_value_estimates(model, value_function, value_params, batch, task_idxs)
+
+        advantages = (action_value_estimates - value_estimates).squeeze(-1)
+        if model._args.no_norm:
+            weights = advantages.clamp(min=-model._advantage_clamp, max=model._advantage_clamp).exp()
+        else:
+            normalized_advantages = (1 / model._adaptation_temperature) * (advantages - advantages.mean(-1, keepdim=True)) / advantages.std(-1, keepdim=True)
+            weights = normalized_advantages.clamp(max=model._advantage_clamp).exp()
+
+    if model._args.advantage_head_coef is not None:
+        action_mu, advantage_prediction = batched_forward(policy, params, obs, actions)
+    else:
+        action_mu = batched_forward(policy, params, obs)
+    action_sigma = torch.empty_like(action_mu).fill_(model._action_sigma)
+    action_log_probs = D.Normal(action_mu, action_sigma).log_prob(actions).sum(-1)
+
+    losses = -(action_log_probs * weights)
+    if model._args.advantage_head_coef is not None:
+        losses = losses + F.softplus(model._adv_coef) * (advantage_prediction.squeeze(-1) - advantages) ** 2
+
+    return losses.mean(-1)
+
+
+def inner_step(params: List[torch.tensor], loss: torch.tensor, lrs: List[torch.tensor]):
+    '''In-place p -= softplus(lr) * grad on every task's parameters; `loss` is the (tasks,) per-task loss.'''
+    grads = torch.autograd.grad(loss.sum(), params, allow_unused=True)
+    with torch.no_grad():
+        for param, grad, lr in zip(params, grads, lrs):
+            if grad is not None:
+                param.sub_(lr * grad)
+
+
+def soft_update(source: List[torch.tensor], target: List[torch.tensor], alpha: float):
+    with torch.no_grad():
+        for param_source, param_target in zip(source, target):
+            param_target.copy_(alpha * param_target + (1 - alpha) * param_source)
@@ -0,0 +1,142 @@
+#
+# A read-only store of the offline buffers shared by the instances of
+# run.py --instances N --shared_buffers.
+# The parent decodes every HDF5 buffer the task config refers to once, into columnar
+# buffers (see src/columnar.py) in shared memory (/dev/shm), and each instance attaches
+# to the store by its name. Immutable buffers then map the shared columns instead of
+# holding a private copy, so the buffers are in memory once rather than N times; only
+# the sampling state (the random module) is private to each instance. Mutable buffers
+# still copy the columns, but the HDF5 decode is not repeated.
+#
+# Buffers that are already columnar are used in place: the page cache shares them.
+# The store holds the full buffers, not the slices the instances load, so it is only
+# created if it fits in the free space of /dev/shm.
+#
+import json
+import os
+import shutil
+import tempfile
+from typing import List
+
+import h5py
+
+from src.columnar import FIELDS, Columns, convert_many, is_columnar
+from src.memory import MB
+
+
+SHM = '/dev/shm'
+BUFFER_PATHS = (('train_buffer_paths', 'train_tasks'), ('test_buffer_paths', 'test_tasks'))
+
+
+def store_path(name: str) -> str:
+    return os.path.join(SHM if os.path.isdir(SHM) else tempfile.gettempdir(), name)
+
+
+def _buffer_keys(args, task_config) -> List[str]:
+    # The buffer paths MAMLRAWR will load from, as in its __init__
+    keys = []
+    if hasattr(task_config, 'train_buffer_paths') and not args.eval and (args.load_inner_buffer or args.load_outer_buffer):
+        keys.append('train_buffer_paths')
+    if hasattr(task_config, 'test_buffer_paths') and args.load_inner_buffer:
+        keys.append('test_buffer_paths')
+    return keys
+
+
+def _h5_bytes(path: str) -> int:
+    # The size of a buffer once decoded; only the file's metadata is read
+    with h5py.File(path, 'r') as f:
+        return sum(f[field].size * f[field].dtype.itemsize for field in FIELDS)
+
+
+def _columns_bytes(path: str) -> int:
+    return sum(os.path.getsize(os.path.join(path, f'{field}.npy')) for field in FIELDS)
+
+
+class BufferStore(object):
+    '''
+    create() fills a store for a task config; attach() opens it by name in an instance,
+    and task_config() rewrites a task config's buffer paths to point into the store.
+    '''
+    def __init__(self, name: str, templates: dict):
+        self.name = name
+        self.path = store_path(name)
+        self._templates = templates
+
+    @staticmethod
+    def create(name: str, args, task_config, workers: int = 1) -> 'BufferStore':
+        path = store_path(name)
+        shutil.rmtree(path, ignore_errors=True)
+        os.makedirs(path)
+        templates, jobs = {}, []
+        for key, tasks in BUFFER_PATHS:
+            if key not in _buffer_keys(args, task_config):
+                continue
+            template = getattr(task_config, key)
+            if all(is_columnar(template.format(idx)) for idx in getattr(task_config, tasks)):
+                continue
+            templates[key] = os.path.join(path, f'{key}_{{}}.cols')
+            jobs += [(template.format(idx), templates[key].format(idx)) for idx in getattr(task_config, tasks)]
+        needed, free = sum(_h5_bytes(h5_path) for h5_path, _ in jobs), shutil.disk_usage(path).free
+        if needed > free:
+            shutil.rmtree(path, ignore_errors=True)
+            raise RuntimeError(f'The buffer store needs {needed / MB:.0f}MB but {os.path.dirname(path)} has {free / MB:.0f}MB free; '
+                               'run without --shared_buffers')
+        convert_many(jobs, workers, silent=True)
+        with open(os.path.join(path, 'store.json'), 'w') as f:
+            json.dump(templates, f)
+        return BufferStore(name, templates)
+
+    @staticmethod
+    def attach(name: str) -> 'BufferStore':
+        path = store_path(name)
+        if not os.path.isfile(os.path.join(path, 'store.json')):
+            raise RuntimeError(f'No buffer store {name} at {path}')
+        with open(os.path.join(path, 'store.json'), 'r') as f:
+            return BufferStore(name, json.load(f))
+
+    def task_config(self, task_config):
+        '''task_config (a namedtuple, as loaded by run.py) with its buffer paths pointing into the store.'''
+        return task_config._replace(**self._templates)
+
+    def _loaded(self, args, task_config) -> List[tuple]:
+        # (name, bytes, immutable) of the slice of each stored buffer an instance loads, as in MAMLRAWR.__init__
+        shared_outer = (args.offline and args.load_inner_buffer and args.load_outer_buffer and args.replay_buffer_size == args.inner_buffer_size
+                        and args.buffer_skip == args.inner_buffer_skip and args.buffer_mode == 'end')
+        kinds = [('inner_buffers', 'train_buffer_paths', 'train_tasks', args.inner_buffer_size, args.inner_buffer_skip,
+                  args.load_inner_buffer, args.offline or args.offline_inner),
+                 ('outer_buffers', 'train_buffer_paths', 'train_tasks', args.replay_buffer_size, args.buffer_skip,
+                  args.load_outer_buffer and not shared_outer, args.offline or args.offline_outer),
+                 ('test_buffers', 'test_buffer_paths', 'test_tasks', args.inner_buffer_size, args.inner_buffer_skip,
+                  args.load_inner_buffer, True)]
+        loaded = []
+        for name, key, tasks, size, skip, load, immutable in kinds:
+            if not load or key not in self._templates:
+                continue
+            nbytes = 0
+            for idx in getattr(task_config, tasks):
+                path = self._templates[key].format(idx)
+                rows = Columns(path).manifest['rows']
+                steps = min(rows, ((rows if size == -1 else size) // skip) * skip) // skip
+                nbytes += _columns_bytes(path) * steps // max(rows, 1)
+            loaded.append((name, nbytes, immutable))
+        return loaded
+
+    def report(self, args, task_config, instances: int) -> str:
+        '''
+        The store's size, what the instances would hold in private copies of the slices
+        they load, and what sharing saves: the immutable slices, which map the store,
+        are held once instead of once per instance. Mutable buffers still copy theirs.
+        '''
+        stored = sum(_columns_bytes(os.path.join(self.path, d)) for d in os.listdir(self.path) if is_columnar(os.path.join(self.path, d)))
+        loaded = self._loaded(args, task_config)
+        width = max([len(name) for name, _, _ in loaded] + [32])
+        lines = [f'{"Buffer store " + self.name:<{width}} {"MB":>10}', f'{"stored":<{width}} {stored / MB:>10.1f}']
+        lines += [f'{name + " (per instance)":<{width}} {nbytes / MB:>10.1f}' for name, nbytes, _ in loaded]
+        private = instances * sum(nbytes for _, nbytes, _ in loaded)
+        saved = (instances - 1) * sum(nbytes for _, nbytes, immutable in loaded if immutable)
+        lines.append(f'{"private copies (" + str(instances) + " instances)":<{width}} {private / MB:>10.1f}')
+        lines.append(f'{"saved":<{width}} {saved / MB:>10.1f}')
+        return '\n'.join(lines)
+
+    def close(self):
+        shutil.rmtree(self.path, ignore_errors=True)
@@ -0,0 +1,95 @@
+#
+# Background checkpointing for MAMLRAWR. Writing a checkpoint hands a copy of the
+# archive and of the rows added to the mutable replay buffers since they were last
+# saved (see NewReplayBuffer.delta) to a writer process, which does the torch.save,
+# lzf compression and disk writes while training continues.
+# The writer is started from a forkserver rather than forked from the trainer: the
+# trainer has live threads (MetricsWriter), sqlite connections and possibly a gloo
+# process group, and a child forked while one of them holds a lock can deadlock. The
+# jobs are pickled to it, so they must only hold what the writer needs: the trainer
+# stalls for copying and sending the archive and the buffer deltas, O(model + new
+# data), and for the previous checkpoint, if that one is still being written.
+#
+import os
+import pickle
+import time
+from typing import Callable, List, Tuple
+
+import torch
+import torch.multiprocessing as mp
+
+
+def to_cpu(obj):
+    '''
+    obj with every tensor copied to the cpu, so the writer never touches the GPU and the
+    archive is a snapshot: .cpu() of a cpu tensor shares its storage with the live one.
+    '''
+    if isinstance(obj, torch.Tensor):
+        return obj.detach().to('cpu', copy=True)
+    elif isinstance(obj, dict):
+        return {k: to_cpu(v) for k, v in obj.items()}
+    elif isinstance(obj, (list, tuple)):
+        return type(obj)(to_cpu(v) for v in obj)
+    else:
+        return obj
+
+
+def atomic_write(write: Callable[[str], None], path: str):
+    '''write(tmp_path), then rename over path, so path is never left half-written.'''
+    tmp_path = f'{path}.tmp{os.getpid()}'
+    try:
+        write(tmp_path)
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.lexists(tmp_path):
+            os.remove(tmp_path)
+
+
+def save_archive(archive: dict, path: str):
+    atomic_write(lambda tmp_path: torch.save(archive, tmp_path), path)
+
+
+def atomic_symlink(target: str, path: str):
+    '''Point path at target (relative to path's directory), replacing whatever path was.'''
+    atomic_write(lambda tmp_path: os.symlink(target, tmp_path), path)
+
+
+def _write_checkpoint(payload: bytes):
+    torch.set_num_threads(1)
+    for fn, args in pickle.loads(payload):
+        fn(*args)
+
+
+class CheckpointWriter(object):
+    '''
+    Runs a list of (fn, args) write jobs, e.g. (save_archive, (archive, path)), in a
+    process started from a forkserver; the jobs are pickled to it, so their args should
+    be snapshots (to_cpu, NewReplayBuffer.delta), not live objects. At most one
+    checkpoint is written at a time; `write` waits for the previous one and returns
+    how long the trainer was stalled.
+    '''
+    def __init__(self):
+        self._ctx = mp.get_context('forkserver')
+        self._job = None
+        self.stall_time = 0.
+
+    def wait(self):
+        if self._job is not None:
+            self._job.join()
+            if self._job.exitcode != 0:
+                print(f'Checkpoint writer {self._job.name} exited with code {self._job.exitcode}')
+            self._job = None
+
+    def write(self, jobs: List[Tuple[Callable, tuple]], name: str = 'checkpoint') -> float:
+        start = time.time()
+        self.wait()
+        # Pickled here rather than by torch.multiprocessing, which would send every tensor's
+        # storage as a file descriptor, more than the forkserver accepts for an archive
+        self._job = self._ctx.Process(target=_write_checkpoint, name=name, args=(pickle.dumps(jobs),))
+        self._job.start()
+        stall = time.time() - start
+        self.stall_time += stall
+        return stall
+
+    def close(self):
+        self.wait()
@@ -0,0 +1,187 @@
+#
+# A columnar on-disk format for offline replay buffers: a directory with one
+# uncompressed .npy file per NewReplayBuffer field and a manifest.json with the dims,
+# discount factor, episode boundaries and per-field statistics. The columns are
+# opened with mmap, so an immutable NewReplayBuffer loaded from one (load_from=<dir>)
+# uses the file pages directly: startup reads nothing up front, and concurrent runs
+# on the same buffers share them through the page cache.
+#
+# Existing lzf-compressed HDF5 buffers are converted in parallel with
+#
+#   python -m src.columnar --workers 8 buffers/cheetah_vel/*.hdf5
+#   python -m src.columnar --workers 8 --task_config config/cheetah_vel/40tasks_offline.json
+#
+# The second form converts every buffer a task config refers to and writes a copy of
+# the config (<name>_columnar.json) whose buffer paths point to the converted ones.
+#
+import argparse
+import json
+import os
+import shutil
+import time
+from typing import Dict, List, Tuple
+
+import h5py
+import numpy as np
+import torch.multiprocessing as mp
+
+
+MANIFEST = 'manifest.json'
+FIELDS = ('obs', 'actions', 'rewards', 'mc_rewards', 'terminals', 'terminal_obs', 'terminal_discounts', 'next_obs')
+VERSION = 1
+
+
+def is_columnar(path: str) -> bool:
+    return os.path.isfile(os.path.join(path, MANIFEST))
+
+
+def columnar_path(path: str) -> str:
+    '''Where the columnar copy of an HDF5 buffer goes: buffer.hdf5 -> buffer.cols'''
+    return f'{os.path.splitext(path)[0]}.cols'
+
+
+class Columns(object):
+    '''
+    An opened columnar buffer. Indexing it like the h5py.File NewReplayBuffer loads
+    from (f['obs'], f['discount_factor'][()]) gives memmaps of the columns, read-only
+    by default or copy-on-write with mmap_mode='c'.
+    '''
+    def __init__(self, path: str, mmap_mode: str = 'r'):
+        with open(os.path.join(path, MANIFEST), 'r') as f:
+            self.manifest = json.load(f)
+        if self.manifest['version'] != VERSION:
+            raise RuntimeError(f'Unsupported columnar buffer version {self.manifest["version"]} in {path}')
+        self._columns = {field: np.load(os.path.join(path, f'{field}.npy'), mmap_mode=mmap_mode) for field in FIELDS}
+        self._columns['discount_factor'] = np.array(self.manifest['discount_factor'], dtype=np.float32)
+
+    def __getitem__(self, field: str) -> np.ndarray:
+        return self._columns[field]
+
+    def close(self):
+        pass
+
+
+def _statistics(columns: Dict[str, np.ndarray], chunk_rows: int) -> dict:
+    stats = {}
+    for field in ('obs', 'actions', 'rewards', 'mc_rewards'):
+        column = columns[field]
+        total, total_sq = np.zeros(column.shape[1]), np.zeros(column.shape[1])
+        low, high = np.full(column.shape[1], np.inf), np.full(column.shape[1], -np.inf)
+        for start in range(0, len(column), chunk_rows):
+            chunk = column[start:start + chunk_rows].astype(np.float64)
+            total += chunk.sum(0)
+            total_sq += (chunk ** 2).sum(0)
+            low, high = np.minimum(low, chunk.min(0)), np.maximum(high, chunk.max(0))
+        mean = total / max(len(column), 1)
+        std = np.sqrt(np.maximum(total_sq / max(len(column), 1) - mean ** 2, 0))
+        stats[field] = {'mean': mean.tolist(), 'std': std.tolist(), 'min': low.tolist(), 'max': high.tolist()}
+    return stats
+
+
+def convert(h5_path: str, out_path: str = None, chunk_rows: int = 100000) -> str:
+    '''
+    Write the columnar copy of an HDF5 buffer (as written by NewReplayBuffer.save),
+    streaming it chunk by chunk so the buffer never has to fit in memory. The copy is
+    written next to out_path and renamed into place when complete.
+    '''
+    out_path = columnar_path(h5_path) if out_path is None else out_path
+    tmp_path = f'{out_path}.tmp{os.getpid()}'
+    shutil.rmtree(tmp_path, ignore_errors=True)
+    os.makedirs(tmp_path)
+    try:
+        columns = {}
+        with h5py.File(h5_path, 'r') as f:
+            rows = f['obs'].shape[0]
+            for field in FIELDS:
+                dataset = f[field]
+                column = np.lib.format.open_memmap(os.path.join(tmp_path, f'{field}.npy'), mode='w+',
+                                                   dtype=dataset.dtype, shape=dataset.shape)
+                for start in range(0, rows, chunk_rows):
+                    column[start:start + chunk_rows] = dataset[start:start + chunk_rows]
+                column.flush()
+                columns[field] = column
+            discount_factor = float(f['discount_factor'][()])
+
+        manifest = {
+            'version': VERSION,
+            'rows': rows,
+            'obs_dim': columns['obs'].shape[-1],
+            'action_dim': columns['actions'].shape[-1],
+            'discount_factor': discount_factor,
+            'fields': {field: {'dtype': columns[field].dtype.str, 'shape': list(columns[field].shape)} for field in FIELDS},
+            # Index of the last step of every episode
+            'episode_ends': np.flatnonzero(columns['terminals'][:,0]).tolist(),
+            'statistics': _statistics(columns, chunk_rows),
+            'source': os.path.abspath(h5_path),
+        }
+        with open(os.path.join(tmp_path, MANIFEST), 'w') as f:
+            json.dump(manifest, f)
+        del columns
+
+        shutil.rmtree(out_path, ignore_errors=True)
+        os.rename(tmp_path, out_path)
+    finally:
+        shutil.rmtree(tmp_path, ignore_errors=True)
+    return out_path
+
+
+def _convert(args) -> tuple:
+    h5_path, out_path = args
+    start = time.time()
+    convert(h5_path, out_path)
+    return h5_path, time.time() - start
+
+
+def convert_many(jobs: List[Tuple[str, str]], workers: int = 1, silent: bool = False):
+    '''Run convert(h5_path, out_path) for every (h5_path, out_path) in `workers` processes.'''
+    if len(jobs) == 0:
+        return
+    with mp.get_context('fork').Pool(max(1, min(workers, len(jobs)))) as pool:
+        for h5_path, seconds in pool.imap_unordered(_convert, jobs):
+            if not silent:
+                print(f'{h5_path}: {seconds:.1f}s')
+
+
+def convert_all(h5_paths: List[str], workers: int = 1, output_dir: str = None) -> Dict[str, str]:
+    '''Convert many HDF5 buffers in `workers` processes; returns {hdf5 path: columnar path}.'''
+    jobs = [(path, columnar_path(path if output_dir is None else os.path.join(output_dir, os.path.basename(path))))
+            for path in h5_paths]
+    convert_many(jobs, workers)
+    return dict(jobs)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--workers', type=int, default=os.cpu_count())
+    parser.add_argument('--output_dir', type=str, default=None) # Write the columnar buffers here instead of next to the HDF5 files
+    parser.add_argument('--task_config', type=str, default=None) # Convert every buffer of this task config
+    parser.add_argument('buffers', type=str, nargs='*') # HDF5 buffers to convert
+    args = parser.parse_args()
+
+    h5_paths = list(args.buffers)
+    if args.task_config is not None:
+        with open(args.task_config, 'r') as f:
+            task_config = json.load(f)
+        for key, tasks in (('train_buffer_paths', 'train_tasks'), ('test_buffer_paths', 'test_tasks')):
+            if key in task_config:
+                h5_paths += [task_config[key].format(idx) for idx in task_config[tasks]]
+    h5_paths = sorted(set(h5_paths))
+
+    start = time.time()
+    converted = convert_all(h5_paths, args.workers, args.output_dir)
+    print(f'Converted {len(converted)} buffers in {time.time() - start:.1f}s')
+
+    if args.task_config is not None:
+        for key in ('train_buffer_paths', 'test_buffer_paths'):
+            if key in task_config:
+                template = task_config[key]
+                task_config[key] = columnar_path(template if args.output_dir is None else
+                                                 os.path.join(args.output_dir, os.path.basename(template)))
+        config_path = f'{os.path.splitext(args.task_config)[0]}_columnar.json'
+        with open(config_path, 'w') as f:
+            json.dump(task_config, f, indent=4)
+        print(f'Wrote {config_path}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,142 @@
+#
+# Data-parallel meta-training over tasks with torch.distributed (gloo, cpu). Every rank
+# holds the full model and owns a shard of the train tasks: in train_step it adapts to
+# and back-propagates only the tasks of the meta-batch it owns, then the gradients of
+# the meta-parameters (policy, value function, Q function, learned lrs and the
+# advantage coefficient) are summed across ranks before the optimizers step. The
+# per-task losses are already divided by the total task count, so the summed gradient
+# is the one a single process iterating every task would compute, and the ranks' models
+# stay identical. Rank 0 logs, evaluates and checkpoints; the other ranks only train.
+#
+#   python -m run --ranks 4 ...
+#
+# runs 4 local ranks; bench/throughput.py --ranks 1 2 4 reports the scaling.
+#
+# By default every rank loads every train buffer. With --shard_buffers each rank only
+# loads the buffers of the tasks it owns, with the tasks assigned so that the shards
+# hold about the same number of buffer steps, so the buffer memory per rank (or node)
+# falls as ranks are added. Meta-batches (--task_batch_size) are drawn across the shards
+# in proportion to their sizes, so every rank has its share of the work each iteration.
+#
+import socket
+from typing import Callable, List
+
+import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
+
+from src.memory import buffer_steps
+
+
+def rank() -> int:
+    return dist.get_rank() if dist.is_available() and dist.is_initialized() else 0
+
+
+def world_size() -> int:
+    return dist.get_world_size() if dist.is_available() and dist.is_initialized() else 1
+
+
+def shard(tasks: List[int], rank: int, world_size: int) -> List[int]:
+    '''The tasks owned by `rank`: every world_size-th task, so shards differ in size by at most one.'''
+    return tasks[rank::world_size]
+
+
+def balanced_shards(tasks: List[int], weights: List[int], world_size: int) -> List[List[int]]:
+    '''
+    Assign tasks to world_size shards so the shards' total weights (e.g. buffer steps)
+    are balanced: heaviest task first, each to the lightest shard. Every rank computes
+    the same assignment. Each shard keeps the order of `tasks`.
+    '''
+    shards = [[] for _ in range(world_size)]
+    loads = [0] * world_size
+    for weight, task in sorted(zip(weights, tasks), key=lambda item: -item[0]):
+        lightest = min(range(world_size), key=lambda r: (loads[r], len(shards[r])))
+        shards[lightest].append(task)
+        loads[lightest] += weight
+    return [sorted(shard, key=tasks.index) for shard in shards]
+
+
+def task_shards(args, task_config, world_size: int) -> List[List[int]]:
+    '''The train tasks each rank owns: balanced by buffer steps with --shard_buffers, every world_size-th task otherwise.'''
+    tasks = task_config.train_tasks
+    if not args.shard_buffers or world_size == 1:
+        return [shard(tasks, rank, world_size) for rank in range(world_size)]
+
+    def path(idx: int, load: bool):
+        return task_config.train_buffer_paths.format(idx) if load and hasattr(task_config, 'train_buffer_paths') else None
+
+    weights = [buffer_steps(args.inner_buffer_size, args.inner_buffer_skip, path(idx, args.load_inner_buffer)) +
+               buffer_steps(args.replay_buffer_size, args.buffer_skip, path(idx, args.load_outer_buffer)) for idx in tasks]
+    return balanced_shards(tasks, weights, world_size)
+
+
+def stratified_sample(shards: List[List[int]], k: int, rng) -> List[int]:
+    '''k tasks, drawn from each shard in proportion to its size (rounded by largest remainder).'''
+    total = sum(len(shard) for shard in shards)
+    quotas = [k * len(shard) / total for shard in shards]
+    counts = [int(quota) for quota in quotas]
+    largest_remainders = sorted(range(len(shards)), key=lambda r: (counts[r] - quotas[r], rng.random()))
+    for r in largest_remainders[:k - sum(counts)]:
+        counts[r] += 1
+    return [task for shard, count in zip(shards, counts) for task in rng.sample(shard, count)]
+
+
+def _free_port() -> int:
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def _init_and_run(rank: int, world_size: int, port: int, fn: Callable, args: tuple):
+    dist.init_process_group('gloo', init_method=f'tcp://127.0.0.1:{port}', rank=rank, world_size=world_size)
+    try:
+        fn(*args)
+    finally:
+        dist.destroy_process_group()
+
+
+def launch(fn: Callable, world_size: int, *args):
+    '''Run fn(*args) in world_size local processes that form a gloo process group.'''
+    port = _free_port()
+    ctx = mp.get_context('fork')
+    processes = [ctx.Process(target=_init_and_run, args=(rank, world_size, port, fn, args)) for rank in range(world_size)]
+    for p in processes:
+        p.start()
+    for p in processes:
+        p.join()
+    failed = [rank for rank, p in enumerate(processes) if p.exitcode != 0]
+    if failed:
+        raise RuntimeError(f'Ranks {failed} exited with an error')
+
+
+def broadcast_parameters(params: List[torch.Tensor], src: int = 0):
+    '''Copy rank src's values of params to every rank.'''
+    with torch.no_grad():
+        for p in params:
+            dist.broadcast(p.data, src)
+
+
+def all_reduce_grads(params: List[torch.Tensor]):
+    '''
+    Sum the gradients of params across ranks with one all-reduce. A rank that has no
+    gradient for a parameter (e.g. none of its tasks were in the meta-batch) contributes
+    zeros; a parameter no rank has a gradient for keeps grad None, as it would without
+    data parallelism, so the optimizers skip it.
+    '''
+    grads = [p.grad.detach().reshape(-1) if p.grad is not None else torch.zeros(p.numel(), device=p.device) for p in params]
+    present = torch.tensor([float(p.grad is not None) for p in params], device=params[0].device)
+    flat = torch.cat(grads + [present])
+    dist.all_reduce(flat)
+
+    offset = 0
+    for p in params:
+        n = p.numel()
+        grad = flat[offset:offset + n].view_as(p)
+        offset += n
+        if p.grad is None:
+            p.grad = grad.clone()
+        else:
+            p.grad.copy_(grad)
+    for p, count in zip(params, flat[offset:].tolist()):
+        if count == 0:
+            p.grad = None
@@ -13,11 +13,14 @@ from metaworld.envs.mujoco.env_dict import HARD_MODE_ARGS_KWARGS, HARD_MODE_CLS_
 from gym.wrappers import TimeLimit
 from copy import deepcopy
 
+from src.task_conditioning import TaskConditionedEnv, one_hot_suffixes
 
-class ML45Env(object):
+
+class ML45Env(TaskConditionedEnv):
     def __init__(self, include_goal: bool = False):
         self.n_tasks = 50
         self.tasks = list(HARD_MODE_ARGS_KWARGS['train'].keys()) + list(HARD_MODE_ARGS_KWARGS['test'].keys())
+        self._init_task_suffixes(one_hot_suffixes(len(self.tasks)))
 
         self._max_episode_steps = 150
 
@@ -52,22 +55,19 @@ class ML45Env(object):
     def reset(self):
         obs = self._env.reset()
         if self.include_goal:
-            one_hot = np.zeros(len(self.tasks), dtype=np.float32)
-            one_hot[self._task_idx] = 1.0
-            obs = np.concatenate([obs, one_hot])
+            obs = self._condition_obs(obs)
         return obs
 
     def step(self, action):
         o, r, d, i = self._env.step(action)
         if self.include_goal:
-            one_hot = np.zeros(len(self.tasks), dtype=np.float32)
-            one_hot[self._task_idx] = 1.0
-            o = np.concatenate([o, one_hot])
+            o = self._condition_obs(o)
         return o, r, d, i
 
     def set_task_idx(self, idx):
         self._task_idx = idx
         self._env = self._envs[idx]
+        self._select_task_suffix(idx)
 
     def __getattribute__(self, name):
         '''
@@ -87,41 +87,37 @@ class ML45Env(object):
         raise e_
 
 
-class HalfCheetahDirEnv(HalfCheetahDirEnv_):
+class HalfCheetahDirEnv(HalfCheetahDirEnv_, TaskConditionedEnv):
     def __init__(self, tasks: List[dict], include_goal: bool = False):
         self.include_goal = include_goal
-        super(HalfCheetahDirEnv, self).__init__()
         if tasks is None:
             tasks = [{'direction': 1}, {'direction': -1}]
+        self._init_task_suffixes(one_hot_suffixes(len(tasks)))
+        super(HalfCheetahDirEnv, self).__init__()
         self.tasks = tasks
         self.set_task_idx(0)
         self._max_episode_steps = 200
 
     def _get_obs(self):
+        obs = super()._get_obs()
         if self.include_goal:
-            idx = 0
-            try:
-                idx = self.tasks.index(self._task)
-            except:
-                pass
-            one_hot = np.zeros(len(self.tasks), dtype=np.float32)
-            one_hot[idx] = 1.0
-            obs = super()._get_obs()
-            obs = np.concatenate([obs, one_hot])
-        else:
-            obs = super()._get_obs()
+            obs = self._condition_obs(obs)
         return obs
     
     def set_task(self, task):
-        self._task = task
-        self._goal_dir = self._task['direction']
-        self.reset()
+        self._select_task_suffix_for(task, self.tasks)
+        self._set_goal(task)
 
     def set_task_idx(self, idx):
-        self.set_task(self.tasks[idx])
+        self._select_task_suffix(idx)
+        self._set_goal(self.tasks[idx])
+
+    def _set_goal(self, task):
+        self._task = task
+        self._goal_dir = self._task['direction']
         
 
-class HalfCheetahVelEnv(HalfCheetahVelEnv_):
+class HalfCheetahVelEnv(HalfCheetahVelEnv_, TaskConditionedEnv):
     def __init__(self, tasks: List[dict] = None, include_goal: bool = False, one_hot_goal: bool = False, n_tasks: int = None):
         self.include_goal = include_goal
         self.one_hot_goal = one_hot_goal
@@ -129,36 +125,41 @@ class HalfCheetahVelEnv(HalfCheetahVelEnv_):
             assert n_tasks is not None, "Either tasks or n_tasks must be non-None"
             tasks = self.sample_tasks(n_tasks)
         self.n_tasks = len(tasks)
+        if self.one_hot_goal:
+            self._init_task_suffixes(one_hot_suffixes(self.n_tasks, dtype=np.float64))
+        else:
+            self._init_task_suffixes(np.array([task['velocity'] for task in tasks], dtype=np.float64))
         super().__init__(tasks)
         self.set_task_idx(0)
         self._max_episode_steps = 200
 
     def _get_obs(self):
+        obs = super()._get_obs()
         if self.include_goal:
-            obs = super()._get_obs()
-            if self.one_hot_goal:
-                goal = np.zeros((self.n_tasks,))
-                goal[self.tasks.index(self._task)] = 1
-            else:
-                goal = np.array([self._goal_vel])
-            obs = np.concatenate([obs, goal])
-        else:
-            obs = super()._get_obs()
-
+            obs = self._condition_obs(obs)
         return obs
         
     def set_task(self, task):
-        self._task = task
-        self._goal_vel = self._task['velocity']
-        self.reset()
+        if self.one_hot_goal:
+            self.task_idx = self._select_task_suffix_for(task, self.tasks)
+        else:
+            self._task_suffix = np.array([task['velocity']], dtype=np.float64)
+        self._set_goal(task)
 
     def set_task_idx(self, idx):
         self.task_idx = idx
-        self.set_task(self.tasks[idx])
+        self._select_task_suffix(idx)
+        self._set_goal(self.tasks[idx])
+
+    def _set_goal(self, task):
+        self._task = task
+        self._goal_vel = self._task['velocity']
 
-class AntDirEnv(AntDirEnv_):
+class AntDirEnv(AntDirEnv_, TaskConditionedEnv):
     def __init__(self, tasks: List[dict], n_tasks: int = None, include_goal: bool = False):
         self.include_goal = include_goal
+        # The one-hot is always padded to 50 entries, independent of the task count
+        self._init_task_suffixes(one_hot_suffixes(len(tasks) if tasks is not None else (n_tasks or 1), 50))
         super(AntDirEnv, self).__init__(forward_backward=n_tasks == 2)
         if tasks is None:
             assert n_tasks is not None, "Either tasks or n_tasks must be non-None"
@@ -169,27 +170,22 @@ class AntDirEnv(AntDirEnv_):
         self._max_episode_steps = 200
     
     def _get_obs(self):
+        obs = super()._get_obs()
         if self.include_goal:
-            idx = 0
-            try:
-                idx = self.tasks.index(self._task)
-            except:
-                pass
-            one_hot = np.zeros(50, dtype=np.float32)
-            one_hot[idx] = 1.0
-            obs = super()._get_obs()
-            obs = np.concatenate([obs, one_hot])
-        else:
-            obs = super()._get_obs()
+            obs = self._condition_obs(obs)
         return obs
     
     def set_task(self, task):
-        self._task = task
-        self._goal = task['goal']
-        self.reset()
+        self._select_task_suffix_for(task, self.tasks)
+        self._set_goal(task)
 
     def set_task_idx(self, idx):
-        self.set_task(self.tasks[idx])
+        self._select_task_suffix(idx)
+        self._set_goal(self.tasks[idx])
+
+    def _set_goal(self, task):
+        self._task = task
+        self._goal = task['goal']
         
 
 ######################################################
@@ -277,10 +273,11 @@ class HumanoidDirEnv(HumanoidDirEnv_):
 ######################################################
 ######################################################
 
-class WalkerRandParamsWrappedEnv(WalkerRandParamsWrappedEnv_):
+class WalkerRandParamsWrappedEnv(WalkerRandParamsWrappedEnv_, TaskConditionedEnv):
     def __init__(self, tasks: List[dict] = None, n_tasks: int = None, include_goal: bool = False):
         self.include_goal = include_goal
         self.n_tasks = len(tasks) if tasks is not None else n_tasks
+        self._init_task_suffixes(one_hot_suffixes(self.n_tasks))
         
         super(WalkerRandParamsWrappedEnv, self).__init__(tasks, n_tasks)
 
@@ -288,24 +285,64 @@ class WalkerRandParamsWrappedEnv(WalkerRandParamsWrappedEnv_):
         self._max_episode_steps = 200
         
     def _get_obs(self):
+        obs = super()._get_obs()
         if self.include_goal:
-            idx = 0
-            try:
-                idx = self._goal
-            except:
-                pass
-            one_hot = np.zeros(self.n_tasks, dtype=np.float32)
-            one_hot[idx] = 1.0
-            obs = super()._get_obs()
-            obs = np.concatenate([obs, one_hot])
-        else:
-            obs = super()._get_obs()
+            obs = self._condition_obs(obs)
         return obs
         
     def set_task_idx(self, idx):
         self._task = self.tasks[idx]
         self._goal = idx
+        self._select_task_suffix(idx)
         self.set_task(self._task)
-        self.reset()
-   
-     
+
+
+class WalkerRandParamsCachedEnv(object):
+    '''
+    One WalkerRandParamsWrappedEnv per task, built the first time the task is
+    used. Switching tasks only swaps the active instance, so the physics parameters
+    are written into a MuJoCo model once per task instead of on every switch.
+    '''
+    def __init__(self, tasks: List[dict] = None, n_tasks: int = None, include_goal: bool = False):
+        self._env = None
+        self.include_goal = include_goal
+        self._envs = [WalkerRandParamsWrappedEnv(tasks, n_tasks, include_goal=include_goal)]
+        self.tasks = self._envs[0].tasks
+        self.n_tasks = len(self.tasks)
+        self._envs += [None] * (self.n_tasks - 1)
+        self._max_episode_steps = 200
+
+        self.set_task_idx(0)
+
+    def set_task_idx(self, idx):
+        if self._envs[idx] is None:
+            self._envs[idx] = WalkerRandParamsWrappedEnv(self.tasks, include_goal=self.include_goal)
+            self._envs[idx].set_task_idx(idx)
+        self._task_idx = idx
+        self._env = self._envs[idx]
+
+    def set_task(self, task):
+        self.set_task_idx(self.tasks.index(task))
+
+    def reset(self):
+        return self._env.reset()
+
+    def step(self, action):
+        return self._env.step(action)
+
+    def __getattribute__(self, name):
+        '''
+        If we try to access attributes that only exist in the env, return the
+        env implementation.
+        '''
+        try:
+            return object.__getattribute__(self, name)
+        except AttributeError as e:
+            e_ = e
+            try:
+                return object.__getattribute__(self._env, name)
+            except AttributeError as env_exception:
+                pass
+            except Exception as env_exception:
+                e_ = env_exception
+        raise e_
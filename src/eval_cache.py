@@ -0,0 +1,113 @@
+#
+# On-disk cache of offline evaluation results. An entry is addressed by a hash of
+# everything the result depends on: the parameters being evaluated (so two copies
+# of the same archive share entries and a retrained one never does), the task
+# config, the test tasks, the eval seed, rollout counter and RNG states, and the
+# eval args.
+#
+import hashlib
+import json
+import os
+import pickle
+import shutil
+import tempfile
+from typing import Iterable, List, Optional, Tuple
+
+import numpy as np
+import torch
+
+
+# Args that do not change the result of an eval, so changing them should not miss the cache
+IGNORED_ARGS = {'name', 'log_dir', 'archive', 'eval_cache', 'clear_eval_cache', 'seed', 'instances', 'profile',
+                'render', 'render_exploration', 'vis_interval', 'train_steps', 'save_buffers', 'actors',
+                'actor_sync_interval', 'actor_queue_size', 'async_eval', 'async_eval_jobs', 'log_interval',
+                'histogram_interval', 'checkpoint_interval', 'memory_interval', 'memory_dry_run', 'sync_timers',
+                'torch_profile', 'torch_profile_start', 'torch_profile_steps', 'torch_profile_every', 'no_metrics_store',
+                'sync_checkpoints', 'resume', 'shared_buffers', 'ranks', 'shard_buffers'}
+
+
+def hash_tensors(tensors: Iterable[torch.tensor]) -> str:
+    h = hashlib.sha256()
+    for tensor in tensors:
+        tensor = tensor.detach().cpu().contiguous()
+        h.update(str((tuple(tensor.shape), str(tensor.dtype))).encode())
+        h.update(tensor.numpy().tobytes())
+    return h.hexdigest()
+
+
+def hash_rng_state(state) -> str:
+    np_state = state[1]
+    return hashlib.sha256(pickle.dumps((state[0], np_state[0], np_state[1].numpy(), np_state[2:], state[2].numpy()))).hexdigest()
+
+
+class TeeWriter(object):
+    '''Forwards add_scalar to a SummaryWriter and keeps (tag, value, step) for every call.'''
+    def __init__(self, writer):
+        self._writer = writer
+        self.scalars = []
+
+    def add_scalar(self, tag: str, value, step: int):
+        self.scalars.append((tag, float(value), step))
+        self._writer.add_scalar(tag, value, step)
+
+    def __getattr__(self, name):
+        return getattr(self._writer, name)
+
+
+class EvalCache(object):
+    '''
+    Maps a key (see `key`) to the result of one eval: per-task rewards, successes,
+    every scalar the eval logged (the per-step reward curves), and the rollout
+    counter and RNG states after the eval, so that a hit leaves the model exactly
+    where rerunning the eval would have. `hits` and `misses` count lookups in this process.
+    '''
+    def __init__(self, cache_dir: str):
+        self._cache_dir = cache_dir
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(cache_dir, exist_ok=True)
+
+    @staticmethod
+    def key(parameters: str, task_config, test_tasks: List[int], seed: int, rollout_counter: int, rng_state: str,
+            train_step_idx: int, eval_args: dict) -> str:
+        description = {'parameters': parameters, 'task_config': task_config, 'test_tasks': list(test_tasks),
+                       'seed': seed, 'rollout_counter': rollout_counter, 'rng_state': rng_state, 'train_step_idx': train_step_idx,
+                       'args': {k: v for k, v in eval_args.items() if k not in IGNORED_ARGS}}
+        return hashlib.sha256(json.dumps(description, sort_keys=True, default=str).encode()).hexdigest()
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self._cache_dir, key[:2], f'{key}.pkl')
+
+    def get(self, key: str) -> Optional[dict]:
+        try:
+            with open(self._path(key), 'rb') as f:
+                entry = pickle.load(f)
+        except (FileNotFoundError, EOFError, pickle.UnpicklingError):
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        return entry
+
+    def put(self, key: str, rewards: np.ndarray, successes: np.ndarray, scalars: List[Tuple[str, float, int]],
+            rollout_counter: int, rng_state):
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        entry = {'rewards': np.asarray(rewards), 'successes': np.asarray(successes), 'scalars': scalars,
+                 'rollout_counter': rollout_counter, 'rng_state': rng_state}
+        # Written to a temporary file and renamed, so concurrent evals never read a partial entry
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+        with os.fdopen(fd, 'wb') as f:
+            pickle.dump(entry, f)
+        os.replace(tmp_path, path)
+
+    def invalidate(self, key: str) -> bool:
+        try:
+            os.remove(self._path(key))
+            return True
+        except FileNotFoundError:
+            return False
+
+    def clear(self):
+        shutil.rmtree(self._cache_dir, ignore_errors=True)
+        os.makedirs(self._cache_dir, exist_ok=True)
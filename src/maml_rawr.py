@@ -24,7 +24,18 @@ warnings.filterwarnings('ignore',category=FutureWarning)
 from torch.utils.tensorboard import SummaryWriter
 
 from src.nn import MLP, CVAE
-from src.utils import NewReplayBuffer, Experience, argmax, kld, RunningEstimator
+from src.utils import NewReplayBuffer, NullWriter, Experience, argmax, kld, RunningEstimator
+from src.utils import get_rng_state, set_rng_state, get_np_rng_state, set_np_rng_state, write_delta
+from src.actor_learner import ActorPool
+from src.async_eval import AsyncEvaluator
+from src.checkpoint import CheckpointWriter, atomic_symlink, save_archive, to_cpu
+from src.metrics import MetricsWriter
+from src.metrics_store import StoreWriter
+from src.profiling import PhaseTimer, torch_profiler
+from src.memory import PhasePeaks, model_rows, format_rows, log_rows
+from src.eval_cache import EvalCache, TeeWriter, hash_tensors, hash_rng_state
+import src.batched as batched
+import src.distributed as distributed
 
 
 def env_action_dim(env):
@@ -129,23 +140,9 @@ class MAMLRAWR(object):
         if args.train_exploration or args.sample_exploration_inner:
             self._exploration_policy_optimizer = O.Adam(self._exploration_policy.parameters(), lr=args.exploration_lr)
 
-        if args.archive is not None:
-            print_(f'Loading parameters from archive: {args.archive}', silent)
-            archive = torch.load(args.archive)
-            self._value_function.load_state_dict(archive['vf'])
-            self._adaptation_policy.load_state_dict(archive['policy'])
-            self._value_function_optimizer.load_state_dict(archive['vf_opt'])
-            self._adaptation_policy_optimizer.load_state_dict(archive['policy_opt'])
-            self._policy_lrs = archive['policy_lrs']
-            self._value_lrs = archive['vf_lrs']
-            if 'adv_coef' in archive:
-                self._adv_coef = archive['adv_coef']
-            else:
-                self._adv_coef = None
-        else:
-            self._policy_lrs = None
-            self._value_lrs = None
-            self._adv_coef = None
+        self._policy_lrs = None
+        self._value_lrs = None
+        self._adv_coef = None
 
         has_train_buffers = hasattr(task_config, 'train_buffer_paths') and not args.eval
         has_test_buffers = hasattr(task_config, 'test_buffer_paths')
@@ -157,6 +154,14 @@ class MAMLRAWR(object):
         inner_buffers = [task_config.train_buffer_paths.format(idx) if load_inner_buffers else None for idx in task_config.train_tasks]
         outer_buffers = [task_config.train_buffer_paths.format(idx) if load_outer_buffers else None for idx in task_config.train_tasks]
         test_buffers = [task_config.test_buffer_paths.format(idx) if load_test_buffers else None for idx in task_config.test_tasks]
+
+        # Data-parallel training over the train tasks; see src/distributed.py
+        self._rank = distributed.rank()
+        self._world_size = distributed.world_size()
+        self._shards = distributed.task_shards(args, task_config, self._world_size)
+        self._owned_tasks = set(self._shards[self._rank])
+        # With --shard_buffers, the train buffers of tasks other ranks own are not loaded (None)
+        owned = lambda task: not args.shard_buffers or task in self._owned_tasks
         
         self._test_buffers = [NewReplayBuffer(args.inner_buffer_size, self._observation_dim, env_action_dim(self._env),
                                               discount_factor=discount_factor,
@@ -167,7 +172,7 @@ class MAMLRAWR(object):
         self._inner_buffers = [NewReplayBuffer(args.inner_buffer_size, self._observation_dim, env_action_dim(self._env),
                                                discount_factor=discount_factor,
                                                immutable=args.offline or args.offline_inner, load_from=inner_buffers[i], silent=silent, skip=args.inner_buffer_skip,
-                                               stream_to_disk=args.from_disk, mode=args.buffer_mode)
+                                               stream_to_disk=args.from_disk, mode=args.buffer_mode) if owned(task) else None
                                for i, task in enumerate(task_config.train_tasks)]
         
         if args.offline and args.load_inner_buffer and args.load_outer_buffer and (args.replay_buffer_size == args.inner_buffer_size) and (args.buffer_skip == args.inner_buffer_skip) and args.buffer_mode == 'end':
@@ -176,7 +181,7 @@ class MAMLRAWR(object):
             self._outer_buffers = [NewReplayBuffer(args.replay_buffer_size, self._observation_dim, env_action_dim(self._env),
                                                    discount_factor=discount_factor, immutable=args.offline or args.offline_outer,
                                                    load_from=outer_buffers[i], silent=silent, skip=args.buffer_skip,
-                                                   stream_to_disk=args.from_disk)
+                                                   stream_to_disk=args.from_disk) if owned(task) else None
                                    for i, task in enumerate(task_config.train_tasks)]
 
         self._training_iterations = training_iterations
@@ -195,6 +200,10 @@ class MAMLRAWR(object):
         
         self._adaptation_temperature = args.adaptation_temp
         self._device = torch.device(args.device)
+        if args.archive is not None:
+            print_(f'Loading parameters from archive: {args.archive}', silent)
+            self.load_archive(args.archive)
+
         self._cpu = torch.device('cpu')
         self._advantage_clamp = np.log(args.exp_advantage_clip)
         self._action_sigma = args.action_sigma
@@ -202,13 +211,190 @@ class MAMLRAWR(object):
         self._silent = silent
         self._gradient_steps_per_iteration = gradient_steps_per_iteration
         self._grad_clip = args.grad_clip
+        self._env_seeds_state = get_np_rng_state()
         self._env_seeds = np.random.randint(1e10, size=(int(1e7),))
         self._rollout_counter = 0
         self._value_estimators = [RunningEstimator() for _ in self._env.tasks]
         self._q_estimators = [RunningEstimator() for _ in self._env.tasks]
         self._maml_steps = args.maml_steps
         self._max_maml_steps = args.maml_steps
+        self._train_task_positions = {task_idx: i for i, task_idx in enumerate(task_config.train_tasks)}
+        self._actors = None
+        self._evaluator = None
+        self._eval_scratch = None
+        self._timer = PhaseTimer(cuda_sync=args.sync_timers)
+        self._eval_seed = None
+        self._buffer_dir = None
+        self._eval_cache = None
+        if args.eval_cache is not None and args.eval:
+            self._eval_cache = EvalCache(args.eval_cache)
+            if args.clear_eval_cache:
+                self._eval_cache.clear()
+        if args.actors > 0 and args.sample_exploration_inner:
+            raise ValueError('Actor processes only roll out the adapted policy; --sample_exploration_inner is not supported')
+
+        if self._world_size > 1:
+            if not (args.offline and args.load_inner_buffer and args.load_outer_buffer) or args.target_reward is not None:
+                raise ValueError('Data-parallel training needs --offline with loaded buffers and no --target_reward')
+            distributed.broadcast_parameters(self._synced_parameters())
         
+    def load_archive(self, path: str):
+        '''
+        Load the networks, their optimizers and the learned lrs/advantage coefficient
+        from an archive_*.pt written by train(). The lrs are copied into the existing
+        parameters, so their optimizers stay valid and an archive can be swapped in
+        at any time (see eval_farm.py).
+        '''
+        archive = torch.load(path, map_location=self._device)
+        self._value_function.load_state_dict(archive['vf'])
+        self._adaptation_policy.load_state_dict(archive['policy'])
+        self._value_function_optimizer.load_state_dict(archive['vf_opt'])
+        self._adaptation_policy_optimizer.load_state_dict(archive['policy_opt'])
+        with torch.no_grad():
+            for lr, archived_lr in zip(self._policy_lrs, archive['policy_lrs']):
+                lr.copy_(archived_lr)
+            for lr, archived_lr in zip(self._value_lrs, archive['vf_lrs']):
+                lr.copy_(archived_lr)
+            if self._adv_coef is not None and 'adv_coef' in archive:
+                self._adv_coef.copy_(archive['adv_coef'])
+
+    def reseed(self, seed: int):
+        '''Reset every source of randomness in training/eval, including the env seed table, to a function of `seed`.'''
+        random.seed(seed)
+        np.random.seed(seed)
+        torch.manual_seed(seed)
+        self._env_seeds_state = get_np_rng_state()
+        self._env_seeds = np.random.randint(1e10, size=(int(1e7),))
+        self._rollout_counter = 0
+        self._eval_seed = seed
+
+    def _synced_parameters(self) -> List[torch.Tensor]:
+        '''The meta-parameters whose gradients are summed across ranks in data-parallel training.'''
+        params = list(self._adaptation_policy.parameters()) + list(self._value_function.parameters())
+        if self._args.q:
+            params += list(self._q_function.parameters())
+        params += self._policy_lrs + self._value_lrs
+        if self._adv_coef is not None:
+            params.append(self._adv_coef)
+        return params
+
+    def _mutable_buffers(self):
+        '''(file name, buffer) for every buffer that training writes to, i.e. the ones a checkpoint must include.'''
+        buffers = [(f'inner_buffer_{i}.h5', b) for i, b in enumerate(self._inner_buffers)]
+        if self._outer_buffers is not self._inner_buffers:
+            buffers += [(f'outer_buffer_{i}.h5', b) for i, b in enumerate(self._outer_buffers)]
+        buffers += [(f'test_buffer_{i}.h5', b) for i, b in enumerate(self._test_buffers)]
+        return [(name, b) for name, b in buffers if b is not None and not b.immutable]
+
+    def resume_state(self, train_step_idx: int, buffer_dir: str) -> dict:
+        '''Everything besides the archive and the mutable buffers (saved to buffer_dir) that training depends on after train_step_idx.'''
+        state = {
+            'train_step_idx': train_step_idx,
+            'buffer_dir': buffer_dir,
+            'q_function': self._q_function.state_dict(),
+            'q_opt': self._q_function_optimizer.state_dict(),
+            'policy_lr_opt': self._policy_lr_optimizer.state_dict(),
+            'value_lr_opt': self._value_lr_optimizer.state_dict(),
+            'value_estimators': [vars(e) for e in self._value_estimators],
+            'q_estimators': [vars(e) for e in self._q_estimators],
+            'maml_steps': self._maml_steps,
+            'rollout_counter': self._rollout_counter,
+            'env_seeds_state': self._env_seeds_state,
+            'eval_seed': self._eval_seed,
+            'buffers': {name: (b._write_location, b._total_written) for name, b in self._mutable_buffers()},
+            'rng_state': get_rng_state(),
+            'elapsed_time': time.time() - self._start_time
+        }
+        if self._args.advantage_head_coef is not None:
+            state['adv_coef_opt'] = self._adv_coef_optimizer.state_dict()
+        if self._exploration_policy is not None:
+            state['exploration_policy'] = self._exploration_policy.state_dict()
+        if hasattr(self, '_exploration_policy_optimizer'):
+            state['exploration_opt'] = self._exploration_policy_optimizer.state_dict()
+        if self._device.type == 'cuda':
+            state['cuda_rng_state'] = torch.cuda.get_rng_state_all()
+        return state
+
+    def load_resume(self, log_path: str) -> int:
+        '''
+        Restore the full training state from the latest checkpoint in log_path (see
+        train), so that training continues exactly as if it had not been interrupted.
+        Returns the index of the last completed train step.
+        '''
+        archive = torch.load(f'{log_path}/archive_LATEST.pt', map_location=self._device)
+        if 'resume' not in archive:
+            raise RuntimeError(f'{log_path}/archive_LATEST.pt was written without resume state')
+        self.load_archive(f'{log_path}/archive_LATEST.pt')
+        state = archive['resume']
+
+        self._q_function.load_state_dict(state['q_function'])
+        self._q_function_optimizer.load_state_dict(state['q_opt'])
+        self._policy_lr_optimizer.load_state_dict(state['policy_lr_opt'])
+        self._value_lr_optimizer.load_state_dict(state['value_lr_opt'])
+        if 'adv_coef_opt' in state:
+            self._adv_coef_optimizer.load_state_dict(state['adv_coef_opt'])
+        if 'exploration_policy' in state:
+            self._exploration_policy.load_state_dict(state['exploration_policy'])
+        if 'exploration_opt' in state:
+            self._exploration_policy_optimizer.load_state_dict(state['exploration_opt'])
+        for estimator, estimator_state in zip(self._value_estimators + self._q_estimators,
+                                              state['value_estimators'] + state['q_estimators']):
+            estimator.__dict__.update(estimator_state)
+
+        for name, buffer in self._mutable_buffers():
+            buffer.restore(f'{log_path}/{state["buffer_dir"]}/{name}')
+            if 'buffers' in state and (buffer._write_location, buffer._total_written) != tuple(state['buffers'][name]):
+                raise RuntimeError(f'{log_path}/{state["buffer_dir"]}/{name} does not hold the buffer of step {state["train_step_idx"]}')
+        self._buffer_dir = state['buffer_dir']
+
+        self._maml_steps = state['maml_steps']
+        self._rollout_counter = state['rollout_counter']
+        self._env_seeds_state = state['env_seeds_state']
+        rng = np.random.RandomState()
+        set_np_rng_state(self._env_seeds_state, rng)
+        self._env_seeds = rng.randint(1e10, size=(int(1e7),))
+        self._eval_seed = state['eval_seed']
+        set_rng_state(state['rng_state'])
+        if 'cuda_rng_state' in state:
+            torch.cuda.set_rng_state_all([s.cpu() for s in state['cuda_rng_state']])
+        self._start_time = time.time() - state['elapsed_time']
+        return state['train_step_idx']
+
+    def eval_state(self) -> dict:
+        '''A copy of the training state that eval depends on, for a background eval worker (see src/async_eval.py).'''
+        state = {
+            'vf': self._value_function.state_dict(),
+            'policy': self._adaptation_policy.state_dict(),
+            'q_function': self._q_function.state_dict(),
+            'vf_lrs': self._value_lrs,
+            'policy_lrs': self._policy_lrs,
+            'adv_coef': self._adv_coef,
+            'value_estimators': deepcopy([vars(e) for e in self._value_estimators]),
+            'q_estimators': deepcopy([vars(e) for e in self._q_estimators]),
+            'maml_steps': self._maml_steps,
+            'rollout_counter': self._rollout_counter,
+            'eval_seed': self._eval_seed,
+            'rng_state': get_rng_state()
+        }
+        return to_cpu(state)
+
+    def load_eval_state(self, state: dict):
+        self._value_function.load_state_dict(state['vf'])
+        self._adaptation_policy.load_state_dict(state['policy'])
+        self._q_function.load_state_dict(state['q_function'])
+        with torch.no_grad():
+            for lr, state_lr in zip(self._value_lrs + self._policy_lrs, state['vf_lrs'] + state['policy_lrs']):
+                lr.copy_(state_lr)
+            if self._adv_coef is not None:
+                self._adv_coef.copy_(state['adv_coef'])
+        for estimator, estimator_state in zip(self._value_estimators + self._q_estimators,
+                                              state['value_estimators'] + state['q_estimators']):
+            estimator.__dict__.update(estimator_state)
+        self._maml_steps = state['maml_steps']
+        self._rollout_counter = state['rollout_counter']
+        self._eval_seed = state['eval_seed']
+        set_rng_state(state['rng_state'])
+
     #################################################################
     ################# SUBROUTINES FOR TRAINING ######################
     #################################################################
@@ -409,6 +595,67 @@ class MAMLRAWR(object):
             assert param_source[0] == param_target[0]
             param_target[1].data = self._args.target_vf_alpha * param_target[1].data + (1 - self._args.target_vf_alpha) * param_source[1].data
 
+    def _eval_scratch_modules(self):
+        '''
+        Value function, target value function and policy copies that evaluation-only
+        adaptation writes into. They are created once and reloaded from the
+        meta-parameters for every task, instead of deep-copying the networks each time.
+        '''
+        if self._eval_scratch is None:
+            self._eval_scratch = (deepcopy(self._value_function), deepcopy(self._value_function), deepcopy(self._adaptation_policy))
+        return self._eval_scratch
+
+    def _load_params(self, target: nn.Module, source: nn.Module):
+        with torch.no_grad():
+            for param_target, param_source in zip(target.parameters(), source.parameters()):
+                param_target.copy_(param_source)
+
+    def _inner_step_no_grad(self, module: nn.Module, loss: torch.tensor, lrs: List[torch.tensor]):
+        '''
+        The SGD step higher takes in the inner loop (p - softplus(lr) * grad), applied in
+        place. Gradients come from a local autograd.grad, so nothing is accumulated
+        into .grad and no graph is kept past the step.
+        '''
+        params = list(module.adaptation_parameters())
+        grads = A.grad(loss, params, allow_unused=True)
+        with torch.no_grad():
+            for param, grad, lr in zip(params, grads, lrs):
+                if grad is not None:
+                    param.sub_(lr * grad)
+
+    def adapt_policy(self, task_idx: int, value_batch: torch.tensor, policy_batch: torch.tensor = None) -> nn.Module:
+        '''
+        Run the inner loop of train_step (value adaptation, then policy adaptation)
+        for one task without tracking higher-order gradients, and return the adapted
+        policy. Used to produce rollout policies outside of the meta-update. The
+        returned policy is a scratch module that the next adaptation overwrites.
+        '''
+        if self._args.multitask or len(self._env.tasks) <= 1:
+            return self._adaptation_policy
+
+        policy_batch = value_batch if policy_batch is None else policy_batch
+        value_sub_batches = value_batch.view(self._maml_steps, value_batch.shape[0] // self._maml_steps, *value_batch.shape[1:])
+        policy_sub_batches = policy_batch.view(self._maml_steps, policy_batch.shape[0] // self._maml_steps, *policy_batch.shape[1:])
+
+        value_function, vf_target, policy = self._eval_scratch_modules()
+        self._load_params(value_function, self._value_function)
+        self._load_params(vf_target, self._value_function)
+        self._load_params(policy, self._adaptation_policy)
+        with torch.no_grad():
+            value_lrs = [F.softplus(l) for l in self._value_lrs]
+            policy_lrs = [F.softplus(l) for l in self._policy_lrs]
+
+        for step in range(self._maml_steps):
+            loss, _, _, _ = self.value_function_loss_on_batch(value_function, value_sub_batches[step], inner=True, task_idx=task_idx, target=vf_target)
+            self._inner_step_no_grad(value_function, loss, value_lrs)
+            self.soft_update(value_function, vf_target)
+
+        for step in range(self._maml_steps):
+            loss, _, _, _ = self.adaptation_policy_loss_on_batch(policy, None, value_function, policy_sub_batches[step], task_idx, inner=True)
+            self._inner_step_no_grad(policy, loss, policy_lrs)
+
+        return policy
+
     def eval_multitask(self, train_step_idx: int, writer: SummaryWriter):
         rewards = np.full((len(self.task_config.test_tasks), self._args.eval_maml_steps+1), float('nan'))
         trajectories, successes = [], []
@@ -485,39 +732,47 @@ class MAMLRAWR(object):
             policy_batch = value_batch#torch.tensor(test_buffer.sample(self._args.inner_batch_size), requires_grad=False).to(self._device)
             policy_sub_batches = policy_batch.view(self._args.eval_maml_steps, policy_batch.shape[0] // self._args.eval_maml_steps, *policy_batch.shape[1:]) # Split data to use different data for each gradient step
 
-            value_function = deepcopy(self._value_function)
-            vf_target = deepcopy(value_function)
+            # Nothing is differentiated through the eval adaptation, so it runs in place on scratch copies
+            value_function, vf_target, policy = self._eval_scratch_modules()
+            self._load_params(value_function, self._value_function)
+            self._load_params(vf_target, self._value_function)
+            self._load_params(policy, self._adaptation_policy)
+            with torch.no_grad():
+                value_lrs = [F.softplus(l) for l in self._value_lrs]
+                policy_lrs = [F.softplus(l) for l in self._policy_lrs]
             DEBUG('******************************************* EVAL **********************************', self._args.debug)
-            opt = O.SGD([{'params': p, 'lr': None} for p in value_function.adaptation_parameters()])
-            with higher.innerloop_ctx(value_function, opt, override={'lr': [F.softplus(l) for l in self._value_lrs]}) as (f_value_function, diff_value_opt):
-                for eval_step in range(self._maml_steps):
-                    #print(f'VALUE STEP {eval_step}')
-                    DEBUG(f'**************** EVAL STEP {eval_step} *******************', self._args.debug)
-                    sub_batch = value_sub_batches[eval_step]
-                    loss, _, _, _ = self.value_function_loss_on_batch(f_value_function, sub_batch, task_idx=test_task_idx, inner=True, target=vf_target)
-                    diff_value_opt.step(loss)
-
-                    # Soft update target value function parameters
-                    self.soft_update(f_value_function, vf_target)
-
-                    policy = deepcopy(self._adaptation_policy)
-                    policy_opt = O.SGD([{'params': p, 'lr': None} for p in policy.adaptation_parameters()])
-                    with higher.innerloop_ctx(policy, policy_opt, override={'lr': [F.softplus(l) for l in self._policy_lrs]}) as (f_policy, diff_policy_opt):
-                        for policy_step in range(eval_step + 1):
-                            #print(f'POLICY STEP {policy_step}')
-                            policy_sub_batch = policy_sub_batches[policy_step]
-                            loss, _, _, _ = self.adaptation_policy_loss_on_batch(f_policy, None, f_value_function, policy_sub_batch, test_task_idx, inner=True)
-                            diff_policy_opt.step(loss)
-
-                        adapted_trajectory, adapted_reward, success = self._rollout_policy(f_policy, self._env, sample_mode=True, render=self._args.render)
-                        trajectories.append(adapted_trajectory)
-                        rewards[i,eval_step+1] = adapted_reward
-                        successes.append(success)
-                        if self._args.eval:
-                            writer.add_scalar(f'Eval_Reward/Task_{test_task_idx}', adapted_reward, (eval_step + 1))
-                    del f_policy, diff_policy_opt
-
-            del f_value_function, diff_value_opt
+            for eval_step in range(self._maml_steps):
+                #print(f'VALUE STEP {eval_step}')
+                DEBUG(f'**************** EVAL STEP {eval_step} *******************', self._args.debug)
+                sub_batch = value_sub_batches[eval_step]
+                loss, _, _, _ = self.value_function_loss_on_batch(value_function, sub_batch, task_idx=test_task_idx, inner=True, target=vf_target)
+                self._inner_step_no_grad(value_function, loss, value_lrs)
+
+                # Soft update target value function parameters
+                self.soft_update(value_function, vf_target)
+
+                if self._args.eval_incremental:
+                    # Carry the adapted policy forward and take one new step against the current value function.
+                    # Cheaper (K instead of K(K+1)/2 policy steps), but earlier steps used earlier value functions,
+                    # so rewards differ from the default schedule for eval_step > 0
+                    policy_steps = [eval_step]
+                else:
+                    # Re-adapt from the meta-parameters, taking every policy step against the current value function
+                    self._load_params(policy, self._adaptation_policy)
+                    policy_steps = range(eval_step + 1)
+
+                for policy_step in policy_steps:
+                    #print(f'POLICY STEP {policy_step}')
+                    policy_sub_batch = policy_sub_batches[policy_step]
+                    loss, _, _, _ = self.adaptation_policy_loss_on_batch(policy, None, value_function, policy_sub_batch, test_task_idx, inner=True)
+                    self._inner_step_no_grad(policy, loss, policy_lrs)
+
+                adapted_trajectory, adapted_reward, success = self._rollout_policy(policy, self._env, sample_mode=True, render=self._args.render)
+                trajectories.append(adapted_trajectory)
+                rewards[i,eval_step+1] = adapted_reward
+                successes.append(success)
+                if self._args.eval:
+                    writer.add_scalar(f'Eval_Reward/Task_{test_task_idx}', adapted_reward, (eval_step + 1))
 
             writer.add_scalar(f'Eval_Reward/Task_{test_task_idx}', adapted_reward, train_step_idx)
             writer.add_scalar(f'Eval_Success/Task_{test_task_idx}', success, train_step_idx)
@@ -528,10 +783,202 @@ class MAMLRAWR(object):
             writer.add_scalar(f'Eval_Reward/Mean', rewards.mean(0)[self._maml_steps], train_step_idx)
         return trajectories, rewards[:,-1], np.array(successes)
 
+    def _rollout_task(self, policy: nn.Module, task_idx: int, rollout_idx: int):
+        '''
+        Roll out `policy` on task_idx using the env seed that per-task evaluation would
+        have used for this rollout, so the batched evals can roll out in any order.
+        '''
+        self._env.set_task_idx(task_idx)
+        self._rollout_counter = rollout_idx
+        return self._rollout_policy(policy, self._env, sample_mode=True, render=self._args.render)
+
+    def _sample_test_batches(self, batch_size: int) -> torch.tensor:
+        return torch.stack([torch.tensor(test_buffer.sample(batch_size), requires_grad=False)
+                            for test_buffer in self._test_buffers]).to(self._device)
+
+    def eval_multitask_batched(self, train_step_idx: int, writer: SummaryWriter):
+        '''
+        eval_multitask with the fine-tuning of all test tasks done as one task-batched
+        computation. Adam is elementwise, so one Adam over the stacked parameters takes
+        the same steps as one Adam per task.
+        '''
+        test_tasks = self.task_config.test_tasks
+        rewards = np.full((len(test_tasks), self._args.eval_maml_steps+1), float('nan'))
+        trajectories, successes = [[] for _ in test_tasks], [[] for _ in test_tasks]
+
+        log_steps = [1, 5, 20]
+        reward_dict = defaultdict(list)
+        success_dict = defaultdict(list)
+        rollouts_per_task = max(log_steps) + (1 if self._args.eval else 0)
+        first_rollout = self._rollout_counter
+
+        if self._args.eval:
+            for i, test_task_idx in enumerate(test_tasks):
+                adapted_trajectory, adapted_reward, success = self._rollout_task(self._adaptation_policy, test_task_idx, first_rollout + i * rollouts_per_task)
+                trajectories[i].append(adapted_trajectory)
+                rewards[i,0] = adapted_reward
+                successes[i].append(success)
+                writer.add_scalar(f'Eval_Reward/Task_{test_task_idx}', adapted_reward, 0)
+
+        task_idxs = [None for _ in test_tasks]
+        vf_params = batched.stack_parameters(self._value_function, len(test_tasks))
+        ap_params = batched.stack_parameters(self._adaptation_policy, len(test_tasks))
+        opt = O.Adam(vf_params, lr=self._args.inner_value_lr)
+        ap_opt = O.Adam(ap_params, lr=self._args.inner_policy_lr)
+        _, _, policy = self._eval_scratch_modules()
+        batch = self._sample_test_batches(self._args.eval_batch_size)
+        for step in range(max(log_steps)):
+            # Gradients are taken w.r.t. the stacked parameters only, so nothing accumulates into _adv_coef
+            vf_loss = batched.value_function_loss(self, self._value_function, vf_params, batch, task_idxs)
+            for param, grad in zip(vf_params, A.grad(vf_loss.sum(), vf_params)):
+                param.grad = grad
+            opt.step()
+            opt.zero_grad()
+
+            ap_loss = batched.adaptation_policy_loss(self, self._adaptation_policy, ap_params, self._value_function, vf_params, batch, task_idxs)
+            for param, grad in zip(ap_params, A.grad(ap_loss.sum(), ap_params)):
+                param.grad = grad
+            ap_opt.step()
+            ap_opt.zero_grad()
+
+            for i, test_task_idx in enumerate(test_tasks):
+                batched.load_parameters(policy, ap_params, i)
+                rollout_idx = first_rollout + i * rollouts_per_task + step + (1 if self._args.eval else 0)
+                adapted_trajectory, adapted_reward, success = self._rollout_task(policy, test_task_idx, rollout_idx)
+                if (step + 1) in log_steps:
+                    reward_dict[step+1].append(adapted_reward)
+                    success_dict[step+1].append(success)
+                    writer.add_scalar(f'FT_Eval_Reward/Task_{i}_Step{step}', adapted_reward, train_step_idx)
+                    writer.add_scalar(f'FT_Eval_Success/Task_{i}_Step{step}', int(success), train_step_idx)
+                if self._args.eval:
+                    rewards[i,step+1] = adapted_reward
+                    writer.add_scalar(f'Eval_Reward/Task_{test_task_idx}', adapted_reward, step + 1)
+                if step == max(log_steps) - 1:
+                    trajectories[i].append(adapted_trajectory)
+        self._rollout_counter = first_rollout + len(test_tasks) * rollouts_per_task
+
+        for s in log_steps:
+            writer.add_scalar(f'FT_Eval_Reward/Mean_Step{s}', np.mean(reward_dict[s]), train_step_idx)
+            writer.add_scalar(f'FT_Eval_Success/Mean_Step{s}', np.mean(success_dict[s]), train_step_idx)
+
+        if not self._args.eval:
+            rewards = np.array(reward_dict[log_steps[-1]])[:,None]
+        if self._args.eval:
+            for idx, r in enumerate(rewards.mean(0)):
+                writer.add_scalar(f'Eval_Reward/Mean', r, idx)
+        else:
+            writer.add_scalar(f'Eval_Reward/Mean', rewards.mean(0)[-1], train_step_idx)
+        return sum(trajectories, []), rewards[:,-1], np.array(sum(successes, []))
+
+    def eval_macaw_batched(self, train_step_idx: int, writer: SummaryWriter):
+        '''
+        eval_macaw with the adaptation of all test tasks done as one task-batched
+        computation per step (see src/batched.py), followed by the rollouts of every
+        task's adapted policy. Rollouts reuse the env seeds of the per-task order.
+        '''
+        test_tasks = self.task_config.test_tasks
+        rewards = np.full((len(test_tasks), self._args.eval_maml_steps+1), float('nan'))
+        trajectories, successes = [[] for _ in test_tasks], [[] for _ in test_tasks]
+        rollouts_per_task = self._maml_steps + (1 if self._args.eval else 0)
+        first_rollout = self._rollout_counter
+
+        if self._args.eval:
+            for i, test_task_idx in enumerate(test_tasks):
+                adapted_trajectory, adapted_reward, success = self._rollout_task(self._adaptation_policy, test_task_idx, first_rollout + i * rollouts_per_task)
+                trajectories[i].append(adapted_trajectory)
+                rewards[i,0] = adapted_reward
+                successes[i].append(success)
+                writer.add_scalar(f'Eval_Reward/Task_{test_task_idx}', adapted_reward, 0)
+
+        value_batch = self._sample_test_batches(self._args.eval_batch_size)
+        # (tasks, steps, batch, features): sub-batch k of every task, as in eval_macaw
+        sub_batches = value_batch.view(value_batch.shape[0], self._args.eval_maml_steps, value_batch.shape[1] // self._args.eval_maml_steps, *value_batch.shape[2:])
+
+        vf_params = batched.stack_parameters(self._value_function, len(test_tasks))
+        target_params = batched.stack_parameters(self._value_function, len(test_tasks), requires_grad=False)
+        policy_params = batched.stack_parameters(self._adaptation_policy, len(test_tasks))
+        _, _, policy = self._eval_scratch_modules()
+        with torch.no_grad():
+            value_lrs = [F.softplus(l) for l in self._value_lrs]
+            policy_lrs = [F.softplus(l) for l in self._policy_lrs]
+
+        for eval_step in range(self._maml_steps):
+            loss = batched.value_function_loss(self, self._value_function, vf_params, sub_batches[:,eval_step], test_tasks, target_params=target_params)
+            batched.inner_step(vf_params, loss, value_lrs)
+            batched.soft_update(vf_params, target_params, self._args.target_vf_alpha)
+
+            if self._args.eval_incremental:
+                policy_steps = [eval_step]
+            else:
+                batched.reset_parameters(policy_params, self._adaptation_policy)
+                policy_steps = range(eval_step + 1)
+
+            for policy_step in policy_steps:
+                loss = batched.adaptation_policy_loss(self, self._adaptation_policy, policy_params, self._value_function, vf_params,
+                                                      sub_batches[:,policy_step], test_tasks)
+                batched.inner_step(policy_params, loss, policy_lrs)
+
+            for i, test_task_idx in enumerate(test_tasks):
+                batched.load_parameters(policy, policy_params, i)
+                rollout_idx = first_rollout + i * rollouts_per_task + eval_step + (1 if self._args.eval else 0)
+                adapted_trajectory, adapted_reward, success = self._rollout_task(policy, test_task_idx, rollout_idx)
+                trajectories[i].append(adapted_trajectory)
+                rewards[i,eval_step+1] = adapted_reward
+                successes[i].append(success)
+                if self._args.eval:
+                    writer.add_scalar(f'Eval_Reward/Task_{test_task_idx}', adapted_reward, (eval_step + 1))
+        self._rollout_counter = first_rollout + len(test_tasks) * rollouts_per_task
+
+        for i, test_task_idx in enumerate(test_tasks):
+            writer.add_scalar(f'Eval_Reward/Task_{test_task_idx}', rewards[i,self._maml_steps], train_step_idx)
+            writer.add_scalar(f'Eval_Success/Task_{test_task_idx}', successes[i][-1], train_step_idx)
+        if self._args.eval:
+            for idx, r in enumerate(rewards.mean(0)):
+                writer.add_scalar(f'Eval_Reward/Mean', r, idx)
+        else:
+            writer.add_scalar(f'Eval_Reward/Mean', rewards.mean(0)[self._maml_steps], train_step_idx)
+        return sum(trajectories, []), rewards[:,-1], np.array(sum(successes, []))
+
+    def _eval_cache_key(self, train_step_idx: int) -> str:
+        tensors = itertools.chain(self._value_function.state_dict().values(), self._adaptation_policy.state_dict().values(),
+                                  self._value_lrs, self._policy_lrs, [self._adv_coef] if self._adv_coef is not None else [])
+        return EvalCache.key(hash_tensors(tensors), self.task_config, self.task_config.test_tasks, self._eval_seed,
+                             self._rollout_counter, hash_rng_state(get_rng_state()), train_step_idx, dict(vars(self._args), _maml_steps=self._maml_steps))
+
     def eval(self, train_step_idx: int, writer: SummaryWriter):
+        '''
+        With --eval_cache, offline evals of parameters that were already evaluated with
+        the same seed and args are read from the cache instead of rerun; the scalars
+        they logged are replayed to writer. Cached evals return no trajectories.
+        '''
+        if self._eval_cache is None or self._eval_seed is None:
+            return self._eval(train_step_idx, writer)
+
+        key = self._eval_cache_key(train_step_idx)
+        cached = self._eval_cache.get(key)
+        if cached is not None:
+            for tag, value, step in cached['scalars']:
+                writer.add_scalar(tag, value, step)
+            self._rollout_counter = cached['rollout_counter']
+            set_rng_state(cached['rng_state'])
+            trajectories, rewards, successes = [], cached['rewards'], cached['successes']
+        else:
+            tee = TeeWriter(writer)
+            trajectories, rewards, successes = self._eval(train_step_idx, tee)
+            self._eval_cache.put(key, rewards, successes, tee.scalars, self._rollout_counter, get_rng_state())
+
+        writer.add_scalar(f'EvalCache/Hits', self._eval_cache.hits, train_step_idx)
+        writer.add_scalar(f'EvalCache/Misses', self._eval_cache.misses, train_step_idx)
+        return trajectories, rewards, successes
+
+    def _eval(self, train_step_idx: int, writer: SummaryWriter):
         if self._args.multitask:
+            if self._args.batched_eval:
+                return self.eval_multitask_batched(train_step_idx, writer)
             return self.eval_multitask(train_step_idx, writer)
         else:
+            if self._args.batched_eval:
+                return self.eval_macaw_batched(train_step_idx, writer)
             return self.eval_macaw(train_step_idx, writer)
 
     # This function is the body of the main training loop [L4]
@@ -540,8 +987,17 @@ class MAMLRAWR(object):
     #  exploration policy
     #@profile
     def train_step(self, train_step_idx: int, writer: Optional[SummaryWriter] = None):
-        if train_step_idx % self._visualization_interval == 0:
-            test_rollouts, test_rewards, successes = self.eval(train_step_idx, writer)
+        evaluate = train_step_idx % self._visualization_interval == 0 and self._rank == 0
+        if evaluate and self._evaluator is not None:
+            # Evaluated in the background against the parameters as of this step
+            with self._timer.time('eval'):
+                self._evaluator.submit(train_step_idx)
+            test_rollouts = []
+            test_rewards = []
+            successes = []
+        elif evaluate:
+            with self._timer.time('eval'):
+                test_rollouts, test_rewards, successes = self.eval(train_step_idx, writer)
         else:
             test_rollouts = []
             test_rewards = []
@@ -559,23 +1015,32 @@ class MAMLRAWR(object):
         rollouts = []
         successes = []
         if self._args.task_batch_size is not None and len(self.task_config.train_tasks) > self._args.task_batch_size:
-            tasks = random.sample(self.task_config.train_tasks, self._args.task_batch_size)
+            if self._world_size == 1:
+                tasks = random.sample(self.task_config.train_tasks, self._args.task_batch_size)
+            else:
+                # Every rank has to draw the same meta-batch; each shard contributes its share
+                rng = random.Random(f'{self._args.seed}.{train_step_idx}')
+                tasks = distributed.stratified_sample(self._shards, self._args.task_batch_size, rng)
         else:
             tasks = self.task_config.train_tasks
 
         for i, (train_task_idx, inner_buffer, outer_buffer) in enumerate(zip(self.task_config.train_tasks, self._inner_buffers, self._outer_buffers)):
             DEBUG(f'**************** TASK IDX {train_task_idx} ***********', self._args.debug)
 
-            # Only train on the randomly selected tasks for this iteration
-            if train_task_idx not in tasks:
+            # Only train on the randomly selected tasks for this iteration, and of those only the ones this rank owns
+            if train_task_idx not in tasks or train_task_idx not in self._owned_tasks:
                 continue
             
             self._env.set_task_idx(train_task_idx)
 
             # Sample J training batches for independent adaptations [L7]
-            value_batch = torch.tensor(inner_buffer.sample(self._args.inner_batch_size, contiguous=self._args.contiguous), requires_grad=False).to(self._device)
+            self._timer.switch('sample')
+            value_batch = inner_buffer.sample(self._args.inner_batch_size, contiguous=self._args.contiguous)
+            meta_batch = outer_buffer.sample(self._args.batch_size)
+            self._timer.switch('to_device')
+            value_batch = torch.tensor(value_batch, requires_grad=False).to(self._device)
             policy_batch = value_batch
-            meta_batch = torch.tensor(outer_buffer.sample(self._args.batch_size), requires_grad=False).to(self._device)
+            meta_batch = torch.tensor(meta_batch, requires_grad=False).to(self._device)
             policy_meta_batch = meta_batch
 
             inner_q_losses = []
@@ -600,6 +1065,7 @@ class MAMLRAWR(object):
             # Adapt value function and collect meta-gradients
             ##################################################################################################
             if self._args.multitask:
+                self._timer.switch('outer_backward')
                 vf_target = self._value_function
                 meta_value_function_loss, value, mc, mc_std = self.value_function_loss_on_batch(self._value_function, meta_batch, task_idx=train_task_idx, target=vf_target)
                 total_vf_loss = meta_value_function_loss / len(self.task_config.train_tasks)
@@ -619,7 +1085,12 @@ class MAMLRAWR(object):
                 meta_policy_losses.append(meta_policy_loss.item())
                 
                 # Sample adapted policy trajectory, add to replay buffer i [L12]
-                if train_step_idx % self._gradient_steps_per_iteration == 0:
+                self._timer.switch('rollout')
+                if train_step_idx % self._gradient_steps_per_iteration == 0 and self._actors is not None:
+                    # Rolled out by an actor process; see _collect_actor_rollouts
+                    self._actors.submit(train_task_idx, value_batch)
+                    success = False
+                elif train_step_idx % self._gradient_steps_per_iteration == 0:
                     adapted_trajectory, adapted_reward, success = self._rollout_policy(self._adaptation_policy, self._env, sample_mode=self._args.offline)
                     train_rewards.append(adapted_reward)
                     successes.append(success)
@@ -631,6 +1102,7 @@ class MAMLRAWR(object):
                 else:
                     success = False
             else:
+                self._timer.switch('inner_value')
                 vf = self._value_function
                 vf.train()
                 vf_target = deepcopy(vf)
@@ -653,6 +1125,7 @@ class MAMLRAWR(object):
 
                     # Collect grads for the value function update in the outer loop [L14],
                     #  which is not actually performed here
+                    self._timer.switch('outer_backward')
                     meta_value_function_loss, value, mc, mc_std = self.value_function_loss_on_batch(f_value_function, meta_batch, task_idx=train_task_idx, target=vf_target)
                     total_vf_loss = meta_value_function_loss / len(self.task_config.train_tasks)
                     if self._args.value_reg > 0:
@@ -668,6 +1141,7 @@ class MAMLRAWR(object):
                     ##################################################################################################
                     # Adapt policy and collect meta-gradients
                     ##################################################################################################
+                    self._timer.switch('inner_policy')
                     adapted_value_function = f_value_function
                     adapted_q_function = q_functions[-1] if self._args.q else None
                     opt = O.SGD([{'params': p, 'lr': None} for p in self._adaptation_policy.adaptation_parameters()])
@@ -687,6 +1161,7 @@ class MAMLRAWR(object):
                                 inner_advantages.append(adv.item())
                                 inner_weights.append(weights.mean().item())
 
+                        self._timer.switch('outer_backward')
                         meta_policy_loss, outer_adv, outer_weights_, _ = self.adaptation_policy_loss_on_batch(f_adaptation_policy, adapted_q_function,
                                                                                                             adapted_value_function, policy_meta_batch, train_task_idx)
                         (meta_policy_loss / len(self.task_config.train_tasks)).backward()
@@ -697,7 +1172,12 @@ class MAMLRAWR(object):
                         ##################################################################################################
 
                         # Sample adapted policy trajectory, add to replay buffer i [L12]
-                        if train_step_idx % self._gradient_steps_per_iteration == 0:
+                        self._timer.switch('rollout')
+                        if train_step_idx % self._gradient_steps_per_iteration == 0 and self._actors is not None:
+                            # Adapted and rolled out by an actor process; see _collect_actor_rollouts
+                            self._actors.submit(train_task_idx, value_batch)
+                            success = False
+                        elif train_step_idx % self._gradient_steps_per_iteration == 0:
                             adapted_trajectory, adapted_reward, success = self._rollout_policy(f_adaptation_policy, self._env, sample_mode=self._args.offline)
                             train_rewards.append(adapted_reward)
                             successes.append(success)
@@ -714,6 +1194,7 @@ class MAMLRAWR(object):
                         else:
                             success = False
 
+            self._timer.switch('logging')
             if train_step_idx % self._gradient_steps_per_iteration == 0:
                 if len(inner_value_losses):
                     if self._args.q:
@@ -742,15 +1223,20 @@ class MAMLRAWR(object):
                 writer.add_histogram(f'Outer_Weights/Task_{train_task_idx}', outer_weights_, train_step_idx)
                 #if train_step_idx % self._visualization_interval == 0:
                 #    writer.add_scalar(f'Reward_Test/Task_{train_task_idx}', test_reward, train_step_idx)
-                writer.add_scalar(f'Success_Train/Task_{train_task_idx}', int(success), train_step_idx)
-                if train_step_idx % self._gradient_steps_per_iteration == 0:
+                if self._actors is None:
+                    writer.add_scalar(f'Success_Train/Task_{train_task_idx}', int(success), train_step_idx)
                     writer.add_scalar(f'Reward_Train/Task_{train_task_idx}', adapted_reward, train_step_idx)
                     writer.add_scalar(f'Success_Train/Task_{train_task_idx}', np.mean(success), train_step_idx)
 
         if self._args.advantage_head_coef is not None:
             writer.add_scalar(f'Adv_Coef', F.softplus(self._adv_coef).item(), train_step_idx)
 
+        if self._world_size > 1:
+            self._timer.switch('all_reduce')
+            distributed.all_reduce_grads(self._synced_parameters())
+
         # Meta-update value function [L14]
+        self._timer.switch('optimizer')
         grad = self.update_model(self._value_function, self._value_function_optimizer, clip=self._grad_clip)
         writer.add_scalar(f'Value_Outer_Grad', grad, train_step_idx)
 
@@ -768,11 +1254,57 @@ class MAMLRAWR(object):
             self.update_params(self._policy_lrs, self._policy_lr_optimizer)
             if self._args.advantage_head_coef is not None:
                 self.update_params([self._adv_coef], self._adv_coef_optimizer)
+
+        if self._actors is not None:
+            self._timer.switch('actors')
+            if train_step_idx % self._args.actor_sync_interval == 0:
+                self._actors.publish()
+            train_rewards, successes = self._collect_actor_rollouts(train_step_idx, writer)
             
         return rollouts, test_rewards, train_rewards, meta_value_losses, meta_policy_losses, None, successes
 
+    def _collect_actor_rollouts(self, train_step_idx: int, writer: SummaryWriter):
+        '''
+        Add every trajectory the actors have finished since the last call to the
+        buffers of its task. Staleness is the number of parameter snapshots the
+        learner has published since the one the actor adapted from.
+        '''
+        rewards, successes, staleness = [], [], []
+        for task_idx, stale, trajectory, reward, success in self._actors.drain():
+            i = self._train_task_positions[task_idx]
+            if not (self._args.offline or self._args.offline_inner):
+                self._inner_buffers[i].add_trajectory(trajectory)
+            if not (self._args.offline or self._args.offline_outer):
+                self._outer_buffers[i].add_trajectory(trajectory)
+
+            rewards.append(reward)
+            successes.append(success)
+            staleness.append(stale)
+            writer.add_scalar(f'Reward_Train/Task_{task_idx}', reward, train_step_idx)
+            writer.add_scalar(f'Success_Train/Task_{task_idx}', int(success), train_step_idx)
+
+        if len(staleness):
+            writer.add_scalar(f'Actor/Staleness', np.mean(staleness), train_step_idx)
+            writer.add_scalar(f'Actor/Staleness_Max', np.max(staleness), train_step_idx)
+        writer.add_scalar(f'Actor/Trajectories', len(rewards), train_step_idx)
+        writer.add_scalar(f'Actor/Dropped_Requests', self._actors.dropped, train_step_idx)
+        if train_step_idx > 0 and train_step_idx % 100 == 0:
+            writer.add_scalar(f'Learner/Steps_Per_Sec', self._actors.learner_steps_per_sec(train_step_idx), train_step_idx)
+
+        return rewards, successes
+
+    def _log_async_eval(self, results, train_step_idx: int, writer: SummaryWriter):
+        for step, test_rewards, successes in results:
+            print_('', self._silent)
+            print_(f'Step {step} Rewards (evaluated in background, now at step {train_step_idx}):', self._silent)
+            for idx, r in enumerate(test_rewards):
+                print_(f'Task {self.task_config.test_tasks[idx]}: {r}', self._silent)
+            print_(f'MEAN TEST REWARD: {np.mean(test_rewards)}', self._silent)
+            writer.add_scalar(f'Eval/Lag_Steps', train_step_idx - step, step)
+            writer.add_scalar(f'Eval/Blocked_Time', self._evaluator.blocked_time, train_step_idx)
+
     #@profile
-    def train(self):
+    def _create_log_dir(self) -> str:
         log_path = f'{self._log_dir}/{self._name}'
         print('*******************************************************')
         print('*******************************************************')
@@ -796,13 +1328,36 @@ class MAMLRAWR(object):
             json.dump(self._args.__dict__, args_file, indent=4, sort_keys=True)
         with open(f'{log_path}/tasks.pkl', 'wb') as tasks_file:
             pickle.dump(self._env.tasks, tasks_file)
+        return log_path
+
+    def _train_follower(self):
+        '''The training loop of ranks other than 0 in data-parallel training: train_step only, with nothing logged or saved.'''
+        start_t = self.load_resume(self._args.resume) + 1 if self._args.resume is not None else 0
+        writer = NullWriter()
+        for t in range(start_t, self._training_iterations):
+            self._timer.switch('step')
+            self.train_step(t, writer)
+        self._timer.stop()
+
+    def train(self):
+        if self._rank > 0:
+            return self._train_follower()
+
+        if self._args.resume is not None:
+            log_path = self._args.resume
+            start_t = self.load_resume(log_path) + 1
+            print(f'Resuming {log_path} at step {start_t}')
+        else:
+            log_path = self._create_log_dir()
+            start_t = 0
+
         tensorboard_log_path = f'{log_path}/tb'
         if not os.path.exists(tensorboard_log_path):
             os.makedirs(tensorboard_log_path)
-        summary_writer = SummaryWriter(tensorboard_log_path)
+        checkpoint_writer = CheckpointWriter()
 
         # Gather initial trajectory rollouts
-        if not self._args.load_inner_buffer or not self._args.load_outer_buffer:
+        if start_t == 0 and (not self._args.load_inner_buffer or not self._args.load_outer_buffer):
             behavior_policy = self._exploration_policy if self._args.sample_exploration_inner else self._adaptation_policy
             exploration_rewards = np.zeros((self._args.initial_rollouts, len(self._env.tasks)))
             print('Gathering training task trajectories...')
@@ -837,11 +1392,47 @@ class MAMLRAWR(object):
             DEBUG(f'Mean exploration rewards: {exploration_rewards.mean(0)}', self._args.debug and not self._silent)
             DEBUG(f'Positive exploration rewards: {(exploration_rewards>0).mean(0)}', self._args.debug and not self._silent)
 
+        if self._args.async_eval and not self._args.eval:
+            self._evaluator = AsyncEvaluator(self, tensorboard_log_path, self._args.async_eval_jobs,
+                                             store_path=None if self._args.no_metrics_store else f'{log_path}/metrics.db')
+
+        if self._args.actors > 0:
+            print_(f'Starting {self._args.actors} actor processes', self._silent)
+            self._actors = ActorPool(self, self._args.actors, self._args.actor_queue_size)
+
+        # Created only after the eval workers and actors are forked, so that no child inherits
+        # their threads or the sqlite connection. Events logged after the checkpoint by the
+        # interrupted run are discarded
+        purge_step = start_t if start_t > 0 else None
+        store = None if self._args.no_metrics_store else StoreWriter(f'{log_path}/metrics.db', os.path.basename(log_path), purge_step=purge_step)
+        summary_writer = MetricsWriter(SummaryWriter(tensorboard_log_path, purge_step=purge_step),
+                                       self._args.log_interval, self._args.histogram_interval, store=store)
+
+        prof = None
+        if self._args.torch_profile:
+            prof = torch_profiler(f'{log_path}/profiler', self._args.torch_profile_start, self._args.torch_profile_steps,
+                                  self._args.torch_profile_every, offset=start_t, cuda=self._device.type == 'cuda')
+            prof.start()
+            self._timer.annotate = True
+
+        memory_peaks = None
+        if self._args.memory_interval > 0:
+            print_(f'\n{format_rows(model_rows(self))}', self._silent)
+            memory_peaks = PhasePeaks(cuda=self._device.type == 'cuda')
+
         rewards = []
         successes = []
         reward_count = 0
-        for t in range(self._training_iterations):
+        # The last completed step, also when resuming a run that has no steps left
+        t = start_t - 1
+        for t in range(start_t, self._training_iterations):
+            if memory_peaks is not None and t % self._args.memory_interval == 0:
+                self._timer.hooks.append(memory_peaks)
+            self._timer.switch('step')
             rollouts, test_rewards, train_rewards, value, policy, vfs, success = self.train_step(t, summary_writer)
+            self._timer.switch('logging')
+            if self._evaluator is not None:
+                self._log_async_eval(self._evaluator.poll(), t, summary_writer)
 
             if not self._silent:
                 if len(test_rewards):
@@ -891,26 +1482,82 @@ class MAMLRAWR(object):
                 except Exception as e:
                     pass
                 
-            if t % 1000 == 0:
+            if t % self._args.checkpoint_interval == 0:
+                self._timer.switch('checkpoint')
+                start = time.time()
+                # The mutable buffers are saved incrementally (see NewReplayBuffer.delta) to two
+                # directories in turn, and archive_LATEST.pt only points to one once it is written,
+                # so an interrupted write never pairs an archive with buffers from a different step.
+                # Only the rows added since a directory was last written are sliced out here and sent
+                # to the writer; delta reads the files' headers, so the previous checkpoint must be written
+                checkpoint_writer.wait()
+                buffer_dir = 'buffers_1' if self._buffer_dir == 'buffers_0' else 'buffers_0'
                 archive = {
                     'vf': self._value_function.state_dict(),
                     'vf_opt': self._value_function_optimizer.state_dict(),
                     'policy': self._adaptation_policy.state_dict(),
                     'policy_opt': self._adaptation_policy_optimizer.state_dict(),
                     'vf_lrs': self._value_lrs,
-                    'policy_lrs': self._policy_lrs
+                    'policy_lrs': self._policy_lrs,
+                    'resume': self.resume_state(t, buffer_dir)
                 }
                 if self._args.advantage_head_coef is not None:
                     archive['adv_coef'] = self._adv_coef
-
-                torch.save(archive, f'{log_path}/archive_LATEST.pt')
+                archive = to_cpu(archive)
+
+                jobs = []
+                if len(self._mutable_buffers()):
+                    jobs.append((os.makedirs, (f'{log_path}/{buffer_dir}', 0o777, True)))
+                for name, buffer in self._mutable_buffers():
+                    path = f'{log_path}/{buffer_dir}/{name}'
+                    jobs.append((write_delta, (buffer.delta(path), path)))
                 if t % 10000 == 0:
-                    torch.save(archive, f'{log_path}/archive_{t}.pt')
+                    jobs.append((save_archive, (archive, f'{log_path}/archive_{t}.pt')))
+                jobs.append((save_archive, (archive, f'{log_path}/archive_LATEST.pt')))
 
                 if self._args.save_buffers:
+                    # The saved buffers link to the resume buffers just written, so they are not written twice
                     for i, (inner_buffer, outer_buffer) in enumerate(zip(self._inner_buffers, self._outer_buffers)):
-                        print(f'{log_path}/outer_buffer_{i}.h5')
-                        inner_buffer.save(f'{log_path}/inner_buffer_{i}.h5')
-                        outer_buffer.save(f'{log_path}/outer_buffer_{i}.h5')
+                        # Immutable buffers are their offline files
+                        if inner_buffer is not None and not inner_buffer.immutable:
+                            jobs.append((atomic_symlink, (f'{buffer_dir}/inner_buffer_{i}.h5', f'{log_path}/inner_buffer_{i}.h5')))
+                        if outer_buffer is not None and not outer_buffer.immutable:
+                            name = f'inner_buffer_{i}.h5' if outer_buffer is inner_buffer else f'outer_buffer_{i}.h5'
+                            jobs.append((atomic_symlink, (f'{buffer_dir}/{name}', f'{log_path}/outer_buffer_{i}.h5')))
                         #full_buffer.save(f'{log_path}/full_buffer_{i}.h5')
-                    
+
+                if self._args.sync_checkpoints:
+                    for fn, fn_args in jobs:
+                        fn(*fn_args)
+                else:
+                    checkpoint_writer.write(jobs, name=f'checkpoint_{t}')
+                self._buffer_dir = buffer_dir
+                summary_writer.add_scalar(f'Checkpoint/Stall_Time', time.time() - start, t)
+                self._timer.dump(f'{log_path}/phase_times.json', t + 1 - start_t)
+
+            if memory_peaks in self._timer.hooks:
+                # Closes the peak of the last phase of this step
+                self._timer.switch(self._timer.phase)
+                self._timer.hooks.remove(memory_peaks)
+                memory_peaks.log(summary_writer, t)
+                log_rows(summary_writer, model_rows(self), t)
+
+            if (t + 1) % self._args.log_interval == 0:
+                self._timer.log(summary_writer, t, self._args.log_interval)
+
+            if prof is not None:
+                prof.step()
+
+        self._timer.stop()
+        if prof is not None:
+            prof.stop()
+            self._timer.annotate = False
+        self._timer.dump(f'{log_path}/phase_times.json', t + 1 - start_t)
+        checkpoint_writer.close()
+        if self._actors is not None:
+            self._actors.close()
+            self._actors = None
+        if self._evaluator is not None:
+            self._log_async_eval(self._evaluator.close(), t, summary_writer)
+            self._evaluator = None
+        summary_writer.close()
@@ -0,0 +1,295 @@
+#
+# Memory accounting for MAMLRAWR. model_rows() breaks down what the trainer holds:
+# every replay buffer field (RAM arrays, or memmaps with the part of them that is
+# actually resident), the networks with their gradients and optimizer state, and
+# the env seed table. PhasePeaks is a PhaseTimer hook that records the peak memory
+# of each phase of a training iteration. predict_rows() gives the same breakdown
+# from the args and task config before anything is loaded (run.py --memory_dry_run).
+#
+import os
+from collections import OrderedDict, defaultdict
+from typing import Dict, List, Optional, Tuple
+
+import h5py
+import numpy as np
+import torch
+import torch.nn as nn
+
+from src.columnar import Columns, is_columnar
+from src.nn import MLP
+
+
+MB = 2 ** 20
+
+# (component, bytes, resident bytes, where: 'ram', 'memmap' or 'cuda')
+Row = Tuple[str, int, int, str]
+
+
+def proc_status() -> Dict[str, int]:
+    '''The Vm* entries of /proc/self/status (VmRSS, VmHWM, ...) in bytes; empty where there is no /proc.'''
+    status = {}
+    try:
+        with open('/proc/self/status', 'r') as f:
+            for line in f:
+                if line.startswith('Vm'):
+                    key, value = line.split(':', 1)
+                    status[key] = int(value.split()[0]) * 1024
+    except OSError:
+        pass
+    return status
+
+
+def reset_peak_rss():
+    '''Reset VmHWM (the peak RSS) to the current RSS, so it measures the peak from here on.'''
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except OSError:
+        pass
+
+
+def mapped_rss() -> Dict[str, int]:
+    '''Resident bytes of every file mapped into this process, from /proc/self/smaps.'''
+    rss = defaultdict(int)
+    path = None
+    try:
+        with open('/proc/self/smaps', 'r') as f:
+            for line in f:
+                fields = line.split()
+                if not fields[0].endswith(':'):
+                    # A mapping header: address range, perms, offset, device, inode[, path]
+                    path = fields[5] if len(fields) > 5 else None
+                elif fields[0] == 'Rss:' and path is not None:
+                    rss[path] += int(fields[1]) * 1024
+    except OSError:
+        pass
+    return rss
+
+
+def tensor_bytes(tensors) -> int:
+    return sum(t.numel() * t.element_size() for t in tensors if t is not None)
+
+
+def _where(tensors) -> str:
+    return 'cuda' if any(t.is_cuda for t in tensors) else 'ram'
+
+
+def buffer_rows(name: str, buffers: list, mapped: Dict[str, int]) -> List[Row]:
+    '''One row per field, summed over a list of NewReplayBuffers.'''
+    fields = OrderedDict()
+    for buffer in buffers:
+        if buffer is None:
+            # A train buffer of a task another rank owns (--shard_buffers)
+            continue
+        for field, array in buffer._datasets().items():
+            nbytes, resident, where = fields.get(field, (0, 0, 'ram'))
+            if isinstance(array, np.memmap):
+                resident += mapped.get(os.path.realpath(array.filename), 0)
+                where = 'memmap'
+            else:
+                # Buffers are allocated with np.full, so every page has been touched
+                resident += array.nbytes
+            fields[field] = (nbytes + array.nbytes, resident, where)
+    return [(f'{name}/{field}', nbytes, resident, where) for field, (nbytes, resident, where) in fields.items()]
+
+
+def module_rows(name: str, module: nn.Module, optimizer: Optional[torch.optim.Optimizer] = None) -> List[Row]:
+    params = list(module.parameters())
+    where = _where(params)
+    rows = [(f'{name}/params', tensor_bytes(params), tensor_bytes(params), where)]
+    grads = tensor_bytes(p.grad for p in params)
+    rows.append((f'{name}/grads', grads, grads, where))
+    if optimizer is not None:
+        state = tensor_bytes(v for s in optimizer.state.values() for v in s.values() if isinstance(v, torch.Tensor))
+        rows.append((f'{name}/optimizer', state, state, where))
+    return rows
+
+
+def model_rows(model) -> List[Row]:
+    '''The memory held by a MAMLRAWR instance, by component.'''
+    rows = []
+    rows += module_rows('policy', model._adaptation_policy, model._adaptation_policy_optimizer)
+    rows += module_rows('value_function', model._value_function, model._value_function_optimizer)
+    rows += module_rows('q_function', model._q_function, model._q_function_optimizer)
+    if model._exploration_policy is not None:
+        rows += module_rows('exploration_policy', model._exploration_policy, getattr(model, '_exploration_policy_optimizer', None))
+    lrs = nn.ParameterList(model._policy_lrs + model._value_lrs + ([model._adv_coef] if model._adv_coef is not None else []))
+    rows += module_rows('lrs', lrs)
+    if model._eval_scratch is not None:
+        rows += module_rows('eval_scratch', nn.ModuleList(model._eval_scratch))
+
+    mapped = mapped_rss()
+    rows += buffer_rows('inner_buffers', model._inner_buffers, mapped)
+    if model._outer_buffers is not model._inner_buffers:
+        rows += buffer_rows('outer_buffers', model._outer_buffers, mapped)
+    rows += buffer_rows('test_buffers', model._test_buffers, mapped)
+    rows.append(('env_seeds', model._env_seeds.nbytes, model._env_seeds.nbytes, 'ram'))
+    return rows
+
+
+def format_rows(rows: List[Row], title: str = 'Memory') -> str:
+    width = max([len(r[0]) for r in rows] + [len(title)])
+    lines = [f'{title:<{width}} {"MB":>10} {"resident MB":>12}  where']
+    totals = defaultdict(lambda: [0, 0])
+    for component, nbytes, resident, where in rows:
+        lines.append(f'{component:<{width}} {nbytes / MB:>10.1f} {resident / MB:>12.1f}  {where}')
+        totals[where][0] += nbytes
+        totals[where][1] += resident
+    for where, (nbytes, resident) in sorted(totals.items()):
+        lines.append(f'{"total " + where:<{width}} {nbytes / MB:>10.1f} {resident / MB:>12.1f}')
+    status = proc_status()
+    if 'VmRSS' in status:
+        lines.append(f'{"process rss (peak)":<{width}} {status["VmRSS"] / MB:>10.1f} {status["VmHWM"] / MB:>12.1f}')
+    if torch.cuda.is_available() and torch.cuda.is_initialized():
+        lines.append(f'{"cuda allocated (reserved)":<{width}} {torch.cuda.memory_allocated() / MB:>10.1f} '
+                     f'{torch.cuda.memory_reserved() / MB:>12.1f}')
+    return '\n'.join(lines)
+
+
+def log_rows(writer, rows: List[Row], step: int):
+    '''Write the totals per group of components (policy, inner_buffers, ...) and the process RSS, in MB.'''
+    groups = defaultdict(int)
+    for component, _, resident, _ in rows:
+        groups[component.split('/')[0]] += resident
+    for group, resident in groups.items():
+        writer.add_scalar(f'Memory/{group}', resident / MB, step)
+    status = proc_status()
+    if 'VmRSS' in status:
+        writer.add_scalar('Memory/process_rss', status['VmRSS'] / MB, step)
+    if torch.cuda.is_available() and torch.cuda.is_initialized():
+        writer.add_scalar('Memory/cuda_allocated', torch.cuda.memory_allocated() / MB, step)
+
+
+class PhasePeaks(object):
+    '''
+    A PhaseTimer hook that records the peak memory of every phase: the process's
+    peak RSS (VmHWM, which is reset at each phase switch) and, on cuda, the peak
+    allocated by torch's caching allocator. Reading and resetting the peaks costs
+    tens of microseconds per switch, so the hook is only installed for sampled steps.
+    '''
+    def __init__(self, cuda: bool = False):
+        self._cuda = cuda
+        self.peaks = defaultdict(int)
+        self.cuda_peaks = defaultdict(int)
+
+    def __call__(self, phase: Optional[str], next_phase: Optional[str]):
+        if phase is not None:
+            self.peaks[phase] = max(self.peaks[phase], proc_status().get('VmHWM', 0))
+            if self._cuda:
+                self.cuda_peaks[phase] = max(self.cuda_peaks[phase], torch.cuda.max_memory_allocated())
+        reset_peak_rss()
+        if self._cuda:
+            torch.cuda.reset_peak_memory_stats()
+
+    def log(self, writer, step: int):
+        '''Write (and reset) the peak of each phase since the last call, in MB.'''
+        for phase, peak in self.peaks.items():
+            writer.add_scalar(f'Memory_Peak/{phase}', peak / MB, step)
+        for phase, peak in self.cuda_peaks.items():
+            writer.add_scalar(f'Memory_Peak_CUDA/{phase}', peak / MB, step)
+        self.peaks.clear()
+        self.cuda_peaks.clear()
+
+
+def buffer_steps(size: int, skip: int, load_from: Optional[str]) -> int:
+    # Mirrors the sizing in NewReplayBuffer.__init__; only the file's metadata is read
+    if size == -1:
+        if load_from is None:
+            size = 1000000
+        elif is_columnar(load_from):
+            size = Columns(load_from).manifest['rows']
+        else:
+            with h5py.File(load_from, 'r') as f:
+                size = f['obs'].shape[0]
+    return size // skip
+
+
+def _predicted_buffer_rows(name: str, steps: List[int], obs_dim: int, action_dim: int, where: str) -> List[Row]:
+    widths = OrderedDict([('obs', obs_dim), ('actions', action_dim), ('rewards', 1), ('mc_rewards', 1), ('terminals', 1),
+                          ('terminal_obs', obs_dim), ('terminal_discounts', 1), ('next_obs', obs_dim)])
+    rows = []
+    for field, width in widths.items():
+        itemsize = 1 if field == 'terminals' else 4
+        nbytes = sum(steps) * width * itemsize
+        rows.append((f'{name}/{field}', nbytes, nbytes if where == 'ram' else 0, where))
+    return rows
+
+
+def predict_rows(args, task_config, env) -> List[Row]:
+    '''
+    The breakdown model_rows() would give for a MAMLRAWR built from these args,
+    task config and env, without allocating buffers or touching the devices. The
+    networks are built on the cpu to count parameters; the adaptation graph of one
+    task (fast weights plus saved activations, freed after that task's backward) is
+    a rough estimate.
+    '''
+    where = 'cuda' if args.device.startswith('cuda') else 'ram'
+    goal_dim = task_config.total_tasks if args.multitask else 0
+    obs_dim = env.observation_space.shape[0] + (args.trim_obs if args.trim_obs else 0) - goal_dim
+    action_space = env.action_space.shape
+    action_dim = action_space[0] if len(action_space) > 0 else 1
+
+    def mlp(widths, **kwargs):
+        return MLP(widths, bias_linear=not args.no_bias_linear, w_linear=args.wlinear, **kwargs)
+
+    hidden = [args.net_width] * args.net_depth
+    policy = mlp([obs_dim + goal_dim] + hidden + [action_dim],
+                 extra_head_layers=[32, 1] if args.advantage_head_coef is not None else None)
+    networks = [('policy', policy), ('value_function', mlp([obs_dim + goal_dim] + hidden + [1])),
+                ('q_function', mlp([obs_dim + goal_dim + action_dim] + hidden + [1]))]
+
+    rows = []
+    for name, network in networks:
+        nbytes = tensor_bytes(network.parameters())
+        # Parameters, gradients and Adam's two moments
+        for part, size in (('params', nbytes), ('grads', nbytes), ('optimizer', 2 * nbytes)):
+            rows.append((f'{name}/{part}', size, size, where))
+    n_lrs = len(list(policy.adaptation_parameters())) + len(list(networks[1][1].adaptation_parameters()))
+    rows.append(('lrs/params', 4 * n_lrs, 4 * n_lrs, where))
+    rows.append(('lrs/grads', 4 * n_lrs, 4 * n_lrs, where))
+    policy_bytes, vf_bytes = tensor_bytes(policy.parameters()), tensor_bytes(networks[1][1].parameters())
+    rows.append(('eval_scratch/params', 2 * vf_bytes + policy_bytes, 2 * vf_bytes + policy_bytes, where))
+    # A set of fast weights per inner step, plus each layer's pre- and post-activation for
+    # the value function, target and policy forward passes on the inner and outer batches
+    rows_per_step = args.inner_batch_size + args.batch_size
+    activations = 3 * 2 * 4 * rows_per_step * (args.net_width * args.net_depth + obs_dim + action_dim)
+    graph = (args.maml_steps + 1) * (policy_bytes + vf_bytes + activations)
+    rows.append(('adaptation_graph (est.)', graph, graph, where))
+
+    has_train_buffers = hasattr(task_config, 'train_buffer_paths') and not args.eval
+    has_test_buffers = hasattr(task_config, 'test_buffer_paths')
+    paths = lambda template, tasks, load: [template.format(idx) if load else None for idx in tasks]
+    inner_paths = paths(getattr(task_config, 'train_buffer_paths', ''), task_config.train_tasks,
+                        has_train_buffers and args.load_inner_buffer)
+    outer_paths = paths(getattr(task_config, 'train_buffer_paths', ''), task_config.train_tasks,
+                        has_train_buffers and args.load_outer_buffer)
+    test_paths = paths(getattr(task_config, 'test_buffer_paths', ''), task_config.test_tasks,
+                       has_test_buffers and args.load_inner_buffer)
+    if args.shard_buffers and args.ranks > 1:
+        # Per rank: the train buffers of the largest shard
+        from src.distributed import task_shards
+        shard = max(task_shards(args, task_config, args.ranks), key=lambda tasks: sum(
+            buffer_steps(args.inner_buffer_size, args.inner_buffer_skip, inner_paths[task_config.train_tasks.index(t)]) for t in tasks))
+        owned = [task in shard for task in task_config.train_tasks]
+        inner_paths = [p for p, o in zip(inner_paths, owned) if o]
+        outer_paths = [p for p, o in zip(outer_paths, owned) if o]
+
+    def buffer_where(paths, immutable):
+        # Immutable buffers loaded from columnar directories map the columns instead of copying them
+        mapped = immutable and len(paths) > 0 and all(p is not None and is_columnar(p) for p in paths)
+        return 'memmap' if args.from_disk or mapped else 'ram'
+
+    rows += _predicted_buffer_rows('inner_buffers', [buffer_steps(args.inner_buffer_size, args.inner_buffer_skip, p)
+                                                     for p in inner_paths], obs_dim, action_dim,
+                                   buffer_where(inner_paths, args.offline or args.offline_inner))
+    shared = (args.offline and args.load_inner_buffer and args.load_outer_buffer and args.replay_buffer_size == args.inner_buffer_size
+              and args.buffer_skip == args.inner_buffer_skip and args.buffer_mode == 'end')
+    if not shared:
+        rows += _predicted_buffer_rows('outer_buffers', [buffer_steps(args.replay_buffer_size, args.buffer_skip, p)
+                                                         for p in outer_paths], obs_dim, action_dim,
+                                       buffer_where(outer_paths, args.offline or args.offline_outer))
+    rows += _predicted_buffer_rows('test_buffers', [buffer_steps(args.inner_buffer_size, args.inner_buffer_skip, p)
+                                                    for p in test_paths], obs_dim, action_dim,
+                                   buffer_where(test_paths, True))
+    rows.append(('env_seeds', 8 * int(1e7), 8 * int(1e7), 'ram'))
+    return rows
@@ -0,0 +1,103 @@
+#
+# A SummaryWriter front end for the training loop. train_step logs a dozen scalars
+# and a few histograms per task per iteration; here scalars are averaged in memory
+# and written once every `interval` steps, histograms are only kept every
+# `histogram_interval` steps, and building and writing the events (including the
+# histogram binning) happens on a background thread. Scalars can also be written to
+# a MetricsStore (see src/metrics_store.py) by the same thread.
+#
+import queue
+import threading
+from collections import OrderedDict
+from typing import Tuple
+
+import numpy as np
+import torch
+
+
+def _to_numpy(value) -> np.ndarray:
+    if isinstance(value, torch.Tensor):
+        return value.detach().cpu().numpy()
+    return np.array(value, copy=True)
+
+
+class MetricsWriter(object):
+    '''
+    Drop-in replacement for the SummaryWriter passed to train_step. Every scalar is
+    averaged over the steps of a window of `interval` steps and written at the last
+    step it was logged in that window. Tags starting with one of `exact_prefixes`
+    (evaluation results and stats, which are logged rarely or at past or adaptation-step
+    indices) are written unaggregated. Every scalar written is also passed to `store`,
+    if given.
+    '''
+    def __init__(self, writer, interval: int = 1, histogram_interval: int = 1,
+                 exact_prefixes: Tuple[str, ...] = ('Eval_', 'Eval/', 'FT_Eval_', 'Reward_Test'), max_queue: int = 10000,
+                 store=None):
+        self._writer = writer
+        self._store = store
+        self._interval = interval
+        self._histogram_interval = histogram_interval
+        self._exact_prefixes = exact_prefixes
+        self._window = None
+        self._scalars = OrderedDict()
+        self._queue = queue.Queue(max_queue)
+        self._thread = threading.Thread(target=self._write_loop, name='metrics_writer', daemon=True)
+        self._thread.start()
+
+    def _write_loop(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                break
+            if isinstance(item, threading.Event):
+                item.set()
+                continue
+            name, args, kwargs = item
+            getattr(self._writer, name)(*args, **kwargs)
+            if self._store is not None and name in ('add_scalar', 'flush'):
+                getattr(self._store, name)(*args, **kwargs)
+
+    def _flush_window(self):
+        for tag, (total, count, step) in self._scalars.items():
+            self._queue.put(('add_scalar', (tag, total / count, step), {}))
+        self._scalars.clear()
+
+    def add_scalar(self, tag: str, value, step: int):
+        value = value.item() if isinstance(value, torch.Tensor) else float(value)
+        if self._interval <= 1 or tag.startswith(self._exact_prefixes):
+            self._queue.put(('add_scalar', (tag, value, step), {}))
+            return
+
+        window = step // self._interval
+        if window != self._window:
+            self._flush_window()
+            self._window = window
+
+        total, count, _ = self._scalars.get(tag, (0., 0, step))
+        self._scalars[tag] = (total + value, count + 1, step)
+
+    def add_histogram(self, tag: str, values, step: int, **kwargs):
+        if step % self._histogram_interval == 0:
+            self._queue.put(('add_histogram', (tag, _to_numpy(values), step), kwargs))
+
+    def __getattr__(self, name):
+        # Anything else (add_image, add_text, ...) is forwarded as is, in order with the logged metrics
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return lambda *args, **kwargs: self._queue.put((name, args, kwargs))
+
+    def flush(self):
+        '''Write the current window and wait until everything logged so far is in the event file.'''
+        self._flush_window()
+        done = threading.Event()
+        self._queue.put(('flush', (), {}))
+        self._queue.put(done)
+        done.wait()
+
+    def close(self):
+        self._flush_window()
+        self._queue.put(None)
+        self._thread.join()
+        self._writer.close()
+        if self._store is not None:
+            self._store.close()
@@ -0,0 +1,277 @@
+#
+# An indexed SQLite store of training scalars, so that plots query the values of a
+# tag (or of one tag across tasks) directly instead of scanning every record of every
+# TensorBoard event file. The trainer writes each run's scalars to <run>/metrics.db
+# alongside the event file (see MetricsWriter). `refresh` merges runs into one index
+# database, importing only what was added since the last refresh: new rows of a
+# run's metrics.db, or, for runs that predate it, new records of its event files.
+#
+#   python -m src.metrics_store --index log/index.db log/gm log/ablations2
+#
+# Event files are read with the tensorboard protobufs, without TensorFlow.
+#
+import argparse
+import glob
+import os
+import re
+import sqlite3
+import struct
+import time
+from typing import Dict, Iterator, List, Optional, Tuple
+
+import numpy as np
+from tensorboard.compat.proto.event_pb2 import Event
+from tensorboard.util.tensor_util import make_ndarray
+
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS runs (run_id INTEGER PRIMARY KEY, name TEXT UNIQUE, path TEXT);
+CREATE TABLE IF NOT EXISTS tags (tag_id INTEGER PRIMARY KEY, tag TEXT UNIQUE, family TEXT, task INTEGER);
+CREATE INDEX IF NOT EXISTS tags_family ON tags (family, task);
+CREATE TABLE IF NOT EXISTS scalars (run_id INTEGER, tag_id INTEGER, step INTEGER, value REAL, wall_time REAL);
+CREATE UNIQUE INDEX IF NOT EXISTS scalars_run_tag_step ON scalars (run_id, tag_id, step);
+CREATE TABLE IF NOT EXISTS sources (path TEXT PRIMARY KEY, run_id INTEGER, position INTEGER);
+'''
+
+TASK = re.compile(r'Task_(\d+)')
+
+
+def tag_family(tag: str) -> Tuple[str, Optional[int]]:
+    ''''FT_Eval_Reward/Task_3_Step2' -> ('FT_Eval_Reward/Task_{}_Step2', 3); tags without a task -> (tag, None).'''
+    match = TASK.search(tag)
+    if match is None:
+        return tag, None
+    return tag[:match.start(1)] + '{}' + tag[match.end(1):], int(match.group(1))
+
+
+def read_events(path: str, offset: int = 0) -> Iterator[Tuple[Event, int]]:
+    '''(event, offset after it) for every complete record of a TFRecord event file from offset on.'''
+    with open(path, 'rb') as f:
+        f.seek(offset)
+        while True:
+            header = f.read(12)
+            if len(header) < 12:
+                return
+            length = struct.unpack('<Q', header[:8])[0]
+            data = f.read(length)
+            footer = f.read(4)
+            if len(data) < length or len(footer) < 4:
+                # A record still being written; the next refresh starts from here
+                return
+            offset += 12 + length + 4
+            event = Event()
+            event.ParseFromString(data)
+            yield event, offset
+
+
+def event_scalars(event: Event) -> Iterator[Tuple[str, float]]:
+    for value in event.summary.value:
+        kind = value.WhichOneof('value')
+        if kind == 'simple_value':
+            yield value.tag, value.simple_value
+        elif kind == 'tensor' and value.metadata.plugin_data.plugin_name == 'scalars':
+            yield value.tag, float(make_ndarray(value.tensor))
+
+
+class MetricsStore(object):
+    '''
+    Scalars indexed by (run, tag, step). Tags are split into a family and a task
+    (see tag_family), so per-task curves of one metric are a single indexed query.
+    '''
+    def __init__(self, path: str, readonly: bool = False):
+        self.path = path
+        if readonly:
+            # For reading a run's metrics.db while the trainer may still be writing it
+            self._db = sqlite3.connect(f'file:{os.path.abspath(path)}?mode=ro', uri=True, timeout=60)
+        else:
+            # Only used by one thread at a time, but MetricsWriter hands it to its writer thread
+            self._db = sqlite3.connect(path, timeout=60, check_same_thread=False)
+            self._db.execute('PRAGMA journal_mode=WAL')
+            self._db.executescript(SCHEMA)
+        self._tag_ids = dict(self._db.execute('SELECT tag, tag_id FROM tags'))
+
+    def run_id(self, name: str, path: Optional[str] = None) -> int:
+        self._db.execute('INSERT OR IGNORE INTO runs (name, path) VALUES (?, ?)', (name, path))
+        return self._db.execute('SELECT run_id FROM runs WHERE name = ?', (name,)).fetchone()[0]
+
+    def tag_id(self, tag: str) -> int:
+        if tag not in self._tag_ids:
+            family, task = tag_family(tag)
+            self._db.execute('INSERT OR IGNORE INTO tags (tag, family, task) VALUES (?, ?, ?)', (tag, family, task))
+            self._tag_ids[tag] = self._db.execute('SELECT tag_id FROM tags WHERE tag = ?', (tag,)).fetchone()[0]
+        return self._tag_ids[tag]
+
+    def add_scalars(self, run_id: int, scalars: List[Tuple[str, int, float, float]]):
+        '''Insert (tag, step, value, wall_time) rows; a later value for the same tag and step replaces the earlier one.'''
+        self._db.executemany('INSERT OR REPLACE INTO scalars (run_id, tag_id, step, value, wall_time) VALUES (?, ?, ?, ?, ?)',
+                             [(run_id, self.tag_id(tag), step, value, wall_time) for tag, step, value, wall_time in scalars])
+
+    def purge(self, run_id: int, step: int):
+        self._db.execute('DELETE FROM scalars WHERE run_id = ? AND step >= ?', (run_id, step))
+
+    def commit(self):
+        self._db.commit()
+
+    def close(self):
+        self._db.commit()
+        self._db.close()
+
+    #################################################################
+    ########################## QUERIES ##############################
+    #################################################################
+    def runs(self, pattern: str = '*') -> List[str]:
+        '''Names of the runs matching a glob pattern.'''
+        return [name for name, in self._db.execute('SELECT name FROM runs WHERE name GLOB ? ORDER BY name', (pattern,))]
+
+    def tags(self, run: Optional[str] = None, pattern: str = '*') -> List[str]:
+        if run is None:
+            query, params = 'SELECT tag FROM tags WHERE tag GLOB ? ORDER BY tag', (pattern,)
+        else:
+            query = ('SELECT tag FROM tags WHERE tag GLOB ? AND tag_id IN '
+                     '(SELECT DISTINCT tag_id FROM scalars WHERE run_id = (SELECT run_id FROM runs WHERE name = ?)) ORDER BY tag')
+            params = (pattern, run)
+        return [tag for tag, in self._db.execute(query, params)]
+
+    def scalars(self, run: str, tag: str) -> Tuple[np.ndarray, np.ndarray]:
+        '''(steps, values) of one tag of one run, ordered by step.'''
+        rows = self._db.execute('SELECT step, value FROM scalars WHERE run_id = (SELECT run_id FROM runs WHERE name = ?) '
+                                'AND tag_id = (SELECT tag_id FROM tags WHERE tag = ?) ORDER BY step', (run, tag)).fetchall()
+        rows = np.array(rows, dtype=np.float64).reshape(-1, 2)
+        return rows[:,0].astype(np.int64), rows[:,1]
+
+    def task_scalars(self, run: str, family: str) -> Dict[int, Tuple[np.ndarray, np.ndarray]]:
+        '''{task: (steps, values)} for every tag of a family, e.g. 'Eval_Reward/Task_{}'; a tag without a task is task -1.'''
+        rows = self._db.execute('SELECT COALESCE(tags.task, -1), step, value FROM scalars JOIN tags ON scalars.tag_id = tags.tag_id '
+                                'WHERE run_id = (SELECT run_id FROM runs WHERE name = ?) AND tags.family = ? '
+                                'ORDER BY tags.task, step', (run, family)).fetchall()
+        rows = np.array(rows, dtype=np.float64).reshape(-1, 3)
+        tasks = {}
+        for task in np.unique(rows[:,0]).astype(np.int64):
+            task_rows = rows[rows[:,0] == task]
+            tasks[int(task)] = (task_rows[:,1].astype(np.int64), task_rows[:,2])
+        return tasks
+
+    #################################################################
+    ########################## IMPORTS ##############################
+    #################################################################
+    def _position(self, source: str) -> int:
+        row = self._db.execute('SELECT position FROM sources WHERE path = ?', (source,)).fetchone()
+        return 0 if row is None else row[0]
+
+    def _set_position(self, source: str, run_id: int, position: int):
+        self._db.execute('INSERT OR REPLACE INTO sources (path, run_id, position) VALUES (?, ?, ?)', (source, run_id, position))
+
+    def import_events(self, run: str, events_path: str, batch: int = 10000) -> int:
+        '''Import the scalars of an event file written since the last import; returns the number of new scalars.'''
+        run_id = self.run_id(run, os.path.dirname(os.path.dirname(os.path.abspath(events_path))))
+        source = os.path.abspath(events_path)
+        position, count, rows = self._position(source), 0, []
+        for event, position in read_events(source, position):
+            rows.extend((tag, event.step, value, event.wall_time) for tag, value in event_scalars(event))
+            if len(rows) >= batch:
+                self.add_scalars(run_id, rows)
+                count, rows = count + len(rows), []
+                self._set_position(source, run_id, position)
+        self.add_scalars(run_id, rows)
+        self._set_position(source, run_id, position)
+        self.commit()
+        return count + len(rows)
+
+    def import_store(self, run: str, store_path: str) -> int:
+        '''Import the rows of another store (a run's metrics.db) added since the last import.'''
+        run_id = self.run_id(run, os.path.dirname(os.path.abspath(store_path)))
+        source = os.path.abspath(store_path)
+        position = self._position(source)
+        other = sqlite3.connect(f'file:{source}?mode=ro', uri=True, timeout=60)
+        rows = other.execute('SELECT scalars.rowid, tag, step, value, wall_time FROM scalars JOIN tags ON scalars.tag_id = tags.tag_id '
+                             'WHERE scalars.rowid > ? ORDER BY scalars.rowid', (position,)).fetchall()
+        other.close()
+        if len(rows):
+            self.add_scalars(run_id, [row[1:] for row in rows])
+            self._set_position(source, run_id, rows[-1][0])
+        self.commit()
+        return len(rows)
+
+    def refresh(self, roots: List[str]) -> Dict[str, int]:
+        '''
+        Import every run under roots (a directory with a metrics.db or a tb/ of event
+        files) and return the number of new scalars per run. Runs are named by their
+        path relative to their root.
+        '''
+        counts = {}
+        for root in roots:
+            for dirpath, dirnames, filenames in os.walk(root):
+                run = os.path.relpath(dirpath, os.path.dirname(os.path.normpath(root)))
+                if 'metrics.db' in filenames and os.path.abspath(os.path.join(dirpath, 'metrics.db')) != os.path.abspath(self.path):
+                    counts[run] = self.import_store(run, os.path.join(dirpath, 'metrics.db'))
+                    dirnames[:] = []
+                elif 'tb' in dirnames:
+                    events = sorted(glob.glob(os.path.join(dirpath, 'tb', 'events.out.tfevents.*')))
+                    counts[run] = sum(self.import_events(run, path) for path in events)
+                    dirnames[:] = []
+        return counts
+
+
+class StoreWriter(object):
+    '''
+    The add_scalar part of a SummaryWriter, writing to a MetricsStore as one run.
+    Rows are committed in batches of `batch` rows, or at least every flush_secs as
+    SummaryWriter flushes its event file, so the database's write lock is only held
+    while a batch is written, readers see a live run, and a killed run keeps what it
+    logged. As with SummaryWriter, rows at or after purge_step (from an interrupted
+    run being resumed) are deleted.
+    '''
+    def __init__(self, path: str, run: str, batch: int = 1000, purge_step: Optional[int] = None, flush_secs: float = 120):
+        self._path = path
+        self._run = run
+        self._batch = batch
+        self._purge_step = purge_step
+        self._flush_secs = flush_secs
+        self._store = None
+        self._rows = []
+        self._last_write = time.time()
+
+    def add_scalar(self, tag: str, value, step: int, walltime: Optional[float] = None):
+        self._rows.append((tag, int(step), float(value), time.time() if walltime is None else walltime))
+        if len(self._rows) >= self._batch or time.time() - self._last_write >= self._flush_secs:
+            self._write()
+
+    def _write(self):
+        if self._store is None:
+            # Opened lazily, by the thread that writes
+            self._store = MetricsStore(self._path)
+            self._run_id = self._store.run_id(self._run, os.path.dirname(os.path.abspath(self._path)))
+            if self._purge_step is not None:
+                self._store.purge(self._run_id, self._purge_step)
+        self._store.add_scalars(self._run_id, self._rows)
+        self._store.commit()
+        self._rows = []
+        self._last_write = time.time()
+
+    def flush(self):
+        self._write()
+
+    def close(self):
+        self.flush()
+        self._store.close()
+        self._store = None
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--index', type=str, required=True) # Index database to create or refresh
+    parser.add_argument('roots', type=str, nargs='+') # Log directories to import runs from
+    args = parser.parse_args()
+
+    start = time.time()
+    store = MetricsStore(args.index)
+    counts = store.refresh(args.roots)
+    for run, count in sorted(counts.items()):
+        if count:
+            print(f'{run}: {count} new scalars')
+    print(f'Refreshed {len(counts)} runs into {args.index} in {time.time() - start:.1f}s')
+    store.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -1,45 +1,43 @@
-from tensorflow.python.summary.summary_iterator import summary_iterator
 import argparse
 import glob
 import os
-import re
-import numpy as np
+
+import matplotlib
+matplotlib.use('Agg')
+import matplotlib.pyplot as plt
+
+from src.aggregate import load_runs, group_seeds, reduce_seeds
 
 
 def run(args: argparse.Namespace):
-    runs = {}
-    for path in glob.glob(args.path + '/*'):
-        basename = os.path.basename(path)
-        if re.match('^.*_[0-9]+$', basename) is not None:
-            runs[basename] = []
-        else:
-            basename = basename[:basename.rindex('_')]
-
-        events_file = glob.glob(path + '/tb/*')[0]
-        it = summary_iterator(events_file)
-
-        rewards = []
-        for x in it:
-            try:
-                tag = x.summary.value[0].tag
-                value = x.summary.value[0].simple_value
-                if tag.startswith('Reward_Train/Task_'):
-                    idx = int(tag[tag.rindex('_')+1:])
-                    while idx >= len(rewards):
-                        rewards.append([])
-                    rewards[idx].append(value)
-            except Exception as e:
-                print(e)
-
-        min_length = min([len(r) for r in rewards])
-        rewards = np.array([r[:min_length] for r in rewards])
-        reduced_rewards = np.mean(rewards, 0)
-        import pdb; pdb.set_trace()
-            
+    # Parsed in parallel and cached per run, so regenerating a figure doesn't rescan unchanged event files
+    run_dirs = [path for path in glob.glob(args.path + '/*') if os.path.isdir(path)]
+    curves = load_runs(run_dirs, args.family, cache_dir=args.cache_dir, workers=args.workers)
+
+    fig, ax = plt.subplots()
+    for name, seeds in sorted(group_seeds(curves).items()):
+        stats = reduce_seeds(seeds)
+        if len(stats['steps']) == 0:
+            continue
+        ax.plot(stats['steps'], stats['mean'], label=f'{name} ({len(seeds)} seeds)')
+        ax.fill_between(stats['steps'], stats['q25'], stats['q75'], alpha=0.2)
+        print(f'{name}: {len(seeds)} seeds, step {stats["steps"][-1]}, mean {stats["mean"][-1]:.2f}')
+
+    ax.set_xlabel('Step')
+    ax.set_ylabel(args.family.replace('/Task_{}', ' (task mean)'))
+    ax.legend()
+    output = args.output if args.output is not None else os.path.join(args.path, 'plot.png')
+    fig.savefig(output, bbox_inches='tight')
+    print(f'Wrote {output}')
+
 
 def get_args():
     args = argparse.ArgumentParser()
     args.add_argument('--path', type=str)
+    args.add_argument('--family', type=str, default='Reward_Train/Task_{}') # Tag family to plot, see src/metrics_store.tag_family
+    args.add_argument('--output', type=str, default=None) # Defaults to <path>/plot.png
+    args.add_argument('--cache_dir', type=str, default=os.path.expanduser('~/.cache/maml_rawr/aggregate'))
+    args.add_argument('--workers', type=int, default=os.cpu_count())
     return args.parse_args()
 
 
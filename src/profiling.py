@@ -0,0 +1,159 @@
+#
+# Always-on, low overhead timing of the phases of a training iteration. PhaseTimer
+# is a stopwatch: switch(phase) charges the time since the previous switch to the
+# phase that was running, so marking a phase is one perf_counter call and one dict
+# update, and phases never overlap or leave gaps.
+#
+# torch_profiler() captures operator-level torch.profiler traces for scheduled
+# windows of training iterations; the PhaseTimer phases show up in those traces as
+# labelled ranges.
+#
+import json
+import os
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from typing import Dict, Optional
+
+import torch
+import torch.profiler as profiler
+
+
+class PhaseTimer(object):
+    '''
+    Accumulates wall time per phase. `interval_summary` returns (and resets) the
+    times since its last call; `totals` holds them for the whole run. With
+    cuda_sync, every switch waits for queued GPU work, so that kernels are charged
+    to the phase that launched them rather than to the next one that syncs.
+    '''
+    def __init__(self, cuda_sync: bool = False):
+        self._cuda_sync = cuda_sync and torch.cuda.is_available()
+        self._interval = defaultdict(float)
+        self.totals = defaultdict(float)
+        self.switches = 0
+        self._phase = None
+        self._start = None
+        # Set while a torch.profiler window is recording, to label each phase in the trace
+        self.annotate = False
+        self._range = None
+        # Called with (phase ending, phase starting) at every switch; see src/memory.py
+        self.hooks = []
+
+    @property
+    def phase(self) -> Optional[str]:
+        return self._phase
+
+    def switch(self, phase: Optional[str]):
+        if self._cuda_sync:
+            torch.cuda.synchronize()
+        now = time.perf_counter()
+        if self._phase is not None:
+            self._interval[self._phase] += now - self._start
+        if self.hooks:
+            for hook in self.hooks:
+                hook(self._phase, phase)
+            # The hooks' own time is not charged to any phase
+            now = time.perf_counter()
+        self._phase = phase
+        self._start = now
+        self.switches += 1
+
+        if self._range is not None:
+            self._range.__exit__(None, None, None)
+            self._range = None
+        if self.annotate and phase is not None:
+            self._range = profiler.record_function(phase)
+            self._range.__enter__()
+
+    def stop(self):
+        self.switch(None)
+
+    @contextmanager
+    def time(self, phase: str):
+        '''Time a block as `phase`, then return to whatever phase was running before it.'''
+        previous = self._phase
+        self.switch(phase)
+        try:
+            yield
+        finally:
+            self.switch(previous)
+
+    def interval_summary(self) -> Dict[str, float]:
+        '''Seconds per phase since the last call.'''
+        if self._phase is not None:
+            self.switch(self._phase)
+        summary = dict(self._interval)
+        for phase, seconds in summary.items():
+            self.totals[phase] += seconds
+        self._interval.clear()
+        return summary
+
+    def log(self, writer, step: int, steps: int):
+        '''Write the mean ms per step of every phase over the last `steps` steps, and each phase's share of the total.'''
+        summary = self.interval_summary()
+        total = sum(summary.values())
+        for phase, seconds in summary.items():
+            writer.add_scalar(f'Time/{phase}', 1000 * seconds / max(steps, 1), step)
+            writer.add_scalar(f'Time_Fraction/{phase}', seconds / max(total, 1e-12), step)
+
+    def dump(self, path: str, steps: int):
+        '''Write the run's totals so far (including the current interval) as JSON.'''
+        if self._phase is not None:
+            self.switch(self._phase)
+        totals = defaultdict(float, self.totals)
+        for phase, seconds in self._interval.items():
+            totals[phase] += seconds
+        total = sum(totals.values())
+        summary = {phase: {'seconds': seconds, 'ms_per_step': 1000 * seconds / max(steps, 1),
+                           'fraction': seconds / max(total, 1e-12)}
+                   for phase, seconds in sorted(totals.items(), key=lambda item: -item[1])}
+        with open(path, 'w') as f:
+            json.dump({'steps': steps, 'seconds': total, 'phases': summary}, f, indent=4)
+
+
+def profiler_schedule(start: int, steps: int, every: int = 0, warmup: int = 1, offset: int = 0):
+    '''
+    A torch.profiler schedule that records iterations [start, start + steps), after
+    `warmup` iterations, and again every `every` iterations if every > 0. Iterations
+    are counted from `offset`, the first iteration the profiler sees.
+    '''
+    if every > 0 and every < steps + warmup:
+        raise ValueError(f'Profiling every {every} steps leaves no room for {warmup} warmup + {steps} active steps')
+
+    def schedule(step: int) -> profiler.ProfilerAction:
+        position = step + offset - (start - warmup)
+        if position < 0:
+            return profiler.ProfilerAction.NONE
+        if every > 0:
+            position %= every
+        if position < warmup:
+            return profiler.ProfilerAction.WARMUP
+        elif position < warmup + steps - 1:
+            return profiler.ProfilerAction.RECORD
+        elif position == warmup + steps - 1:
+            return profiler.ProfilerAction.RECORD_AND_SAVE
+        return profiler.ProfilerAction.NONE
+
+    return schedule
+
+
+def torch_profiler(output_dir: str, start: int, steps: int, every: int = 0, offset: int = 0, cuda: bool = False):
+    '''
+    A torch.profiler.profile that records CPU (and cuda) ops with shapes, memory and
+    stacks over the iterations given by profiler_schedule. Call .step() once per
+    iteration. Each window is written to output_dir as a Chrome/TensorBoard trace,
+    along with a text table of the ops grouped by stack.
+    '''
+    os.makedirs(output_dir, exist_ok=True)
+    # Traces with stacks and shapes run to 100s of MB per window uncompressed
+    trace_handler = profiler.tensorboard_trace_handler(output_dir, use_gzip=True)
+
+    def on_trace_ready(prof):
+        trace_handler(prof)
+        last = prof.step_num + offset - 1
+        with open(os.path.join(output_dir, f'ops_steps{last - steps + 1}_{last}.txt'), 'w') as f:
+            f.write(prof.key_averages(group_by_stack_n=5).table(sort_by='self_cpu_time_total', row_limit=50))
+
+    activities = [profiler.ProfilerActivity.CPU] + ([profiler.ProfilerActivity.CUDA] if cuda else [])
+    return profiler.profile(activities=activities, schedule=profiler_schedule(start, steps, every, offset=offset),
+                            on_trace_ready=on_trace_ready, record_shapes=True, profile_memory=True, with_stack=True)
@@ -529,10 +529,10 @@ class SAC(OffPolicyRLModel):
                     infos_values = []
                 
                 if step % 100000==0:
-                    self.full_buffer.save(self.buffer_log + 'sub_task_{}.hdf5'.format(0))
+                    self.full_buffer.save_incremental(self.buffer_log + 'sub_task_{}.hdf5'.format(0))
 
             callback.on_training_end()          
-            self.full_buffer.save(self.buffer_log + 'sub_task_{}.hdf5'.format(0))
+            self.full_buffer.save_incremental(self.buffer_log + 'sub_task_{}.hdf5'.format(0))
 
             
             return self
@@ -0,0 +1,233 @@
+#
+# Dependency-free (numpy + gym.spaces) meta-RL task families for benchmarking
+# the training pipeline on machines without MuJoCo. Every env exposes the same
+# interface as the wrappers in src/envs.py (tasks, set_task_idx, seed, reset,
+# step, _max_episode_steps), and can also run a batch of episodes in lockstep.
+#
+import numpy as np
+from gym.spaces import Box
+from typing import List, Optional, Union
+
+from src.task_conditioning import TaskConditionedEnv, one_hot_suffixes
+from src.tp_envs import register_env, ENVS
+
+
+class SyntheticMetaEnv(TaskConditionedEnv):
+    '''
+    Base class for the synthetic task families. Dynamics are written for a batch of
+    `batch_size` parallel episodes (state arrays have a leading batch dimension).
+    With batch_size=None the env behaves like a regular single-episode gym env:
+    observations are 1-D, rewards are floats and done is a bool.
+
+    In batched mode set_task_idx also accepts one task index per episode, so a
+    single env can step different tasks at once.
+    '''
+    def __init__(self, tasks: List[dict] = None, n_tasks: int = 8, obs_dim: int = 2, action_dim: int = 2,
+                 batch_size: Optional[int] = None, include_goal: bool = False, episode_length: int = 100,
+                 seed: int = 1337):
+        rng = np.random.RandomState(seed)
+        self._obs_dim = obs_dim
+        self._action_dim = action_dim
+        self._build(rng)
+
+        self.tasks = tasks if tasks is not None else self.sample_tasks(n_tasks, rng)
+        self.n_tasks = len(self.tasks)
+        self._task_params = self._stack_task_params(self.tasks)
+
+        self.include_goal = include_goal
+        self._batch_size = batch_size
+        self._n = 1 if batch_size is None else batch_size
+        self._max_episode_steps = episode_length
+        self._t = 0
+        self._state = None
+
+        self.action_space = Box(low=-1., high=1., shape=(action_dim,), dtype=np.float32)
+        suffix_dim = self.n_tasks if include_goal else 0
+        self.observation_space = Box(low=-np.inf, high=np.inf, shape=(obs_dim + suffix_dim,), dtype=np.float32)
+
+        self.np_random = np.random.RandomState()
+        self._init_task_suffixes(one_hot_suffixes(self.n_tasks))
+        self.set_task_idx(0)
+
+    #################################################################
+    ################# TASK FAMILY INTERFACE #########################
+    #################################################################
+    def _build(self, rng: np.random.RandomState):
+        '''Sample any task-independent structure (e.g. action projections).'''
+        pass
+
+    def sample_tasks(self, n_tasks: int, rng: np.random.RandomState) -> List[dict]:
+        raise NotImplementedError()
+
+    def _stack_task_params(self, tasks: List[dict]) -> dict:
+        '''Stack per-task parameters into arrays indexed by task along axis 0.'''
+        return {k: np.stack([np.asarray(task[k], dtype=np.float32) for task in tasks]) for k in tasks[0].keys()}
+
+    def _reset_state(self) -> np.ndarray:
+        raise NotImplementedError()
+
+    def _transition(self, action: np.ndarray) -> np.ndarray:
+        '''Advance self._state by one step for the whole batch and return rewards of shape (batch,)'''
+        raise NotImplementedError()
+
+    def _observe(self) -> np.ndarray:
+        return self._state
+
+    #################################################################
+    ################# GYM-STYLE INTERFACE ###########################
+    #################################################################
+    def get_all_task_idx(self):
+        return range(len(self.tasks))
+
+    def set_task_idx(self, idx: Union[int, np.ndarray]):
+        idx = np.asarray(idx)
+        if idx.ndim > 0 and self._batch_size is None:
+            raise ValueError('Per-episode task indices require batch_size to be set')
+        self._task_idx = idx
+        # Per-episode parameter views of shape (batch, ...); scalar indices broadcast
+        self._params = {k: np.broadcast_to(v[idx], (self._n,) + v.shape[1:]) for k, v in self._task_params.items()}
+        self._suffix = np.broadcast_to(self._task_suffixes[idx], (self._n, self._task_suffixes.shape[-1]))
+        if idx.ndim == 0:
+            self._task = self.tasks[int(idx)]
+            self._select_task_suffix(int(idx))
+
+    def set_task(self, task: dict):
+        self.set_task_idx(self.tasks.index(task))
+
+    def seed(self, seed: int = None):
+        self.np_random = np.random.RandomState(None if seed is None else seed % 2 ** 32)
+        return [seed]
+
+    def reset(self) -> np.ndarray:
+        self._t = 0
+        self._state = self._reset_state()
+        return self._output(self._observe())
+
+    def step(self, action: np.ndarray):
+        action = np.asarray(action, dtype=np.float32).reshape(self._n, self._action_dim)
+        action = action.clip(self.action_space.low, self.action_space.high)
+        self._t += 1
+        rewards = self._transition(action)
+        done = self._t >= self._max_episode_steps
+        obs = self._output(self._observe())
+
+        if self._batch_size is None:
+            return obs, float(rewards[0]), done, {}
+        return obs, rewards, np.full((self._n,), done), {}
+
+    def _output(self, obs: np.ndarray) -> np.ndarray:
+        if self._batch_size is None:
+            return self._condition_obs(obs[0]) if self.include_goal else obs[0].copy()
+
+        if self.include_goal:
+            out = np.empty((self._n, obs.shape[-1] + self._suffix.shape[-1]), dtype=obs.dtype)
+            out[:, :obs.shape[-1]] = obs
+            out[:, obs.shape[-1]:] = self._suffix
+            return out
+        return obs.copy()
+
+    def render(self, *args, **kwargs):
+        pass
+
+
+@register_env('synthetic-point')
+class SyntheticPointEnv(SyntheticMetaEnv):
+    '''
+    N-D generalization of PointEnv (src/tp_envs/point_robot.py): position control
+    towards a per-task goal on the unit sphere, reward is negative L2 distance. When
+    action_dim != obs_dim actions are mapped through a fixed random projection.
+    '''
+    def _build(self, rng):
+        if self._action_dim == self._obs_dim:
+            self._projection = np.eye(self._obs_dim, dtype=np.float32)
+        else:
+            self._projection = (rng.normal(size=(self._action_dim, self._obs_dim)) / np.sqrt(self._action_dim)).astype(np.float32)
+
+    def sample_tasks(self, n_tasks, rng):
+        goals = rng.normal(size=(n_tasks, self._obs_dim))
+        goals /= np.linalg.norm(goals, axis=-1, keepdims=True)
+        return [{'goal': goal.astype(np.float32)} for goal in goals]
+
+    def _reset_state(self):
+        return self.np_random.uniform(-1., 1., size=(self._n, self._obs_dim)).astype(np.float32)
+
+    def _transition(self, action):
+        self._state = self._state + 0.1 * action @ self._projection
+        return -np.linalg.norm(self._state - self._params['goal'], axis=-1)
+
+
+@register_env('synthetic-velocity')
+class SyntheticVelocityEnv(SyntheticMetaEnv):
+    '''
+    Point-mass analog of cheetah_vel, generalizing PointMass1DEnv (src/envs_.py):
+    the observation is (position, velocity), actions are accelerations, and the
+    reward penalizes the gap between the velocity along the first axis and the
+    per-task target velocity plus a small control cost.
+    '''
+    def _build(self, rng):
+        if self._obs_dim % 2 != 0:
+            raise ValueError(f'synthetic-velocity needs an even obs_dim (position, velocity), got {self._obs_dim}')
+        self._dim = self._obs_dim // 2
+        self._projection = (np.eye(self._action_dim, self._dim) if self._action_dim <= self._dim else
+                            rng.normal(size=(self._action_dim, self._dim)) / np.sqrt(self._action_dim)).astype(np.float32)
+        self._dt = 0.1
+
+    def sample_tasks(self, n_tasks, rng):
+        velocities = np.linspace(0.075, 3, n_tasks)
+        return [{'velocity': velocity} for velocity in velocities]
+
+    def _reset_state(self):
+        return (self.np_random.normal(size=(self._n, self._obs_dim)) * 0.01).astype(np.float32)
+
+    def _transition(self, action):
+        position, velocity = self._state[:, :self._dim], self._state[:, self._dim:]
+        velocity = velocity + self._dt * 10 * (action @ self._projection)
+        position = position + self._dt * velocity
+        self._state = np.concatenate((position, velocity), -1)
+        forward_reward = -np.abs(velocity[:, 0] - self._params['velocity'])
+        ctrl_cost = 0.05 * np.square(action).sum(-1)
+        return forward_reward - ctrl_cost
+
+
+@register_env('synthetic-linear')
+class SyntheticLinearEnv(SyntheticMetaEnv):
+    '''
+    Random stable linear dynamics s' = A_task s + B a with a per-task goal, and a
+    quadratic tracking reward. Tasks differ in both dynamics and reward, which makes
+    this the closest stand-in for the rand-params envs.
+    '''
+    def _build(self, rng):
+        self._B = (rng.normal(size=(self._action_dim, self._obs_dim)) * 0.1).astype(np.float32)
+
+    def sample_tasks(self, n_tasks, rng):
+        tasks = []
+        for _ in range(n_tasks):
+            A = rng.normal(size=(self._obs_dim, self._obs_dim))
+            A = 0.95 * A / max(np.abs(np.linalg.eigvals(A)).max(), 1e-6)
+            tasks.append({'dynamics': A.astype(np.float32),
+                          'goal': rng.uniform(-1., 1., size=(self._obs_dim,)).astype(np.float32)})
+        return tasks
+
+    def _reset_state(self):
+        return self.np_random.uniform(-1., 1., size=(self._n, self._obs_dim)).astype(np.float32)
+
+    def _transition(self, action):
+        # Batched s @ A^T for per-episode A of shape (batch, obs_dim, obs_dim)
+        self._state = np.einsum('bij,bj->bi', self._params['dynamics'], self._state) + action @ self._B
+        return -np.square(self._state - self._params['goal']).sum(-1) - 0.01 * np.square(action).sum(-1)
+
+
+SYNTHETIC_PREFIX = 'synthetic-'
+
+
+def make_synthetic_env(name: str, **kwargs) -> SyntheticMetaEnv:
+    '''
+    Build a registered synthetic env by family name ('point', 'velocity', 'linear')
+    or full registry name ('synthetic-point').
+    '''
+    if not name.startswith(SYNTHETIC_PREFIX):
+        name = SYNTHETIC_PREFIX + name
+    if name not in ENVS:
+        families = [n[len(SYNTHETIC_PREFIX):] for n in ENVS if n.startswith(SYNTHETIC_PREFIX)]
+        raise ValueError(f'Unknown synthetic env {name}; available families: {families}')
+    return ENVS[name](**kwargs)
@@ -0,0 +1,61 @@
+import numpy as np
+from typing import List, Optional
+
+
+def one_hot_suffixes(n_tasks: int, width: Optional[int] = None, dtype=np.float32) -> np.ndarray:
+    '''
+    Row i is the one-hot conditioning suffix for task i. `width` can be larger
+    than `n_tasks` for envs that pad their one-hot (e.g. AntDirEnv always uses 50).
+    '''
+    width = n_tasks if width is None else width
+    return np.eye(n_tasks, width, dtype=dtype)
+
+
+class TaskConditionedEnv(object):
+    '''
+    Mixin for multi-task envs that append a task description (one-hot or goal) to
+    every observation. The suffix for each task is computed once when the task table
+    is set up, so conditioning an observation during a rollout is a copy into one
+    output array instead of a search over self.tasks plus a fresh one-hot and
+    np.concatenate per step.
+
+    Subclasses call _init_task_suffixes once their task list is known, then
+    _select_task_suffix from set_task_idx (or _select_task_suffix_for from set_task
+    when they are handed a task dict rather than an index), and _condition_obs
+    from _get_obs/step.
+    '''
+    _task_suffixes = None
+    _task_suffix = None
+
+    def _init_task_suffixes(self, suffixes: np.ndarray, idx: int = 0):
+        self._task_suffixes = np.asarray(suffixes)
+        if self._task_suffixes.ndim == 1:
+            self._task_suffixes = self._task_suffixes[:, None]
+        self._select_task_suffix(idx)
+
+    def _select_task_suffix(self, idx: int):
+        self._task_suffix = self._task_suffixes[idx]
+
+    def _select_task_suffix_for(self, task, tasks: List, default_idx: int = 0):
+        '''
+        Pick the suffix for a task dict. This is the only place that scans the task
+        list, and it only runs when the task changes, never per step. Tasks that are
+        not in the list fall back to `default_idx`, matching the old per-step lookup.
+        '''
+        try:
+            idx = tasks.index(task)
+        except ValueError:
+            idx = default_idx
+        self._select_task_suffix(idx)
+        return idx
+
+    def _condition_obs(self, obs: np.ndarray) -> np.ndarray:
+        # The output has to be a fresh array: rollouts keep a reference to every
+        # observation (Experience.state/next_state), so reusing a single output
+        # buffer across steps would alias the whole trajectory.
+        suffix = self._task_suffix
+        n = obs.shape[0]
+        conditioned = np.empty(n + suffix.shape[0], dtype=np.result_type(obs, suffix))
+        conditioned[:n] = obs
+        conditioned[n:] = suffix
+        return conditioned
@@ -445,9 +445,9 @@ class TD3(OffPolicyRLModel):
 
                 if step % 10000 == 0:
                     for i, buffer in enumerate(self.full_buffers):
-                        buffer.save(self.buffer_log + 'sub_task_{}.hdf5'.format(i))
+                        buffer.save_incremental(self.buffer_log + 'sub_task_{}.hdf5'.format(i))
             for i, buffer in enumerate(self.full_buffers):
-                buffer.save(self.buffer_log + 'sub_task_{}.hdf5'.format(i))
+                buffer.save_incremental(self.buffer_log + 'sub_task_{}.hdf5'.format(i))
             callback.on_training_end()
             return self
 
@@ -1,4 +1,4 @@
-from typing import NamedTuple, List
+from typing import NamedTuple, List, Optional
 
 import h5py
 import numpy as np
@@ -8,6 +8,8 @@ import torch.nn as nn
 import os
 import random
 
+from src.columnar import Columns, FIELDS as COLUMNS, is_columnar
+
 
 class RunningEstimator(object):
     def __init__(self):
@@ -37,6 +39,34 @@ class RunningEstimator(object):
         self._n += 1
 
 
+def get_np_rng_state(rng=np.random):
+    '''rng.get_state() with the key array as a tensor, so that it can be saved with torch.save.'''
+    name, keys, pos, has_gauss, cached_gaussian = rng.get_state()
+    return name, torch.from_numpy(keys.astype(np.int64)), pos, has_gauss, cached_gaussian
+
+
+def set_np_rng_state(state, rng=np.random):
+    name, keys, pos, has_gauss, cached_gaussian = state
+    rng.set_state((name, keys.cpu().numpy().astype(np.uint32), pos, has_gauss, cached_gaussian))
+
+
+def get_rng_state():
+    '''The states of the python, numpy and torch (cpu) RNGs.'''
+    return random.getstate(), get_np_rng_state(), torch.get_rng_state()
+
+
+def set_rng_state(state):
+    random.setstate(state[0])
+    set_np_rng_state(state[1])
+    torch.set_rng_state(state[2].cpu())
+
+
+class NullWriter(object):
+    '''Stands in for a SummaryWriter when nothing should be logged; every method is a no-op.'''
+    def __getattr__(self, name):
+        return lambda *args, **kwargs: None
+
+
 def argmax(module: nn.Module, arg: torch.tensor):
     print('Computing argmax')
     arg.requires_grad = True
@@ -77,6 +107,46 @@ class Experience(NamedTuple):
     done: bool
 
 
+def _offline_slice(stored: int, chunk_size: int, mode: str) -> slice:
+    '''The chunk_size steps of a stored offline buffer to load, for each --buffer_mode.'''
+    if mode == 'end':
+        return slice(-chunk_size, stored)
+    elif mode == 'middle':
+        center = stored // 2
+        return slice(center // 2 - chunk_size // 2,center // 2 + chunk_size // 2)
+    elif mode == 'start':
+        return slice(chunk_size)
+    else:
+        raise Exception(f'No such mode {mode}')
+
+
+def write_delta(delta: dict, location: str, chunk_rows: int = 1024):
+    '''Write a NewReplayBuffer.delta to the incremental file at location; see NewReplayBuffer.save_incremental.'''
+    if delta['saved_total'] is None:
+        f = h5py.File(location, 'w')
+        for name, (data,) in delta['data'].items():
+            f.create_dataset(name, data=data, maxshape=(delta['size'],) + data.shape[1:],
+                             chunks=(min(chunk_rows, delta['size']),) + data.shape[1:], compression='lzf')
+        f.create_dataset('discount_factor', data=delta['discount_factor'])
+        f.attrs['incremental'] = True
+    else:
+        f = h5py.File(location, 'a')
+        if int(f.attrs['total_written']) != delta['saved_total']:
+            f.close()
+            raise RuntimeError(f'{location} changed since its delta was taken')
+        for name, chunks in delta['data'].items():
+            dataset = f[name]
+            if dataset.shape[0] < delta['stored_steps']:
+                dataset.resize(delta['stored_steps'], axis=0)
+            for (begin, end), data in zip(delta['ranges'], chunks):
+                dataset[begin:end] = data
+
+    f.attrs['write_location'] = delta['write_location']
+    f.attrs['total_written'] = delta['total_written']
+    f.attrs['size'] = delta['size']
+    f.close()
+
+
 class NewReplayBuffer(object):
     def __init__(self, size: int, obs_dim: int, action_dim: int, discount_factor: float = 0.99,
                  immutable: bool = False, load_from: str = None, silent: bool = False, skip: int = 1,
@@ -88,14 +158,31 @@ class NewReplayBuffer(object):
         self.immutable = immutable
         self.stream_to_disk = stream_to_disk
         
+        columnar = load_from is not None and is_columnar(load_from)
         if load_from is not None:
-            f = h5py.File(load_from, 'r')
+            # A columnar buffer is indexed like the h5py.File, but its fields are memmaps
+            f = Columns(load_from, 'c') if columnar else h5py.File(load_from, 'r')
             if size == -1:
                 size = f['obs'].shape[0]
         
         needs_to_load = True
         size //= skip
-        if stream_to_disk:
+        if columnar and immutable:
+            # Use (copy-on-write views of) the mapped columns directly, so nothing is read
+            # up front. The buffer holds exactly the loaded steps.
+            stored = f['obs'].shape[0]
+            n_seed = min(stored, size * skip)
+            size = n_seed // skip
+            needs_to_load = False
+            if not silent:
+                print(f'Mapping trajectories from {load_from}')
+            columns = {field: f[field][_offline_slice(stored, n_seed, mode)][::skip][:size] for field in COLUMNS}
+            self._obs, self._actions = columns['obs'], columns['actions']
+            self._rewards, self._mc_rewards = columns['rewards'], columns['mc_rewards']
+            self._terminals, self._terminal_obs = columns['terminals'], columns['terminal_obs']
+            self._terminal_discounts, self._next_obs = columns['terminal_discounts'], columns['next_obs']
+            self._discount_factor = f['discount_factor'][()]
+        elif stream_to_disk:
             name = os.path.splitext(os.path.basename(os.path.normpath(load_from)))[0]
             if os.path.exists('/scr-ssd'):
                 path = f'/scr-ssd/em7/{name}'
@@ -168,15 +255,7 @@ class NewReplayBuffer(object):
                 chunk_size = n_seed# + int(skip > 1)
 
                 self._discount_factor = f['discount_factor'][()]
-                if mode == 'end':
-                    h5slice = slice(-chunk_size, stored)
-                elif mode == 'middle':
-                    center = stored // 2
-                    h5slice = slice(center // 2 - chunk_size // 2,center // 2 + chunk_size // 2)
-                elif mode == 'start':
-                    h5slice = slice(chunk_size)
-                else:
-                    raise Exception(f'No such mode {mode}')
+                h5slice = _offline_slice(stored, chunk_size, mode)
 
                 self._obs[:self._stored_steps] = f['obs'][h5slice][::skip]
                 self._actions[:self._stored_steps] = f['actions'][h5slice][::skip]
@@ -190,6 +269,7 @@ class NewReplayBuffer(object):
             f.close()
 
         self._write_location = self._stored_steps % self._size
+        self._total_written = self._stored_steps
         self._valid = np.where(np.logical_and(~np.isnan(self._terminal_discounts[:,0]), self._terminal_discounts[:,0] < 0.35))[0]
 
     @property
@@ -203,18 +283,98 @@ class NewReplayBuffer(object):
     def __len__(self):
         return self._stored_steps
 
+    def _datasets(self):
+        return {
+            'obs': self._obs,
+            'actions': self._actions,
+            'rewards': self._rewards,
+            'mc_rewards': self._mc_rewards,
+            'terminals': self._terminals,
+            'terminal_obs': self._terminal_obs,
+            'terminal_discounts': self._terminal_discounts,
+            'next_obs': self._next_obs
+        }
+
+    def _write_header(self, f):
+        f.attrs['write_location'] = self._write_location
+        f.attrs['total_written'] = self._total_written
+        f.attrs['size'] = self._size
+
     def save(self, location: str):
         f = h5py.File(location, 'w')
-        f.create_dataset('obs', data=self._obs[:self._stored_steps], compression='lzf')
-        f.create_dataset('actions', data=self._actions[:self._stored_steps], compression='lzf')
-        f.create_dataset('rewards', data=self._rewards[:self._stored_steps], compression='lzf')
-        f.create_dataset('mc_rewards', data=self._mc_rewards[:self._stored_steps], compression='lzf')
-        f.create_dataset('terminals', data=self._terminals[:self._stored_steps], compression='lzf')
-        f.create_dataset('terminal_obs', data=self._terminal_obs[:self._stored_steps], compression='lzf')
-        f.create_dataset('terminal_discounts', data=self._terminal_discounts[:self._stored_steps], compression='lzf')
-        f.create_dataset('next_obs', data=self._next_obs[:self._stored_steps], compression='lzf')
+        for name, data in self._datasets().items():
+            f.create_dataset(name, data=data[:self._stored_steps], compression='lzf')
         f.create_dataset('discount_factor', data=self._discount_factor)
+        self._write_header(f)
         f.close()
+
+    @staticmethod
+    def saved_total(location: str, size: int) -> Optional[int]:
+        '''total_written in the header of the incremental file at location, or None if there is no such file of this size.'''
+        if not os.path.exists(location):
+            return None
+        with h5py.File(location, 'r') as f:
+            if f.attrs.get('incremental', False) and f.attrs['size'] == size:
+                return int(f.attrs['total_written'])
+        return None
+
+    def delta(self, location: str) -> dict:
+        '''
+        A copy of the rows added or overwritten since location was last written by
+        save_incremental (all the rows, if it can't be updated), and the header fields.
+        The write itself is write_delta(delta, location), which e.g. a checkpoint writer
+        process can do: only the delta has to be sent to it, not the buffer.
+        '''
+        saved = NewReplayBuffer.saved_total(location, self._size)
+        new_rows = None if saved is None else self._total_written - saved
+        if new_rows is None or new_rows < 0 or new_rows >= self._size:
+            saved, ranges = None, [(0, self._stored_steps)]
+        else:
+            # The new rows are the new_rows before the write location, wrapping around the end of the buffer
+            start = (self._write_location - new_rows) % self._size
+            if start + new_rows <= self._size:
+                ranges = [(start, start + new_rows)]
+            else:
+                ranges = [(start, self._size), (0, start + new_rows - self._size)]
+
+        return {
+            'saved_total': saved,
+            'ranges': ranges,
+            'data': {name: [np.array(data[begin:end]) for begin, end in ranges] for name, data in self._datasets().items()},
+            'discount_factor': self._discount_factor,
+            'stored_steps': self._stored_steps,
+            'write_location': self._write_location,
+            'total_written': self._total_written,
+            'size': self._size
+        }
+
+    def save_incremental(self, location: str, chunk_rows: int = 1024):
+        '''
+        Like save, but the datasets are chunked and resizable, and only the rows added or
+        overwritten since location was last written are saved, so a save costs O(new data).
+        The header (see _write_header) is updated last, so a save that is interrupted is
+        redone in full by the next one. The file is readable by the loader in __init__.
+        '''
+        write_delta(self.delta(location), location, chunk_rows)
+
+    def restore(self, location: str):
+        '''Reload the contents and write position saved by save(), e.g. to resume training.'''
+        f = h5py.File(location, 'r')
+        n = f['obs'].shape[0]
+        self._obs[:n] = f['obs'][()]
+        self._actions[:n] = f['actions'][()]
+        self._rewards[:n] = f['rewards'][()]
+        self._mc_rewards[:n] = f['mc_rewards'][()]
+        self._terminals[:n] = f['terminals'][()]
+        self._terminal_obs[:n] = f['terminal_obs'][()]
+        self._terminal_discounts[:n] = f['terminal_discounts'][()]
+        self._next_obs[:n] = f['next_obs'][()]
+        self._discount_factor = f['discount_factor'][()]
+        self._stored_steps = n
+        self._write_location = int(f.attrs['write_location']) if 'write_location' in f.attrs else n % self._size
+        self._total_written = int(f.attrs['total_written']) if 'total_written' in f.attrs else n
+        f.close()
+        self._valid = np.where(np.logical_and(~np.isnan(self._terminal_discounts[:,0]), self._terminal_discounts[:,0] < 0.35))[0]
     
     def add_trajectory(self, trajectory: List[Experience], force: bool = False):
         if self.immutable and not force:
@@ -242,6 +402,7 @@ class NewReplayBuffer(object):
 
             self._write_location += 1
             self._write_location = self._write_location % self._size
+            self._total_written += 1
             
             if self._stored_steps < self._size:
                 self._stored_steps += 1